@@ -0,0 +1,404 @@
+import argparse
+import json
+import time
+
+import faiss
+import numpy as np
+
+from config import INDEX_DIR, INDEX_FACTORY, SEARCH_NPROBE, SEARCH_EF_SEARCH, ANN_TRAIN_SAMPLE, RESCORE_K_FACTOR
+
+# --- 近似最近邻索引 ---
+# 建索引时先写入暴力索引（IndexFlatL2），全部 chunk 就绪后再按 config.INDEX_FACTORY 转换：
+#   "Flat"              -> 精确检索（默认），耗时与 chunk 数线性相关
+#   "HNSW32"            -> 图索引，无需训练，efSearch 越大召回越高
+#   "IVF{nlist},Flat"   -> 倒排索引，量化器在样本上训练，每次只扫描 nprobe 个簇
+#   "IVF{nlist},PQ32"   -> 倒排 + 乘积量化，内存最小，召回损失最大
+#   "SQ8"               -> int8 标量量化的暴力索引，内存约为 Flat 的 1/4
+#   "PCA128,SQ8"        -> 先 PCA 降到 128 维再量化，bge-small-zh（512 维）下约为 1/16
+# 有损索引可配合精排：先取 k * RESCORE_K_FACTOR 个候选，再用快照中以内存映射方式打开的 float32 原始向量
+# 重新计算精确距离。原始向量只占页缓存、不占进程堆内存，多个进程共享同一份。
+# {nlist} 按 chunk 数自动取值（约 4 * sqrt(n)）。检索参数 nprobe/efSearch 每次查询通过 SearchParameters 传入，
+# 与分类过滤的 IDSelector 合并在同一个参数对象里。
+
+
+def resolve_factory(factory, ntotal):
+    # 每个簇至少 39 个训练样本（FAISS 的下限），否则训练质量很差
+    nlist = max(1, min(int(4 * ntotal ** 0.5), ntotal // 39))
+    return factory.replace("{nlist}", str(nlist))
+
+
+def _ivf(index):
+    try:
+        return faiss.extract_index_ivf(index)
+    except RuntimeError:
+        return None
+
+
+def reconstruct(index, positions):
+    """按位置取回向量；倒排索引需要先建立 direct map。PQ 等有损编码取回的是近似向量。"""
+    ivf = _ivf(index)
+    if ivf is not None and ivf.direct_map.type == faiss.DirectMap.NoMap:
+        # 哈希表形式的 direct map 仍支持 add/remove_ids，数组形式不支持删除
+        ivf.set_direct_map_type(faiss.DirectMap.Hashtable)
+    return index.reconstruct_batch(np.asarray(positions, dtype=np.int64))
+
+
+def reconstruct_all(index, positions=None, block=65536):
+    # positions 默认为 0..ntotal-1；删除过 chunk 的倒排索引或 HNSW 应传入仍在使用的位置（index_to_docstore_id 的键）
+    positions = np.arange(index.ntotal) if positions is None else np.asarray(positions, dtype=np.int64)
+    for start in range(0, len(positions), block):
+        yield reconstruct(index, positions[start:start + block])
+
+
+def build(vectors_blocks, d, factory, ntotal, train_sample=ANN_TRAIN_SAMPLE, sample=None):
+    """按 factory 新建索引；需要训练时用 sample（或第一个分块）训练，然后按块依次写入。"""
+    index = faiss.index_factory(d, resolve_factory(factory, ntotal))
+    blocks = iter(vectors_blocks)
+    first = next(blocks, None)
+    if not index.is_trained:
+        train = first if sample is None else sample
+        index.train(np.ascontiguousarray(train[:train_sample], dtype=np.float32))
+    if first is not None:
+        index.add(np.ascontiguousarray(first, dtype=np.float32))
+    for vectors in blocks:
+        index.add(np.ascontiguousarray(vectors, dtype=np.float32))
+    return index
+
+
+def convert(index, factory=INDEX_FACTORY, train_sample=ANN_TRAIN_SAMPLE):
+    """把（暴力）索引转换为 factory 指定的类型，向量位置保持不变，index_to_docstore_id 无需改动。"""
+    if factory == "Flat" or index.ntotal == 0:
+        return index
+    rng = np.random.default_rng(0)
+    positions = np.sort(rng.choice(index.ntotal, size=min(train_sample, index.ntotal), replace=False))
+    try:
+        return build(reconstruct_all(index), index.d, factory, index.ntotal, train_sample, sample=reconstruct(index, positions))
+    except RuntimeError as e:
+        # 语料太小（如 PQ 需要至少 256 个训练样本）时保留暴力索引，小规模下它本来就足够快
+        print(f"[ann] 无法构建 {factory}，保留 Flat 索引：{e}")
+        return index
+
+
+def search_parameters(index, sel=None, nprobe=SEARCH_NPROBE, ef_search=SEARCH_EF_SEARCH):
+    """返回与索引类型匹配的 SearchParameters；暴力索引且无过滤时返回 None。
+
+    组合索引（PCA 预变换、精排）的参数对象引用内层参数对象，内层对象挂在外层的 _refs 上以免被提前回收。
+    """
+    index = faiss.downcast_index(index)
+    if isinstance(index, faiss.IndexPreTransform):
+        inner = search_parameters(index.index, sel, nprobe, ef_search)
+        params = faiss.SearchParametersPreTransform(index_params=inner) if inner is not None else None
+    elif isinstance(index, faiss.IndexRefine):
+        inner = search_parameters(index.base_index, sel, nprobe, ef_search)
+        params = faiss.IndexRefineSearchParameters(k_factor=index.k_factor, base_index_params=inner)
+    elif isinstance(index, faiss.IndexIVF):
+        inner = None
+        params = faiss.SearchParametersIVF(sel=sel, nprobe=nprobe)
+    elif isinstance(index, faiss.IndexHNSW):
+        inner = None
+        params = faiss.SearchParametersHNSW(sel=sel, efSearch=ef_search)
+    else:
+        inner = None
+        params = faiss.SearchParameters(sel=sel) if sel is not None else None
+    if params is not None:
+        params._refs = (inner, sel)
+    return params
+
+
+def _removal(index):
+    """删除 chunk 的方式，由索引类型决定：
+    "compact"   -> 顺序存储编码（Flat、SQ 等）：remove_ids 后其后的向量前移，位置保持连续（与 langchain FAISS.delete 的假设一致）
+    "remove"    -> 倒排索引：remove_ids 后其余向量的位置（标签）不变，index_to_docstore_id 出现空洞，
+                   空洞超过两成时把倒排表中的标签重新编号为连续（编码不变，见 _relabel）
+    "tombstone" -> HNSW 等不支持 remove_ids 的索引：只从 index_to_docstore_id 中去掉，向量留在图中作为墓碑，
+                   检索时由 IDSelector 排除（见 search.CategoryFilter），墓碑超过两成时用其余向量重建
+    """
+    index = faiss.downcast_index(index)
+    if isinstance(index, faiss.IndexPreTransform):
+        return _removal(index.index)
+    if isinstance(index, faiss.IndexFlatCodes):
+        return "compact"
+    if isinstance(index, faiss.IndexIVF):
+        return "remove"
+    return "tombstone"
+
+
+def plan_update(vector_db, ids, docs, vectors):
+    """准备一次增量更新：删除 chunk id 为 ids 的 chunk，再写入 docs（{id: Document}，与 vectors 一一对应）。
+
+    只读取 vector_db、不修改它，检索可以同时进行；与 chunk 总数成正比的工作（新的 index_to_docstore_id、
+    墓碑过多时重建 HNSW、空洞过多时重新编号倒排索引）都在这里完成，apply_update 在写锁内只做本次的增删与引用替换。返回的 plan：
+      removed    -> 被删除 chunk 的原位置
+      index      -> 墓碑或空洞超过两成时重建或重新编号的新索引（已写入新 chunk），None 表示沿用原索引
+      mapping    -> 更新后的 index_to_docstore_id
+      keep       -> 位置重新编号时，新位置 i 上是原位置 keep[i] 的向量（与位置对齐的精排向量据此重排）；None 表示位置不变
+      positions  -> 新 chunk 的位置
+      tombstones -> 更新后 HNSW 中墓碑的位置，检索时排除（见 search.CategoryFilter）；没有时为 None
+    """
+    index = vector_db.index
+    doomed = set(ids)
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32).reshape(len(docs), index.d)
+    removal = _removal(index)
+    removed = np.asarray(sorted(pos for pos, _id in vector_db.index_to_docstore_id.items() if _id in doomed), dtype=np.int64)
+    mapping = {pos: _id for pos, _id in vector_db.index_to_docstore_id.items() if _id not in doomed}
+    plan = {"ids": list(doomed), "docs": docs, "vectors": vectors, "removed": removed, "index": None, "keep": None,
+            "tombstones": None}
+    # 墓碑（HNSW）或标签空洞（倒排索引）占到两成以上时重新编号；空洞同样占着与位置对齐的精排向量的行
+    span = max(vector_db.index_to_docstore_id, default=-1) + 1 if removal == "remove" else index.ntotal
+    rebuild = removal != "compact" and len(removed) and len(mapping) < 0.8 * span
+    if (removal == "compact" or rebuild) and len(removed):
+        keep = np.asarray(sorted(mapping), dtype=np.int64)
+        if rebuild:
+            plan["index"] = (_relabel if removal == "remove" else _rebuild)(index, removed, keep, vectors)
+        mapping = {new: mapping[pos] for new, pos in enumerate(keep.tolist())}
+        plan["keep"] = keep
+    if removal == "remove":
+        start = max(mapping, default=-1) + 1
+    elif plan["keep"] is not None:
+        start = len(mapping)
+    else:
+        start = index.ntotal
+    positions = np.arange(start, start + len(vectors), dtype=np.int64)
+    mapping.update(zip(positions.tolist(), docs))
+    ntotal = start + len(vectors)
+    if removal == "tombstone" and len(mapping) < ntotal:
+        plan["tombstones"] = np.setdiff1d(np.arange(ntotal, dtype=np.int64), np.fromiter(mapping, dtype=np.int64))
+    plan.update(mapping=mapping, positions=positions)
+    return plan
+
+
+def apply_update(vector_db, plan):
+    """把 plan_update 准备好的更新落入 vector_db。与检索并发时需在写锁内调用。"""
+    if plan["index"] is not None:
+        vector_db.index = plan["index"]
+    else:
+        removal = _removal(vector_db.index)
+        if len(plan["removed"]) and removal != "tombstone":
+            # 顺序存储编码删除后其后的向量前移（与 keep 一致），倒排索引其余标签不变
+            vector_db.index.remove_ids(plan["removed"])
+        if len(plan["vectors"]) and removal == "remove":
+            vector_db.index.add_with_ids(plan["vectors"], plan["positions"])
+        elif len(plan["vectors"]):
+            vector_db.index.add(plan["vectors"])
+    if plan["ids"]:
+        vector_db.docstore.delete(plan["ids"])
+    if plan["docs"]:
+        vector_db.docstore.add(plan["docs"])
+    vector_db.index_to_docstore_id = plan["mapping"]
+
+
+def _rebuild(index, removed, keep, vectors):
+    """用位置 keep 上的向量与新向量重建同类型索引（沿用已训练的量化器），位置重新编号为连续。"""
+    rebuilt = faiss.clone_index(index)
+    rebuilt.reset()
+    for block in reconstruct_all(index, keep):
+        rebuilt.add(block)
+    if len(vectors):
+        rebuilt.add(vectors)
+    return rebuilt
+
+
+def _relabel(index, removed, keep, vectors):
+    """倒排索引的副本：删除 removed 后把标签 keep[i] 改为 i，再写入新向量。
+
+    只改倒排表中的标签，编码原样保留；PQ 等有损编码若按重建出的近似向量重新写入，可能落入别的簇、得到不同的编码。
+    """
+    relabeled = faiss.clone_index(index)
+    relabeled.remove_ids(removed)
+    ivf = faiss.extract_index_ivf(relabeled)
+    invlists = ivf.invlists
+    for list_no in range(ivf.nlist):
+        size = invlists.list_size(list_no)
+        if size:
+            ptr = invlists.get_ids(list_no)
+            ids = faiss.rev_swig_ptr(ptr, size)
+            ids[:] = np.searchsorted(keep, ids)
+            invlists.release_ids(list_no, ptr)
+    direct_map = ivf.direct_map.type
+    if direct_map != faiss.DirectMap.NoMap:
+        # direct map 记录的是旧标签，按新标签重建
+        ivf.set_direct_map_type(faiss.DirectMap.NoMap)
+        ivf.set_direct_map_type(direct_map)
+    if len(vectors):
+        relabeled.add_with_ids(vectors, np.arange(len(keep), len(keep) + len(vectors), dtype=np.int64))
+    return relabeled
+
+
+def add_chunks(vector_db, docs, vectors):
+    """全量构建时写入新 chunk（docs 为 {id: Document}，与 vectors 一一对应），返回它们的位置。增量同步见 plan_update。
+
+    删除后位置有空洞的倒排索引用 add_with_ids 接在最大位置之后；其余索引的新位置从 ntotal 开始（HNSW 的墓碑仍占着位置）。
+    """
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32).reshape(len(docs), -1)
+    index = vector_db.index
+    mapping = vector_db.index_to_docstore_id
+    start = max(mapping, default=-1) + 1 if _removal(index) == "remove" else index.ntotal
+    positions = np.arange(start, start + len(vectors), dtype=np.int64)
+    if _removal(index) == "remove":
+        index.add_with_ids(vectors, positions)
+    else:
+        index.add(vectors)
+    vector_db.docstore.add(docs)
+    mapping.update(zip(positions.tolist(), docs))
+    return positions
+
+
+def place_rows(float_vectors, positions, vectors):
+    """在与位置对齐的原始向量中写入新 chunk 的行。返回新数组：原数组可能是快照的只读内存映射。"""
+    size = max(len(float_vectors), int(positions.max()) + 1) if len(positions) else len(float_vectors)
+    rows = np.empty((size, float_vectors.shape[1]), dtype=np.float32)
+    rows[:len(float_vectors)] = float_vectors
+    rows[positions] = np.asarray(vectors, dtype=np.float32).reshape(len(positions), -1)
+    return rows
+
+
+def index_bytes(index):
+    return faiss.serialize_index(index).nbytes
+
+
+def flat_vectors(index):
+    # 暴力索引的原始向量（转换之前取出，用于精排）
+    return faiss.rev_swig_ptr(index.get_xb(), index.ntotal * index.d).reshape(index.ntotal, index.d).copy()
+
+
+def is_lossy(index):
+    """索引保存的是否为近似向量：标量/乘积量化（SQ、PQ）与降维（PCA）是有损的，Flat、IVF,Flat、HNSW（Flat 存储）不是。"""
+    index = faiss.downcast_index(index)
+    if isinstance(index, faiss.IndexPreTransform):
+        chain = [faiss.downcast_VectorTransform(index.chain.at(i)) for i in range(index.chain.size())]
+        return any(t.d_out < t.d_in for t in chain) or is_lossy(index.index)
+    if isinstance(index, faiss.IndexHNSW):
+        return is_lossy(index.storage)
+    if isinstance(index, faiss.IndexRefine):
+        return is_lossy(index.refine_index)
+    if isinstance(index, faiss.IndexIVF):
+        return not isinstance(index, faiss.IndexIVFFlat)
+    return not isinstance(index, faiss.IndexFlat)
+
+
+def wants_rescore(index, k_factor=RESCORE_K_FACTOR):
+    # 无损索引的距离本身就是精确的，精排只会多占一份原始向量
+    return k_factor > 0 and is_lossy(index)
+
+
+def rescore(float_vectors, query, indices, k):
+    """用 float32 原始向量对候选位置重新计算 L2 距离，返回距离最小的 k 个 (scores, indices)。"""
+    indices = np.sort(indices[indices >= 0])
+    # 按位置顺序读取，内存映射文件上接近顺序访问
+    candidates = np.asarray(float_vectors[indices], dtype=np.float32)
+    scores = ((candidates - query) ** 2).sum(axis=1)
+    top = np.argsort(scores)[:k]
+    return scores[top], indices[top]
+
+
+# --- 调参：在留出查询集上测量 recall@k 与延迟 ---
+
+def _sweep_values(index):
+    index = faiss.downcast_index(index)
+    if isinstance(index, (faiss.IndexPreTransform, faiss.IndexRefine)):
+        return _sweep_values(index.index if isinstance(index, faiss.IndexPreTransform) else index.base_index)
+    if isinstance(index, faiss.IndexIVF):
+        return "nprobe", [v for v in (1, 2, 4, 8, 16, 32, 64, 128) if v <= index.nlist]
+    if isinstance(index, faiss.IndexHNSW):
+        return "efSearch", [16, 32, 64, 128, 256]
+    return None, [None]
+
+
+def _measure(index, queries, truth, k, params, float_vectors=None, k_factor=0):
+    found = np.full((len(queries), k), -1, dtype=np.int64)
+    latencies = []
+    fetch = k * k_factor if float_vectors is not None else k
+    # 逐条查询，与线上一次一个问题的负载一致
+    for i, query in enumerate(queries):
+        start = time.perf_counter()
+        indices = index.search(query[None, :], fetch, params=params)[1][0]
+        if float_vectors is not None:
+            indices = rescore(float_vectors, query, indices, k)[1]
+        found[i, :len(indices)] = indices
+        latencies.append(time.perf_counter() - start)
+    hits = sum(len(set(f) & set(t)) for f, t in zip(found, truth))
+    latencies = np.asarray(latencies) * 1000
+    return hits / truth.size, float(np.mean(latencies)), float(np.percentile(latencies, 95))
+
+
+def tune(vectors, factories, holdout=200, k=5, queries=None, seed=0, k_factor=0):
+    """留出 holdout 条 chunk 向量作查询（或使用给定 queries），以暴力检索结果为真值，
+    对每种 factory 扫描 nprobe/efSearch，返回 [{factory, param, value, rescore, recall, ms, p95_ms, bytes, ratio}]。
+
+    k_factor > 0 时有损索引额外测一遍精排后的结果；ratio 为 Flat 索引大小 / 该索引大小。
+    """
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    if queries is None:
+        rng = np.random.default_rng(seed)
+        held = rng.choice(len(vectors), size=min(holdout, len(vectors) // 10 or 1), replace=False)
+        mask = np.ones(len(vectors), dtype=bool)
+        mask[held] = False
+        queries, vectors = vectors[held], vectors[mask]
+    queries = np.ascontiguousarray(queries, dtype=np.float32)
+
+    exact = faiss.IndexFlatL2(vectors.shape[1])
+    exact.add(vectors)
+    _, truth = exact.search(queries, k)
+    flat_bytes = index_bytes(exact)
+
+    results = []
+    for factory in ["Flat"] + [f for f in factories if f != "Flat"]:
+        start = time.time()
+        try:
+            index = exact if factory == "Flat" else build([vectors], vectors.shape[1], factory, len(vectors))
+        except RuntimeError as e:
+            print(f"[tune] 跳过 {factory}：{e}")
+            continue
+        build_s = time.time() - start
+        size = index_bytes(index)
+        name, values = _sweep_values(index)
+        modes = [0, k_factor] if k_factor and wants_rescore(index, k_factor) else [0]
+        for value in values:
+            kwargs = {"nprobe": value} if name == "nprobe" else {"ef_search": value} if name == "efSearch" else {}
+            params = search_parameters(index, **kwargs)
+            for factor in modes:
+                recall, ms, p95 = _measure(index, queries, truth, k, params, vectors if factor else None, factor)
+                row = {"factory": resolve_factory(factory, len(vectors)), "param": name, "value": value, "rescore": factor,
+                       f"recall@{k}": round(recall, 4), "ms": round(ms, 3), "p95_ms": round(p95, 3),
+                       "bytes": size, "ratio": round(flat_bytes / size, 2), "build_s": round(build_s, 2)}
+                results.append(row)
+                print(f"[tune] {row['factory']:<20} {name or '-'}={value if value is not None else '-':<5} "
+                      f"rescore={factor or '-':<3} recall@{k}={recall:.4f}  {ms:.3f} ms (p95 {p95:.3f})  "
+                      f"{size / 2**20:.1f} MiB ({row['ratio']}x)")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="在当前快照的 chunk 向量上比较不同 ANN 索引的 recall@k 与查询延迟")
+    parser.add_argument("--index", default=INDEX_DIR)
+    parser.add_argument("--factory", action="append", help="可重复，如 --factory HNSW32 --factory 'IVF{nlist},Flat'")
+    parser.add_argument("--holdout", type=int, default=200, help="留出作为查询的 chunk 数")
+    parser.add_argument("--queries", help="可选：每行一个问题的文本文件，嵌入后作为查询集")
+    parser.add_argument("-k", type=int, default=5)
+    parser.add_argument("--rescore", type=int, default=RESCORE_K_FACTOR, help="精排候选倍数，0 表示不测精排")
+    parser.add_argument("--out", help="把结果写成 JSON")
+    args = parser.parse_args()
+
+    import index_store
+    from embedder import make_embeddings
+
+    snapshot_dir = index_store.current_snapshot_dir(args.index)
+    if snapshot_dir is None:
+        raise SystemExit(f"{args.index} 下没有快照，请先运行 python ingest.py")
+    embeddings = make_embeddings()
+    vector_db = index_store.load_snapshot(snapshot_dir, embeddings, mmap=False)
+    # 非暴力快照取回的向量可能是近似值（如 PQ），此时的真值也只是近似
+    vectors = np.vstack(list(reconstruct_all(vector_db.index, sorted(vector_db.index_to_docstore_id))))
+    queries = None
+    if args.queries:
+        with open(args.queries, encoding="utf-8") as f:
+            queries = np.asarray([embeddings.embed_query(line.strip()) for line in f if line.strip()], dtype=np.float32)
+    factories = args.factory or ["HNSW32", "IVF{nlist},Flat", "IVF{nlist},PQ32", "SQ8", "PCA128,SQ8"]
+    results = tune(vectors, factories, args.holdout, args.k, queries, k_factor=args.rescore)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,15 @@
+import html
 import os
 # --- 1. 配置镜像源 ---
 os.environ['HF_ENDPOINT'] = 'https://hf-mirror.com'
 
 import streamlit as st
 import time
-from langchain_community.vectorstores import FAISS
-from langchain_huggingface import HuggingFaceEmbeddings
-from langchain_community.document_loaders import DirectoryLoader, TextLoader
-from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+from categorizer import DISPLAY_CATEGORIES
+from config import DOCS_DIR, INDEX_DIR, SYNC_INTERVAL, SEARCH_MODE, SERVICE_URL, ALL_CATEGORIES, SEARCH_MODES
+from metrics import REGISTRY
+from serving import Overloaded
 
 # --- 2. 页面设置 ---
 st.set_page_config(
@@ -153,51 +155,23 @@ st.markdown("""
 # --- 4. 核心逻辑 ---
 @st.cache_resource
 def initialize_system():
-    embeddings = HuggingFaceEmbeddings(model_name="BAAI/bge-small-zh-v1.5")
-    
-    if not os.path.exists('docs/'):
-        os.makedirs('docs/')
-    
-    loader = DirectoryLoader('docs/', glob="**/*.txt", loader_cls=TextLoader, loader_kwargs={'encoding': 'utf-8'})
-    raw_docs = loader.load()
-    
-    if not raw_docs:
-        return None, None, []
+    # 配置了检索服务时只做瘦客户端，模型与索引都在 service.py 进程中
+    if SERVICE_URL:
+        from client import ServiceClient
 
-    categorized_docs = []
-    # 关键词定义
-    ai_keywords = ['learning', 'neural', 'intelligence', 'gpt', 'python', 'data', 'cloud']
-    fintech_keywords = ['blockchain', 'bitcoin', 'payment', 'finance', 'wallet', 'economy', 'bank']
-    humanities_keywords = ['history', 'culture', 'art', 'philosophy', 'literature', 'civilization', 'museum']
-    
-    for doc in raw_docs:
-        filename = doc.metadata['source'].lower()
-        content = doc.page_content.lower()
-        category = "General / Uncategorized"
-        
-        if any(k in filename or k in content for k in ai_keywords):
-            category = "AI & Technology"
-        elif any(k in filename or k in content for k in fintech_keywords):
-            category = "FinTech & Economy"
-        elif any(k in filename or k in content for k in humanities_keywords):
-            category = "Humanities & History"
-            
-        doc.metadata['category'] = category
-        categorized_docs.append(doc)
+        return ServiceClient(SERVICE_URL), DISPLAY_CATEGORIES
 
-    # 【修改点】：这里移除了 "General / Uncategorized" 
-    # 注意：如果文件被归类为 General，它在 "ALL ARCHIVES" 中仍可见，但侧边栏没有单独入口，符合您的要求
-    display_categories = ["AI & Technology", "FinTech & Economy", "Humanities & History"]
-    
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=300, chunk_overlap=50)
-    splits = text_splitter.split_documents(categorized_docs)
-    vector_db = FAISS.from_documents(splits, embeddings)
-    
-    return vector_db, raw_docs, display_categories
+    from serving import ServingPool, embed_threads
+    from warmup import WarmupIndex
+
+    # 立即返回：快照载入与模型加载在后台线程进行，页面先渲染出来；
+    # 快照就绪后即可检索（模型就绪前以关键词检索代替），之后后台线程定期增量同步 docs/ 的变更。
+    # 所有会话共享这一份索引与模型，检索经 ServingPool 限制并发与线程数（见 serving.py）
+    return WarmupIndex(DOCS_DIR, INDEX_DIR, SYNC_INTERVAL, pool=ServingPool(), embed_threads=embed_threads()), DISPLAY_CATEGORIES
 
 # --- 5. 初始化 ---
 with st.spinner("Initializing System..."):
-    vector_db, raw_docs, category_list = initialize_system()
+    live, category_list = initialize_system()
 
 # --- 6. 侧边栏 (重构版) ---
 with st.sidebar:
@@ -215,20 +189,25 @@ with st.sidebar:
     
     # 解析回原始分类名
     if "ALL ARCHIVES" in selected_option:
-        selected_category = "ALL ARCHIVES"
+        selected_category = ALL_CATEGORIES
     else:
         # 去掉图标前缀 "🏷️  " (长度为4)
         selected_category = selected_option[2:]
 
     st.markdown("---")
+
+    # 检索模式：关键词模式直接查倒排索引，不运行嵌入模型
+    search_mode = st.selectbox("Search Mode", SEARCH_MODES, index=SEARCH_MODES.index(SEARCH_MODE))
     
     # 统计数据卡片化
     col1, col2 = st.columns(2)
     
-    total_count = len(raw_docs) if raw_docs else 0
+    # live 为本地 LiveIndex 或远程 ServiceClient，两者的 stats/search/read_text 接口一致
+    stats = live.stats()
+    total_count = stats["docs"]
     current_count = "All"
-    if selected_category != "ALL ARCHIVES" and raw_docs:
-        current_count = sum(1 for d in raw_docs if d.metadata.get('category') == selected_category)
+    if selected_category != ALL_CATEGORIES and total_count:
+        current_count = stats["categories"].get(selected_category, 0)
 
     with col1:
         st.markdown(f"""
@@ -247,6 +226,44 @@ with st.sidebar:
         """, unsafe_allow_html=True)
 
     st.markdown("<br>", unsafe_allow_html=True)
+    query_stats = stats["cache"]["query_embedding"]
+    result_stats = stats["cache"]["results"]
+    st.caption(
+        f"Cache hit rate · query {query_stats['hit_rate'] if query_stats else 0:.0%}"
+        f" · results {result_stats['hit_rate'] if result_stats else 0:.0%}"
+    )
+    if stats.get("snapshot"):
+        st.caption(f"Index version · {stats['snapshot']}")
+    if stats.get("shards"):
+        ready_shards = sum(1 for shard in stats["shards"].values() if shard["ready"])
+        st.caption(f"Shards · {ready_shards}/{len(stats['shards'])} ready")
+    # 并发检索：执行中 / 工作线程数，以及排队数
+    serving = stats.get("serving")
+    if serving:
+        st.caption(f"Serving · {serving['active']}/{serving['workers']} active · {serving['queued']} queued")
+    # 预热进度（本地后台载入，或远程服务的 /stats）
+    warmup = stats.get("warmup")
+    if warmup and warmup["stage"] != "ready":
+        st.caption(f"Warming up · {warmup['stage']} · index {'✓' if warmup['index_ready'] else '…'}"
+                   f" · model {'✓' if warmup['model_ready'] else '…'} · {warmup['seconds']:.0f}s")
+        if warmup["error"]:
+            st.error(warmup["error"])
+
+    # 诊断：各阶段耗时直方图、计数器，以及运行时剖析（本地索引或远程服务均可）
+    with st.expander("Diagnostics"):
+        profile_mode = st.selectbox("Profiler", ["cpu", "memory"])
+        start_col, stop_col = st.columns(2)
+        if start_col.button("Start", use_container_width=True):
+            try:
+                live.start_profile(profile_mode)
+            except Exception as e:
+                st.warning(str(e))
+        if stop_col.button("Stop", use_container_width=True):
+            st.session_state["profile_report"] = live.stop_profile()
+        if st.session_state.get("profile_report"):
+            st.code(st.session_state["profile_report"], language=None)
+        if st.checkbox("Show metrics"):
+            st.json(live.metrics(), expanded=False)
     st.caption("System v3.0 | Azure Theme")
 
 # --- 7. 主界面 ---
@@ -262,32 +279,33 @@ with search_col2:
 st.markdown("---")
 
 # --- 8. 检索与结果展示 ---
-if (query or search_btn) and vector_db:
+if (query or search_btn) and stats["ready"]:
     start_time = time.time()
-    results = vector_db.similarity_search(query, k=15)
-    
-    if selected_category != "ALL ARCHIVES":
-        filtered_results = [doc for doc in results if doc.metadata.get('category') == selected_category]
-    else:
-        filtered_results = results
-
-    final_results = filtered_results[:5]
+    # 查询向量与检索结果都有缓存：rerun、切换侧边栏分类时相同的查询不会重新嵌入和检索；
+    # 分类过滤在 FAISS 与倒排索引内部完成，不再先取 15 条再事后丢弃
+    with REGISTRY.trace() as stages:
+        try:
+            hits = live.search(query, selected_category, k=5, mode=search_mode)
+        except Overloaded:
+            # 排队已满或等待超时：直接提示，而不是让所有会话一起变慢
+            st.warning("当前检索请求较多，请稍后重试。")
+            st.stop()
+    final_results = [doc for doc, _ in hits]
 
     if not final_results:
         st.info(f"未在 【{selected_category}】 中找到相关内容。")
     else:
         st.markdown(f"**找到 {len(final_results)} 条相关记录** (用时 {time.time() - start_time:.4f}s)")
-        
-        for doc in final_results:
+        if search_mode != "lexical" and not stats.get("model_ready", True):
+            st.caption("嵌入模型加载中，当前为关键词检索结果")
+        # 耗时构成：模型（embed）、FAISS、精排、关键词、融合；结果缓存命中时没有任何阶段
+        st.caption(" · ".join(f"{stage} {seconds * 1000:.1f}ms" for stage, seconds in stages.items()) or "cached")
+
+        render_start = time.perf_counter()
+        for rank, doc in enumerate(final_results):
             cat_tag = doc.metadata.get('category')
             file_name = doc.metadata['source'].split('/')[-1]
-            full_file_path = doc.metadata['source']
-            
-            full_content = "未找到全文内容"
-            for raw_doc in raw_docs:
-                if raw_doc.metadata['source'] == full_file_path:
-                    full_content = raw_doc.page_content
-                    break
+            doc_id = doc.metadata['doc_id']
 
             st.markdown(f"""
             <div class="result-item">
@@ -302,10 +320,31 @@ if (query or search_btn) and vector_db:
             </div>
             """, unsafe_allow_html=True)
             
-            with st.expander("📖 查看完整文档"):
-                st.markdown(full_content)
+            # 全文按需读取：只有展开时才从磁盘加载；命中的 chunk 按其在原文中的区间高亮
+            if st.toggle("📖 查看完整文档", key=f"full-{rank}-{doc_id}"):
+                full_content = live.read_text(doc_id)
+                start, end = doc.metadata.get('start'), doc.metadata.get('end')
+                with st.container(border=True):
+                    if full_content is None:
+                        st.markdown("未找到全文内容")
+                    elif start is None or end is None:
+                        st.markdown(full_content)
+                    else:
+                        st.markdown(
+                            f"<div style='white-space:pre-wrap;'>{html.escape(full_content[:start])}"
+                            f"<mark>{html.escape(full_content[start:end])}</mark>{html.escape(full_content[end:])}</div>",
+                            unsafe_allow_html=True,
+                        )
+        REGISTRY.observe("query_stage_seconds", time.perf_counter() - render_start, stage="render")
 
-elif not vector_db:
+elif not stats["ready"] and warmup and not warmup["index_ready"] and not warmup["error"]:
+    st.info("正在后台载入索引与模型，页面会自动刷新……")
+elif not stats["ready"]:
     st.info("请在 docs/ 目录下放入 .txt 文件后启动系统。")
 elif not query:
-    st.info("💡 在上方搜索框输入关键词开启检索。")
\ No newline at end of file
+    st.info("💡 在上方搜索框输入关键词开启检索。")
+
+# 预热期间定时刷新，就绪状态与检索模式随之更新
+if warmup and warmup["stage"] not in ("ready", "failed") and not warmup["error"]:
+    time.sleep(2)
+    st.rerun()
\ No newline at end of file
@@ -0,0 +1,161 @@
+import argparse
+import json
+import sys
+import time
+
+from config import DOCS_DIR, INDEX_DIR, ALL_CATEGORIES, SEARCH_MODE, SEARCH_MODES, EMBED_WORKERS
+
+# --- 离线批量查询 ---
+# 输入 JSONL，每行一个查询：{"query": "...", "category"?: "...", "k"?: 5, "mode"?: "hybrid", "id"?: ...}
+# （也可以每行直接是一个 JSON 字符串）。category 的含义与 app 侧边栏相同，缺省为 "ALL ARCHIVES"。
+# 查询按 --batch-size 条一组：整组一次性嵌入，同一 (分类, k, 模式) 的查询合并为一次矩阵检索，
+# 结果逐组写出为 JSONL，或在输出文件以 .parquet 结尾时写成 Parquet（每个命中一行，需要 pyarrow）。
+# 默认只读载入 app 使用的同一份快照，不改动索引；--sync 时先把 docs/ 的变更同步进快照。
+
+
+def iter_requests(lines, default_category=ALL_CATEGORIES, default_k=5, default_mode=SEARCH_MODE):
+    for line_no, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        record = json.loads(line)
+        if isinstance(record, str):
+            record = {"query": record}
+        mode = record.get("mode", default_mode)
+        if mode not in SEARCH_MODES:
+            raise ValueError(f"line {line_no}: unknown mode {mode!r}")
+        yield {
+            "id": record.get("id", line_no),
+            "query": record["query"],
+            "category": record.get("category") or default_category,
+            "k": int(record.get("k", default_k)),
+            "mode": mode,
+        }
+
+
+def iter_batches(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class JsonlWriter:
+    def __init__(self, path, with_content=True):
+        self.file = sys.stdout if path == "-" else open(path, "w", encoding="utf-8")
+        self.with_content = with_content
+
+    def write(self, request, hits):
+        rows = []
+        for rank, hit in enumerate(hits, 1):
+            if not self.with_content:
+                hit.pop("content")
+            rows.append(dict(hit, rank=rank))
+        self.file.write(json.dumps(dict(request, hits=rows), ensure_ascii=False) + "\n")
+
+    def close(self):
+        if self.file is not sys.stdout:
+            self.file.close()
+
+
+class ParquetWriter:
+    """每个命中一行：id, query, category, mode, rank, source, doc_id, hit_category, score[, content]。"""
+
+    def __init__(self, path, with_content=True):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise SystemExit("写 Parquet 需要安装 pyarrow：pip install pyarrow")
+        self.pa = pa
+        self.with_content = with_content
+        fields = [
+            ("id", pa.string()), ("query", pa.string()), ("category", pa.string()), ("mode", pa.string()),
+            ("rank", pa.int32()), ("source", pa.string()), ("doc_id", pa.int64()), ("hit_category", pa.string()),
+            ("score", pa.float64()),
+        ]
+        if with_content:
+            fields.append(("content", pa.string()))
+        self.schema = pa.schema(fields)
+        self.writer = pq.ParquetWriter(path, self.schema)
+        self.columns = {name: [] for name in self.schema.names}
+
+    def write(self, request, hits):
+        for rank, hit in enumerate(hits, 1):
+            row = {
+                "id": str(request["id"]), "query": request["query"], "category": request["category"], "mode": request["mode"],
+                "rank": rank, "source": hit["source"], "doc_id": hit["doc_id"], "hit_category": hit["category"],
+                "score": hit["score"], "content": hit["content"],
+            }
+            for name, values in self.columns.items():
+                values.append(row[name])
+
+    def flush(self):
+        if self.columns["id"]:
+            self.writer.write_table(self.pa.table(self.columns, schema=self.schema))
+            self.columns = {name: [] for name in self.schema.names}
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
+def run(live, requests, writer, batch_size=4096):
+    """逐组检索并写出，返回 (查询数, 耗时秒)。"""
+    from search import hit_to_json
+
+    start = time.time()
+    total = 0
+    for batch in iter_batches(requests, batch_size):
+        results = live.search_many([(r["query"], r["category"], r["k"], r["mode"]) for r in batch])
+        for request, hits in zip(batch, results):
+            writer.write(request, [hit_to_json(doc, score) for doc, score in hits])
+        if hasattr(writer, "flush"):
+            writer.flush()
+        total += len(batch)
+        elapsed = time.time() - start
+        print(f"[batch] {total} queries, {total / max(elapsed, 1e-9):.0f} q/s", file=sys.stderr)
+    return total, time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="从 JSONL 读取查询，批量检索并把结果写成 JSONL 或 Parquet")
+    parser.add_argument("input", help="查询文件（JSONL），- 表示标准输入")
+    parser.add_argument("-o", "--output", default="-", help="输出文件，.parquet 结尾时写 Parquet；默认标准输出（JSONL）")
+    parser.add_argument("--docs", default=DOCS_DIR)
+    parser.add_argument("--index", default=INDEX_DIR)
+    parser.add_argument("--category", default=ALL_CATEGORIES, help="查询未指定 category 时使用的分类")
+    parser.add_argument("-k", type=int, default=5)
+    parser.add_argument("--mode", choices=SEARCH_MODES, default=SEARCH_MODE)
+    parser.add_argument("--batch-size", type=int, default=4096, help="每组查询数：一组一次嵌入、一次矩阵检索、一次写出")
+    parser.add_argument("--workers", type=int, default=EMBED_WORKERS)
+    parser.add_argument("--no-content", action="store_true", help="输出中不包含 chunk 正文")
+    parser.add_argument("--sync", action="store_true", help="先把 docs/ 的变更同步进快照（默认只读使用现有快照）")
+    args = parser.parse_args()
+
+    from embedder import make_embeddings
+    from ingest import open_live_index, open_snapshot
+
+    embeddings = make_embeddings(workers=args.workers)
+    live = open_live_index(args.docs, args.index, embeddings) if args.sync else open_snapshot(args.docs, args.index, embeddings)
+    if live is None or not live.ready:
+        raise SystemExit(f"{args.index} 下没有可用的快照，请先运行 python ingest.py")
+
+    source = sys.stdin if args.input == "-" else open(args.input, encoding="utf-8")
+    writer_cls = ParquetWriter if args.output.endswith(".parquet") else JsonlWriter
+    writer = writer_cls(args.output, with_content=not args.no_content)
+    try:
+        total, elapsed = run(live, iter_requests(source, args.category, args.k, args.mode), writer, args.batch_size)
+    finally:
+        writer.close()
+        if source is not sys.stdin:
+            source.close()
+    print(f"[batch] done: {total} queries in {elapsed:.1f}s ({total / max(elapsed, 1e-9):.0f} q/s)", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,246 @@
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+import config
+from config import ALL_CATEGORIES, EMBEDDING_ID, EMBEDDING_MODEL, CHUNK_SIZE, CHUNK_OVERLAP, EMBED_BATCH_SIZE, EMBED_WORKERS, INDEX_FACTORY
+
+# --- 端到端基准测试 ---
+# 对一份语料（通常由 synth_corpus.py 生成）从零构建索引，记录：
+#   - 构建各阶段耗时：scan（摘要）、load、categorize、dedup、split、embed、index、lexical、save
+#   - 各检索模式的单条查询延迟 p50/p95/p99（查询向量嵌入单独计时）
+#   - 近似索引相对暴力检索的 recall@k、峰值 RSS、分类准确率（语料带 labels.jsonl 时）
+# 结果写成 JSON；--compare 指定上一版本的结果文件时，比较耗时与召回，退步超过 --tolerance 则以非零状态退出。
+
+
+def peak_rss_mb():
+    # Linux 上 ru_maxrss 单位为 KB，macOS 上为字节
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024 if sys.platform != "darwin" else rss / 2**20
+
+
+def percentiles(samples_ms):
+    if not samples_ms:
+        return None
+    values = np.asarray(samples_ms)
+    return {
+        "p50": round(float(np.percentile(values, 50)), 3),
+        "p95": round(float(np.percentile(values, 95)), 3),
+        "p99": round(float(np.percentile(values, 99)), 3),
+        "mean": round(float(values.mean()), 3),
+        "n": len(samples_ms),
+    }
+
+
+def git_revision():
+    try:
+        repo = os.path.dirname(os.path.abspath(__file__))
+        return subprocess.run(["git", "-C", repo, "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def make_benchmark_embeddings(kind, workers, batch_size):
+    # 不经过 SQLite 嵌入缓存，保证每次运行测到的是真实的嵌入耗时
+    from embedder import BatchedEmbeddings
+
+    if kind == "fake":
+        from langchain_core.embeddings import DeterministicFakeEmbedding
+
+        base = DeterministicFakeEmbedding(size=512)
+    else:
+        from embedder import load_model
+
+        # 按 config.EMBED_BACKEND 加载（torch 或 ONNX），便于比较两种后端的导入吞吐
+        base = load_model()
+    return BatchedEmbeddings(base, batch_size, workers, "thread", EMBEDDING_MODEL)
+
+
+def sample_queries(live, n, seed=0):
+    """从已入库的 chunk 中抽取片段作为查询：一半取前 30 个字符，一半取其中的英文词。"""
+    rng = random.Random(seed)
+    ids = list(live.vector_db.index_to_docstore_id.values())
+    queries = []
+    for _id in rng.sample(ids, min(n, len(ids))):
+        text = live.vector_db.docstore.search(_id).page_content
+        words = [w for w in text.split() if w.isascii() and w.isalpha() and len(w) > 3]
+        if words and rng.random() < 0.5:
+            queries.append(rng.choice(words))
+        else:
+            start = rng.randrange(max(1, len(text) - 30))
+            queries.append(text[start:start + 30])
+    return queries
+
+
+def measure_queries(live, queries, k=5):
+    """逐条计时：嵌入、各检索模式（不含嵌入）以及带嵌入的端到端延迟。结果缓存不参与。"""
+    from search import hybrid_search
+
+    timings = {"embed": [], "dense": [], "lexical": [], "hybrid": []}
+    vectors = []
+    for query in queries:
+        start = time.perf_counter()
+        vectors.append(live.embeddings.embed_query(query))
+        timings["embed"].append((time.perf_counter() - start) * 1000)
+    with live.lock.read():
+        for mode in ("dense", "lexical", "hybrid"):
+            for query, vector in zip(queries, vectors):
+                start = time.perf_counter()
+                hybrid_search(live.vector_db, live.category_filter, live.lexical, query, vector, ALL_CATEGORIES, k, mode=mode,
+                              float_vectors=live.float_vectors)
+                timings[mode].append((time.perf_counter() - start) * 1000)
+    report = {name: percentiles(samples) for name, samples in timings.items()}
+    report["end_to_end_hybrid"] = percentiles([e + h for e, h in zip(timings["embed"], timings["hybrid"])])
+    return report, np.asarray(vectors, dtype=np.float32)
+
+
+def measure_recall(live, vectors, k=5):
+    """当前索引（含精排）相对暴力检索的 recall@k。原始向量优先取自精排用的 float 向量。"""
+    import faiss
+
+    import ann_index
+
+    index = live.vector_db.index
+    exact_vectors = live.float_vectors if live.float_vectors is not None else np.vstack(list(ann_index.reconstruct_all(index)))
+    exact = faiss.IndexFlatL2(index.d)
+    exact.add(np.ascontiguousarray(exact_vectors, dtype=np.float32))
+    _, truth = exact.search(vectors, k)
+    rescore = live.float_vectors is not None and config.RESCORE_K_FACTOR > 0
+    fetch = k * config.RESCORE_K_FACTOR if rescore else k
+    _, found = index.search(vectors, fetch, params=ann_index.search_parameters(index))
+    hits = 0
+    for query, row, expected in zip(vectors, found, truth):
+        if rescore:
+            row = ann_index.rescore(live.float_vectors, query, row, k)[1]
+        hits += len(set(row[:k]) & set(expected))
+    return hits / truth.size
+
+
+def category_accuracy(live, labels_path):
+    if not os.path.exists(labels_path):
+        return None
+    correct = total = 0
+    with open(labels_path, encoding="utf-8") as f:
+        for line in f:
+            label = json.loads(line)
+            entry = live.manifest['files'].get(label["source"])
+            if entry is not None:
+                total += 1
+                correct += entry["category"] == label["category"]
+    return round(correct / total, 4) if total else None
+
+
+def run(docs_dir, index_dir, embedder="model", workers=EMBED_WORKERS, batch_size=EMBED_BATCH_SIZE, n_queries=500, k=5):
+    import index_store
+    from ingest import build_index, categorizer_signature
+    from metrics import StageTimer
+
+    shutil.rmtree(index_dir, ignore_errors=True)
+    embeddings = make_benchmark_embeddings(embedder, workers, batch_size)
+    timer = StageTimer()
+    rss = {"start": round(peak_rss_mb(), 1)}
+
+    start = time.time()
+    with timer("scan"):
+        manifest = index_store.build_manifest(docs_dir, EMBEDDING_ID, CHUNK_SIZE, CHUNK_OVERLAP)
+    manifest['categorizer'] = categorizer_signature()
+    manifest['index_factory'] = INDEX_FACTORY
+    manifest['dedup'] = config.DEDUP_THRESHOLD
+    live = build_index(docs_dir, index_dir, embeddings, manifest, timer=timer)
+    build_seconds = time.time() - start
+    rss["after_build"] = round(peak_rss_mb(), 1)
+
+    chunks = len(live.vector_db.index_to_docstore_id) if live.vector_db is not None else 0
+    result = {
+        "meta": {
+            "revision": git_revision(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+            "embedder": embedder,
+            "embedding": EMBEDDING_ID if embedder == "model" else "fake",
+            "index_factory": INDEX_FACTORY,
+            "workers": workers,
+            "batch_size": batch_size,
+        },
+        "corpus": {"docs": len(live.doc_store), "chunks": chunks, "bytes": sum(e["size"] for e in manifest['files'].values())},
+        "build": {
+            "seconds": round(build_seconds, 3),
+            "docs_per_s": round(len(live.doc_store) / max(build_seconds, 1e-9), 1),
+            "chunks_per_s": round(chunks / max(build_seconds, 1e-9), 1),
+            "stages": timer.report(),
+        },
+        "category_accuracy": category_accuracy(live, os.path.join(docs_dir, "labels.jsonl")),
+    }
+    if chunks:
+        queries = sample_queries(live, n_queries)
+        result["query_ms"], vectors = measure_queries(live, queries, k)
+        result[f"recall@{k}"] = round(measure_recall(live, vectors, k), 4)
+    rss["peak"] = round(peak_rss_mb(), 1)
+    result["rss_mb"] = rss
+    return result
+
+
+def compare(current, baseline, tolerance):
+    """返回退步项列表：耗时类指标增长超过 tolerance，或召回下降超过 0.01。"""
+    regressions = []
+
+    def check(name, new, old, higher_is_worse=True):
+        if new is None or old is None or not old:
+            return
+        change = (new - old) / old
+        if (change if higher_is_worse else -change) > tolerance:
+            regressions.append(f"{name}: {old} -> {new} ({change:+.0%})")
+
+    check("build.seconds", current["build"]["seconds"], baseline["build"]["seconds"])
+    for mode, stats in current.get("query_ms", {}).items():
+        old = baseline.get("query_ms", {}).get(mode)
+        if stats and old:
+            check(f"query_ms.{mode}.p95", stats["p95"], old["p95"])
+    check("rss_mb.peak", current["rss_mb"]["peak"], baseline["rss_mb"]["peak"])
+    for key in current:
+        if key.startswith("recall@") and key in baseline and current[key] < baseline[key] - 0.01:
+            regressions.append(f"{key}: {baseline[key]} -> {current[key]}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="从零构建索引并测量各阶段耗时、查询延迟、召回与内存")
+    parser.add_argument("docs", help="语料目录，如 python synth_corpus.py bench_docs -n 100000 生成的目录")
+    parser.add_argument("--index", default="bench_index/", help="基准测试专用的索引目录（每次运行会清空）")
+    parser.add_argument("--embedder", choices=["model", "fake"], default="model", help="fake 使用确定性哈希向量，只测管线本身")
+    parser.add_argument("--workers", type=int, default=EMBED_WORKERS)
+    parser.add_argument("--batch-size", type=int, default=EMBED_BATCH_SIZE)
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("-k", type=int, default=5)
+    parser.add_argument("-o", "--out", default="benchmark.json")
+    parser.add_argument("--compare", help="上一版本的结果文件")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="耗时/内存允许的相对退步幅度")
+    args = parser.parse_args()
+
+    result = run(args.docs, args.index, args.embedder, args.workers, args.batch_size, args.queries, args.k)
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=1)
+    print(json.dumps(result, ensure_ascii=False, indent=1))
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            regressions = compare(result, json.load(f), args.tolerance)
+        for line in regressions:
+            print(f"[benchmark] regression {line}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+import json
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from config import CATEGORY_RULES_PATH, CATEGORIZE_WORKERS
+
+# --- 文档分类 ---
+# 规则从 category_rules.json 读取：每个分类一组关键词，按文件名与正文（均转小写）做子串匹配。
+# 所有关键词编译进一个 Aho-Corasick 自动机，一次扫描即可得到每个分类的命中次数，
+# 耗时只与文本长度有关，不随关键词数量线性增长。
+#
+# strategy:
+#   "priority" -> 按规则顺序，第一个有命中的分类胜出（与最初的 any(...) 链等价）
+#   "score"    -> 命中次数最多的分类胜出，次数相同时按规则顺序
+
+try:
+    import ahocorasick  # pyahocorasick，可选的 C 实现
+except ImportError:
+    ahocorasick = None
+
+
+def load_rules(path=CATEGORY_RULES_PATH):
+    with open(path, encoding="utf-8") as f:
+        rules = json.load(f)
+    rules.setdefault("strategy", "priority")
+    return rules
+
+
+class KeywordAutomaton:
+    """纯 Python 的 Aho-Corasick 自动机，接口与 pyahocorasick 的 iter() 保持一致。"""
+
+    def __init__(self, keywords):
+        # keywords: {keyword: value}
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [[]]
+        for word, value in keywords.items():
+            node = 0
+            for ch in word:
+                nxt = self._goto[node].get(ch)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto[node][ch] = nxt
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append([])
+                node = nxt
+            self._out[node].append(value)
+
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, nxt in self._goto[node].items():
+                queue.append(nxt)
+                f = self._fail[node]
+                while f and ch not in self._goto[f]:
+                    f = self._fail[f]
+                self._fail[nxt] = self._goto[f].get(ch, 0)
+                self._out[nxt] = self._out[nxt] + self._out[self._fail[nxt]]
+
+    def iter(self, text):
+        goto, fail, out = self._goto, self._fail, self._out
+        node = 0
+        for i, ch in enumerate(text):
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            for value in out[node]:
+                yield i, value
+
+
+class Categorizer:
+    def __init__(self, rules):
+        self.default = rules["default"]
+        self.strategy = rules["strategy"]
+        self.categories = [rule["category"] for rule in rules["rules"]]
+
+        # 同一关键词出现在多个分类下时，对每个分类都计数
+        keywords = {}
+        for idx, rule in enumerate(rules["rules"]):
+            for word in rule["keywords"]:
+                keywords.setdefault(word.lower(), []).append(idx)
+        if ahocorasick is not None:
+            self._automaton = ahocorasick.Automaton()
+            for word, idxs in keywords.items():
+                self._automaton.add_word(word, tuple(idxs))
+            self._automaton.make_automaton()
+        else:
+            self._automaton = KeywordAutomaton({w: tuple(idxs) for w, idxs in keywords.items()})
+
+    def hit_counts(self, source, content):
+        counts = [0] * len(self.categories)
+        # 文件名与正文之间插入换行，避免关键词跨越两者拼接处被误匹配
+        for _, idxs in self._automaton.iter(f"{source.lower()}\n{content.lower()}"):
+            for idx in idxs:
+                counts[idx] += 1
+        return counts
+
+    def categorize(self, source, content):
+        return self.choose(self.hit_counts(source, content))
+
+    def choose(self, counts):
+        if self.strategy == "score":
+            best = max(range(len(counts)), key=lambda i: (counts[i], -i), default=None)
+            return self.categories[best] if best is not None and counts[best] else self.default
+        for category, hits in zip(self.categories, counts):
+            if hits:
+                return category
+        return self.default
+
+
+# --- 模块级默认规则 ---
+RULES = load_rules()
+DEFAULT_CATEGORY = RULES["default"]
+
+# 【修改点】：这里移除了 "General / Uncategorized"
+# 注意：如果文件被归类为 General，它在 "ALL ARCHIVES" 中仍可见，但侧边栏没有单独入口，符合您的要求
+DISPLAY_CATEGORIES = [rule["category"] for rule in RULES["rules"]]
+
+_categorizer = Categorizer(RULES)
+
+
+def categorize(source, content):
+    return _categorizer.categorize(source, content)
+
+
+def hit_counts(source, content):
+    return dict(zip(_categorizer.categories, _categorizer.hit_counts(source, content)))
+
+
+def _categorize_batch(items):
+    return [_categorizer.categorize(source, content) for source, content in items]
+
+
+# 多进程分类：进程池在第一次需要时创建，之后在各次调用（各个导入窗口）之间复用
+_workers = CATEGORIZE_WORKERS
+_pool = None
+_pool_workers = 0
+_pool_lock = threading.Lock()
+
+
+def set_categorize_workers(workers):
+    """设置 categorize_many 默认的进程数，0 或 1 为串行。"""
+    global _workers
+    _workers = workers
+
+
+def _process_pool(workers):
+    global _pool, _pool_workers
+    with _pool_lock:
+        if _pool is None or _pool_workers != workers:
+            if _pool is not None:
+                _pool.shutdown(wait=False)
+            _pool = ProcessPoolExecutor(max_workers=workers)
+            _pool_workers = workers
+        return _pool
+
+
+def categorize_many(items, workers=None, min_parallel=256, batch_size=64):
+    """批量分类 [(source, content)]。进程数（默认见 set_categorize_workers）大于 1 且数量达到 min_parallel 时分发到进程池。"""
+    items = list(items)
+    workers = _workers if workers is None else workers
+    if len(items) < min_parallel or workers <= 1:
+        return _categorize_batch(items)
+    batches = [items[i:i + batch_size] for i in range(0, len(items), batch_size)]
+    return [category for result in _process_pool(workers).map(_categorize_batch, batches) for category in result]
+
+
+def categorize_documents(docs, workers=None):
+    categories = categorize_many(((doc.metadata['source'], doc.page_content) for doc in docs), workers)
+    for doc, category in zip(docs, categories):
+        doc.metadata['category'] = category
+    return docs
@@ -0,0 +1,134 @@
+from array import array
+
+from langchain_community.docstore.base import AddableMixin, Docstore
+
+# --- chunk 存储：原文区间而非文本副本 ---
+# FAISS 的 docstore 原本为每个 chunk 保存一个 Document：chunk 文本（含与相邻 chunk 重叠的部分）加一份完整的 metadata。
+# ChunkStore 只记录每个 chunk 在原文中的位置 (doc_id, start, end) 与分类，存放在紧凑的 array 中；
+# 原文只在 docs/（散文件或打包分片）中存一份，由 DocStore.read_text 按需读取（带 LRU 缓存）。
+# search() 返回轻量的 Chunk，page_content 在第一次访问时才从原文切出，因此只有展示出来的命中才会读取文本。
+# 偏移同时用于在全文中定位、高亮命中的段落。
+
+
+class Chunk:
+    """FAISS 检索结果中的一个 chunk，接口与 Document 中检索路径用到的部分一致（id、page_content、metadata）。"""
+
+    __slots__ = ("id", "doc_id", "start", "end", "category", "source", "_store", "_text", "_stale")
+
+    def __init__(self, store, _id, doc_id, start, end, category, source):
+        self._store = store
+        self.id = _id
+        self.doc_id = doc_id
+        self.start = start
+        self.end = end
+        self.category = category
+        self.source = source
+        self._text = None
+        self._stale = False
+
+    @property
+    def page_content(self):
+        if self._text is None:
+            text = self._store.text(self.doc_id, self.start, self.end)
+            self._stale = text is None
+            self._text = text if text is not None else ""
+        return self._text
+
+    @property
+    def stale(self):
+        """原文已不是入库时的版本（在两次同步之间被修改或删除），或无法读取：这个 chunk 没有可展示的文本。"""
+        self.page_content
+        return self._stale
+
+    @property
+    def metadata(self):
+        return {"source": self.source, "doc_id": self.doc_id, "category": self.category, "start": self.start, "end": self.end}
+
+    def __repr__(self):
+        return f"Chunk({self.id!r}, {self.start}:{self.end})"
+
+
+class ChunkStore(Docstore, AddableMixin):
+    """chunk id -> (doc_id, start, end, 分类)。删除只把槽位标记为空，空槽超过一定比例时整体压缩。"""
+
+    def __init__(self):
+        self.slot_of = {}
+        self.ids = []
+        self.doc_ids = array("q")
+        self.starts = array("I")
+        self.ends = array("I")
+        self.category_codes = array("H")
+        self.category_names = []
+        self.sources = {}  # doc_id -> source
+        self.reader = None
+
+    def __len__(self):
+        return len(self.slot_of)
+
+    def __getstate__(self):
+        # 读取函数属于运行中的 DocStore，不写入快照；载入后由 attach 重新设置
+        state = self.__dict__.copy()
+        state["reader"] = None
+        return state
+
+    def attach(self, reader):
+        """reader(doc_id) -> 该文档全文（找不到时为 None）。"""
+        self.reader = reader
+
+    def _category_code(self, category):
+        try:
+            return self.category_names.index(category)
+        except ValueError:
+            self.category_names.append(category)
+            return len(self.category_names) - 1
+
+    def add(self, texts):
+        # FAISS 传入 {id: Document}；metadata 中的 start_index 由切分器（add_start_index=True）给出
+        for _id, doc in texts.items():
+            self.delete([_id])
+            metadata = doc.metadata
+            start = metadata["start_index"]
+            self.slot_of[_id] = len(self.ids)
+            self.ids.append(_id)
+            self.doc_ids.append(metadata["doc_id"])
+            self.starts.append(start)
+            self.ends.append(start + len(doc.page_content))
+            self.category_codes.append(self._category_code(metadata.get("category")))
+            self.sources[metadata["doc_id"]] = metadata["source"]
+
+    def delete(self, ids):
+        for _id in ids:
+            slot = self.slot_of.pop(_id, None)
+            if slot is not None:
+                self.ids[slot] = None
+        if len(self.ids) > 1024 and len(self.slot_of) < 0.8 * len(self.ids):
+            self.compact()
+        self._prune_sources()
+
+    def _prune_sources(self):
+        # 文档的最后一个 chunk 删除后，去掉 doc_id -> source 映射
+        if len(self.sources) > 2 * max(len(self.slot_of), 1):
+            live = {self.doc_ids[slot] for slot in self.slot_of.values()}
+            self.sources = {doc_id: source for doc_id, source in self.sources.items() if doc_id in live}
+
+    def compact(self):
+        keep = [slot for slot, _id in enumerate(self.ids) if _id is not None]
+        self.ids = [self.ids[slot] for slot in keep]
+        self.doc_ids = array("q", (self.doc_ids[slot] for slot in keep))
+        self.starts = array("I", (self.starts[slot] for slot in keep))
+        self.ends = array("I", (self.ends[slot] for slot in keep))
+        self.category_codes = array("H", (self.category_codes[slot] for slot in keep))
+        self.slot_of = {_id: slot for slot, _id in enumerate(self.ids)}
+
+    def search(self, search):
+        slot = self.slot_of.get(search)
+        if slot is None:
+            return f"ID {search} not found."
+        doc_id = self.doc_ids[slot]
+        return Chunk(self, search, doc_id, self.starts[slot], self.ends[slot], self.category_names[self.category_codes[slot]],
+                     self.sources.get(doc_id))
+
+    def text(self, doc_id, start, end):
+        # 读不到入库时版本的原文时返回 None（见 DocStore.read_text）
+        full = self.reader(doc_id) if self.reader is not None else None
+        return full[start:end] if full is not None else None
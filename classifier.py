@@ -0,0 +1,91 @@
+import json
+import os
+
+import numpy as np
+
+# --- 基于嵌入的最近质心分类 ---
+# 复用建索引时已经算好的 chunk 向量：文档向量 = 其 chunk 向量的均值，
+# 每个分类的质心 = 该类种子文档向量的均值。分类只是一次 (文档数 x 维度) @ (维度 x 分类数) 的矩阵乘法，
+# 相对嵌入本身几乎没有额外开销。置信度不足或与第二名差距过小的文档归入默认分类。
+
+
+def _normalize(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def document_vectors(splits, vectors):
+    """按 metadata['source'] 对 chunk 向量做均值池化，返回 (sources, 矩阵)。"""
+    sources = []
+    rows = {}
+    row_of_chunk = np.empty(len(splits), dtype=np.int64)
+    for i, chunk in enumerate(splits):
+        source = chunk.metadata['source']
+        if source not in rows:
+            rows[source] = len(sources)
+            sources.append(source)
+        row_of_chunk[i] = rows[source]
+    vectors = np.asarray(vectors, dtype=np.float32)
+    sums = np.zeros((len(sources), vectors.shape[1]), dtype=np.float32)
+    np.add.at(sums, row_of_chunk, vectors)
+    counts = np.bincount(row_of_chunk, minlength=len(sources)).astype(np.float32)
+    return sources, sums / counts[:, None]
+
+
+def load_seeds(path):
+    # 种子文件格式：{"分类名": ["docs/xxx.txt", ...]}
+    if not path or not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+class CentroidClassifier:
+    def __init__(self, categories, default, min_confidence=0.5, min_margin=0.02, centroids=None):
+        self.categories = list(categories)
+        self.default = default
+        self.min_confidence = min_confidence
+        self.min_margin = min_margin
+        self.centroids = None if centroids is None else np.asarray(centroids, dtype=np.float32)
+
+    def fit(self, sources, doc_vectors, labels):
+        """labels: {source: 分类名}。没有任何种子文档的分类质心为零向量，永远不会被选中。"""
+        doc_vectors = _normalize(np.asarray(doc_vectors, dtype=np.float32))
+        index = {c: i for i, c in enumerate(self.categories)}
+        centroids = np.zeros((len(self.categories), doc_vectors.shape[1]), dtype=np.float32)
+        counts = np.zeros(len(self.categories), dtype=np.float32)
+        for row, source in enumerate(sources):
+            idx = index.get(labels.get(source))
+            if idx is not None:
+                centroids[idx] += doc_vectors[row]
+                counts[idx] += 1
+        centroids[counts > 0] /= counts[counts > 0, None]
+        self.centroids = _normalize(centroids)
+        return self
+
+    def predict(self, doc_vectors):
+        """返回 (分类列表, 置信度数组)。置信度为与最近质心的余弦相似度。"""
+        sims = _normalize(np.asarray(doc_vectors, dtype=np.float32)) @ self.centroids.T
+        order = np.argsort(-sims, axis=1)
+        top = sims[np.arange(len(sims)), order[:, 0]]
+        if sims.shape[1] > 1:
+            margin = top - sims[np.arange(len(sims)), order[:, 1]]
+        else:
+            margin = np.full(len(sims), np.inf, dtype=np.float32)
+        confident = (top >= self.min_confidence) & (margin >= self.min_margin)
+        labels = [self.categories[i] if ok else self.default for i, ok in zip(order[:, 0], confident)]
+        return labels, top
+
+    def to_dict(self):
+        return {
+            "categories": self.categories,
+            "default": self.default,
+            "min_confidence": self.min_confidence,
+            "min_margin": self.min_margin,
+            "centroids": self.centroids.tolist(),
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["categories"], data["default"], data["min_confidence"], data["min_margin"], data["centroids"])
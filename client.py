@@ -0,0 +1,78 @@
+import json
+import time
+import urllib.error
+import urllib.request
+
+from langchain_core.documents import Document
+
+from metrics import REGISTRY
+from serving import Overloaded
+
+# --- 检索服务的瘦客户端 ---
+# 接口与 LiveIndex 中 app.py 用到的部分一致（search、stats、read_text、metrics、start_profile/stop_profile），
+# app 无需区分本地索引与远程服务。本进程不加载嵌入模型与 FAISS。
+
+
+class ServiceClient:
+    def __init__(self, url, timeout=30):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+
+    def _request(self, path, payload=None, raw=False):
+        data = None if payload is None else json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        request = urllib.request.Request(self.url + path, data=data, headers={"Content-Type": "application/json"})
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            body = response.read()
+            return body.decode("utf-8") if raw else json.loads(body)
+
+    def search(self, query, category, k=5, mode="hybrid"):
+        start = time.perf_counter()
+        try:
+            result = self._request("/search", {"query": query, "category": category, "k": k, "mode": mode})
+        except urllib.error.HTTPError as e:
+            # 服务端队满或排队超时返回 503，与本地 ServingPool 一样抛出 Overloaded
+            if e.code == 503:
+                raise Overloaded(json.loads(e.read() or b"{}").get("reason", "unavailable")) from e
+            raise
+        # 服务端返回的阶段耗时记入本进程的指标，其余（排队、网络、序列化）记为 transport
+        stages = result.get("stages", {})
+        for stage, ms in stages.items():
+            REGISTRY.observe("query_stage_seconds", ms / 1000, stage=stage)
+        REGISTRY.observe("query_stage_seconds", max(time.perf_counter() - start - sum(stages.values()) / 1000, 0.0), stage="transport")
+        hits = []
+        for hit in result["hits"]:
+            metadata = {"source": hit["source"], "doc_id": hit["doc_id"], "category": hit["category"],
+                        "start": hit.get("start"), "end": hit.get("end")}
+            hits.append((Document(page_content=hit["content"], metadata=metadata), hit["score"]))
+        return hits
+
+    def search_parts(self, requests, vectors=None, corpora=None):
+        """分片协调端使用：一批 [(query, category, depth, mode)]、对应的查询向量与全局 BM25 统计，
+        返回各自的 {"dense": [...], "lexical": [...]}（JSON，doc_id 为分片内编号），见 LiveIndex.search_parts。"""
+        vectors = None if vectors is None else [None if v is None else [float(x) for x in v] for v in vectors]
+        return self._request("/search/parts", {"requests": [list(request) for request in requests], "vectors": vectors,
+                                               "corpora": corpora})["parts"]
+
+    def stats(self):
+        return self._request("/stats")
+
+    def shard_state(self, since=None):
+        """分片节点（service.py --shard）的就绪状态、索引版本与 BM25 语料统计，见 sharding.shard_state。"""
+        return self._request("/shard/state", {"since": since})
+
+    def metrics(self):
+        return self._request("/metrics.json")
+
+    def start_profile(self, mode):
+        return self._request("/profile/start", {"mode": mode})
+
+    def stop_profile(self):
+        return self._request("/profile/stop", {}, raw=True)
+
+    def read_text(self, doc_id):
+        try:
+            return self._request(f"/doc/{doc_id}")["text"]
+        except urllib.error.HTTPError as e:
+            if e.code == 404:
+                return None
+            raise
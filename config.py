@@ -0,0 +1,127 @@
+# --- 全局配置 ---
+# app.py、索引快照与离线脚本共用同一份参数，修改任何一项都会让旧快照的 manifest 失效
+
+# 文档与索引目录
+DOCS_DIR = "docs/"
+INDEX_DIR = "index/"
+
+# 嵌入模型
+EMBEDDING_MODEL = "BAAI/bge-small-zh-v1.5"
+
+# 嵌入后端："torch"（sentence-transformers）或 "onnx"（ONNX Runtime，CPU 上更快；先运行 python onnx_embedder.py export）
+EMBED_BACKEND = "torch"
+ONNX_MODEL_DIR = "models/bge-small-zh-v1.5-onnx/"
+ONNX_QUANTIZE = True  # 使用 int8 动态量化后的模型
+ONNX_THREADS = 0  # 推理线程数（intra-op），0 表示按 CPU 核数
+ONNX_PARITY_MIN_COSINE = 0.98  # python onnx_embedder.py check：与 torch 参考向量的最低余弦相似度
+# 嵌入缓存与快照按 "模型 + 后端" 区分：不同后端（尤其是 int8）的向量略有差异，切换后端会重新嵌入
+EMBEDDING_ID = EMBEDDING_MODEL if EMBED_BACKEND == "torch" else f"{EMBEDDING_MODEL}#onnx{'-int8' if ONNX_QUANTIZE else ''}"
+
+# 批量嵌入：每批 chunk 数、并行度与执行器（"thread" 共享模型；"process" 每个子进程各加载一份模型）
+EMBED_BATCH_SIZE = 64
+EMBED_WORKERS = 1
+EMBED_EXECUTOR = "thread"
+
+# 流式导入：每个处理窗口的正文字符上限，决定导入时的峰值内存
+INGEST_WINDOW_CHARS = 2_000_000
+# 关键词分类的进程数：默认 0，在本进程内串行分类（app / service 的增量同步不另起进程）；
+# python ingest.py 用 --categorize-workers（默认 CPU 核数）开启，各窗口共用同一个进程池
+CATEGORIZE_WORKERS = 0
+
+# 近重复检测（MinHash + LSH）：与已入库文档估计 Jaccard 相似度不低于 DEDUP_THRESHOLD 的文档不再切分与嵌入，
+# 同一文档内近乎相同的 chunk 只保留一个；0 表示关闭（默认）。开启时建议 0.9。被判为重复的文档没有自己的 chunk，
+# 不出现在检索结果与它自己分类的过滤中。shingle 为连续 SHINGLE_SIZE 个词元（与 BM25 分词相同）
+DEDUP_THRESHOLD = 0
+SHINGLE_SIZE = 3
+MINHASH_PERMUTATIONS = 64
+MINHASH_BANDS = 8  # LSH 分段数：64 / 8 = 每段 8 个哈希，相似度 0.9 的文档成为候选的概率约 99%
+
+# 嵌入缓存（按 模型+chunk 文本 寻址，跨快照复用）
+EMBEDDING_CACHE_PATH = "cache/embeddings.sqlite"
+EMBEDDING_CACHE_MAX_ENTRIES = 1_000_000
+
+# 分类规则（关键词表、默认分类、判定策略）
+CATEGORY_RULES_PATH = "category_rules.json"
+
+# 分类模式："keyword" 仅用关键词规则；"centroid" 在关键词/种子标注的基础上，
+# 用文档向量与各分类质心的余弦相似度重新分类，置信度不足的归入默认分类
+CLASSIFIER_MODE = "keyword"
+CLASSIFIER_SEEDS_PATH = "classifier_seeds.json"  # 可选：{"分类名": ["docs/xxx.txt", ...]}
+CLASSIFIER_MIN_CONFIDENCE = 0.5
+CLASSIFIER_MIN_MARGIN = 0.02
+
+# 向量索引类型（FAISS index_factory 字符串，{nlist} 按 chunk 数自动取值）：
+# "Flat" 精确检索；"HNSW32"；"IVF{nlist},Flat"；"IVF{nlist},PQ32"；
+# 压缩存储："SQ8"（int8 标量量化，约 1/4 内存）、"PCA128,SQ8"（降到 128 维后量化）。可用 python ann_index.py 比较召回与延迟
+INDEX_FACTORY = "Flat"
+ANN_TRAIN_SAMPLE = 100_000  # 需要训练的索引（IVF/PQ）最多使用的训练样本数
+# 精排：有损索引（SQ8、PCA、PQ 等）先取 k * RESCORE_K_FACTOR 个候选，再用快照中内存映射的 float32 原始向量
+# 重新计算精确距离；0 表示不精排（也不保存原始向量）。Flat、IVF,Flat、HNSW 存的就是原始向量，距离是精确的，
+# 不精排也不另存原始向量
+RESCORE_K_FACTOR = 4
+# 检索参数：IVF 每次扫描的簇数、HNSW 的候选队列长度，越大召回越高、越慢
+SEARCH_NPROBE = 16
+SEARCH_EF_SEARCH = 64
+
+# 侧边栏中表示不过滤分类的选项
+ALL_CATEGORIES = "ALL ARCHIVES"
+
+# 检索模式："hybrid"（向量 + BM25，倒数排名融合）、"dense"（仅向量）、"lexical"（仅关键词，不运行嵌入模型）
+SEARCH_MODES = ("hybrid", "dense", "lexical")
+SEARCH_MODE = "hybrid"
+SEARCH_MAX_K = 50  # 检索服务单次请求的 k 上限，更大的 k 按上限处理
+HYBRID_DEPTH = 20  # 融合前每一路取的候选数
+RRF_K = 60
+# 检索结果按来源文档折叠：同一文档的多个 chunk 只保留最相关的一个，top-k 为 k 篇不同的文档。
+# 折叠前向量/关键词检索各取 k * COLLAPSE_FETCH_FACTOR 条候选
+COLLAPSE_BY_SOURCE = True
+COLLAPSE_FETCH_FACTOR = 3
+
+# 查询路径缓存（进程内 LRU）：查询文本 -> 查询向量；(查询, 分类, k, 模式, 索引版本) -> 检索结果。ttl 单位为秒
+QUERY_CACHE_SIZE = 4096
+QUERY_CACHE_TTL = 24 * 3600
+RESULT_CACHE_SIZE = 4096
+RESULT_CACHE_TTL = 600
+
+# 独立检索服务（python service.py）：监听地址或 Unix socket，以及查询攒批的时间窗口与批大小上限
+SERVICE_HOST = "127.0.0.1"
+SERVICE_PORT = 8765
+SERVICE_SOCKET = None
+BATCH_WINDOW_MS = 5
+BATCH_MAX_SIZE = 32
+# 设为 "http://127.0.0.1:8765" 后 app.py 作为瘦客户端连接服务，不在 Streamlit 进程内加载模型与索引
+SERVICE_URL = None
+
+# 在线检索的并发控制（app 的多个会话共享同一索引与模型；service.py 的攒批队列）：
+# 同时最多执行 SERVING_WORKERS 个检索，其余在长度为 SERVING_QUEUE_SIZE 的队列中等待，队满时新请求立即拒绝；
+# 排队超过 SERVING_TIMEOUT 秒仍未开始执行的请求放弃。
+SERVING_WORKERS = 2
+SERVING_QUEUE_SIZE = 16
+SERVING_TIMEOUT = 5.0
+# 每个检索线程的 FAISS（OpenMP）线程数与查询嵌入的推理线程数（PyTorch intra-op / ONNX Runtime），
+# 0 表示 CPU 核数 / SERVING_WORKERS：并发检索的线程总数不超过核数，避免互相抢占
+SERVING_SEARCH_THREADS = 0
+SERVING_EMBED_THREADS = 0
+
+# 文本切分参数
+CHUNK_SIZE = 300
+CHUNK_OVERLAP = 50
+
+# 后台检查 docs/ 变更的间隔（秒）
+SYNC_INTERVAL = 10
+
+# 索引更新方式："sync" 由 app / 服务进程自己监视 docs/、增量嵌入并写快照；
+# "follow" 服务进程不读 docs/ 也不嵌入文档，只每隔 INDEX_POLL_INTERVAL 秒检查 index/CURRENT，
+# 换入由 python ingest.py（可在另一台机器上运行，配合 --publish）写出的新版本
+INDEX_MODE = "sync"
+INDEX_POLL_INTERVAL = 5
+
+# 分片索引（见 sharding.py）：None 为单一索引；"category" 按分类各建一个分片（要求 CLASSIFIER_MODE = "keyword"）；
+# 整数 N 按来源路径哈希分成 N 片。每个分片在 index/shards/<名称>/ 下独立构建（python ingest.py --shard 名称），
+# 查询由各分片的工作进程并行检索后合并
+INDEX_SHARDS = None
+# 远程分片：{分片名: "http://host:port"}，对应节点运行 python service.py --shard 名称；未列出的分片在本机启动工作进程
+SHARD_URLS = {}
+
+# 磁盘上保留的历史快照数量（含当前版本）
+SNAPSHOT_KEEP = 2
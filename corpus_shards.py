@@ -0,0 +1,312 @@
+import argparse
+import hashlib
+import json
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+from array import array
+
+# --- 打包语料分片 ---
+# 大量小 .txt 文件的打开、stat 与目录遍历开销远大于读取本身。分片把许多文档顺序追加进一个文件：
+#   xxx.docs.jsonl  -> 每行一条记录 {"source", "text", "category", "timestamp"}；删除记为 {"source", "deleted": true}
+#   xxx.docs.idx    -> 每条记录 16 字节（小端 uint64 偏移, uint64 长度），第 i 项即第 i 条记录，可直接随机访问
+# 分片只追加不修改：同一 source 的后一条记录覆盖前一条，墓碑记录删除它；compact 重写分片，只保留有效记录。
+# source 是文档的逻辑路径（如 docs/ai_xxx.txt），与散文件共用同一命名空间，分类、显示与 labels 都按它进行。
+#
+# 导入时按偏移顺序用 mmap 顺序读取；app 展开全文时按 (分片, 偏移, 长度) 用 pread 随机读取一条记录。
+
+SHARD_SUFFIX = ".docs.jsonl"
+INDEX_SUFFIX = ".docs.idx"
+_ENTRY = struct.Struct("<QQ")
+
+
+def index_path(path):
+    return path[:-len(SHARD_SUFFIX)] + INDEX_SUFFIX
+
+
+def is_shard(path):
+    return path.endswith(SHARD_SUFFIX)
+
+
+def location(entry):
+    """manifest 条目在分片中的位置 (分片, 偏移, 长度)；散文件返回 None。"""
+    return (entry["shard"], entry["offset"], entry["length"]) if "shard" in entry else None
+
+
+def text_digest(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class ShardWriter:
+    """向分片追加记录（文件不存在时新建）。先写数据、后写索引，读取时会丢弃越过数据末尾的索引项。"""
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self._data = open(path, "ab")
+        self._index = open(index_path(path), "ab")
+        self.offset = self._data.tell()
+        self.count = 0
+
+    def _write(self, record):
+        line = (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+        self._data.write(line)
+        self._index.write(_ENTRY.pack(self.offset, len(line)))
+        self.offset += len(line)
+        self.count += 1
+
+    def append(self, source, text, category=None, timestamp=None):
+        self._write({"source": source, "text": text, "category": category, "timestamp": timestamp or time.time()})
+
+    def delete(self, source):
+        self._write({"source": source, "deleted": True, "timestamp": time.time()})
+
+    def close(self):
+        self._data.close()
+        self._index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class Shard:
+    """只读打开一个分片：offsets/lengths 来自索引文件，索引缺失或落后于数据文件时从数据中补齐。"""
+
+    def __init__(self, path, load_index=True):
+        self.path = path
+        self.offsets = array("Q")
+        self.lengths = array("Q")
+        with open(path, "rb") as f:
+            self.size = os.fstat(f.fileno()).st_size
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if self.size else b""
+        self.end = 0
+        # 只按 manifest 中的 (偏移, 长度) 顺序读取时不需要索引
+        if load_index:
+            self._load_index()
+
+    def _load_index(self):
+        entries = array("Q")
+        try:
+            with open(index_path(self.path), "rb") as f:
+                raw = f.read()
+            entries.frombytes(raw[:len(raw) - len(raw) % _ENTRY.size])
+            if sys.byteorder == "big":
+                entries.byteswap()
+        except FileNotFoundError:
+            pass
+        end = 0
+        for i in range(0, len(entries), 2):
+            offset, length = entries[i], entries[i + 1]
+            if offset != end or offset + length > self.size:
+                break
+            self.offsets.append(offset)
+            self.lengths.append(length)
+            end = offset + length
+        # 索引之后的完整行（索引写入中断、或由其他工具追加）逐行补齐；末尾不完整的一行忽略
+        while end < self.size:
+            newline = self._mm.find(b"\n", end)
+            if newline < 0:
+                break
+            self.offsets.append(end)
+            self.lengths.append(newline + 1 - end)
+            end = newline + 1
+        self.end = end
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def record(self, i):
+        return self.read(self.offsets[i], self.lengths[i])
+
+    def read(self, offset, length):
+        return json.loads(self._mm[offset:offset + length])
+
+    def iter_records(self, start=0):
+        """按顺序产出 (偏移, 长度, 记录)，从字节偏移 start 处开始。"""
+        first = 0
+        if start:
+            # offsets 有序，二分找到第一条不早于 start 的记录
+            lo, hi = 0, len(self.offsets)
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if self.offsets[mid] < start:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            first = lo
+        for i in range(first, len(self.offsets)):
+            yield self.offsets[i], self.lengths[i], self.record(i)
+
+    def live_records(self):
+        """后一条覆盖前一条、墓碑删除之后仍然有效的记录：{source: (偏移, 长度, 记录)}，按首次出现的顺序。"""
+        live = {}
+        for offset, length, record in self.iter_records():
+            live.pop(record["source"], None)
+            if not record.get("deleted"):
+                live[record["source"]] = (offset, length, record)
+        return live
+
+    def close(self):
+        if self.size:
+            self._mm.close()
+
+
+# --- 随机读取单条记录（全文显示） ---
+
+_fds = {}
+_fds_lock = threading.Lock()
+
+
+def _fd(path):
+    # 按 (路径, inode) 缓存文件描述符：compact 原子替换分片后会重新打开
+    ino = os.stat(path).st_ino
+    with _fds_lock:
+        cached = _fds.get(path)
+        if cached and cached[1] == ino:
+            return cached[0]
+        if cached:
+            os.close(cached[0])
+        fd = os.open(path, os.O_RDONLY)
+        _fds[path] = (fd, ino)
+        return fd
+
+
+def read_record(path, offset, length):
+    return json.loads(os.pread(_fd(path), length, offset))
+
+
+# --- 扫描：分片 -> manifest 条目 ---
+
+def scan_shards(docs_dir, previous_files=None, previous_shards=None):
+    """扫描 docs_dir 下所有分片，返回 ({source: 条目}, {分片: 状态})。
+
+    条目形如 {size, mtime, sha256, shard, offset, length}，sha256 为正文摘要；状态为 {size, mtime, ino, end}，
+    end 为最后一条完整记录的结束位置。
+    分片未变化时整体沿用 previous 中的条目；只有追加时只读取新增部分；被替换（compact）时重新完整读取。
+    """
+    previous_files = previous_files or {}
+    previous_shards = previous_shards or {}
+    by_shard = {}
+    for source, entry in previous_files.items():
+        if "shard" in entry:
+            by_shard.setdefault(entry["shard"], {})[source] = entry
+
+    files, shards = {}, {}
+    for root, _, names in os.walk(docs_dir):
+        for name in sorted(names):
+            if not is_shard(name) or name.startswith("."):
+                continue
+            path = os.path.join(root, name)
+            st = os.stat(path)
+            old = previous_shards.get(path)
+            entries = by_shard.get(path, {})
+            if old and old["ino"] == st.st_ino and old["size"] == st.st_size and old["mtime"] == st.st_mtime:
+                files.update(entries)
+                shards[path] = old
+                continue
+            appended = old and old["ino"] == st.st_ino and st.st_size >= old["size"]
+            live = dict(entries) if appended else {}
+            shard = Shard(path)
+            try:
+                for offset, length, record in shard.iter_records(old["end"] if appended else 0):
+                    live.pop(record["source"], None)
+                    if record.get("deleted"):
+                        continue
+                    text = record["text"]
+                    live[record["source"]] = {
+                        "size": length, "mtime": record.get("timestamp"), "sha256": text_digest(text),
+                        "shard": path, "offset": offset, "length": length,
+                    }
+                shards[path] = {"size": st.st_size, "mtime": st.st_mtime, "ino": st.st_ino, "end": shard.end}
+            finally:
+                shard.close()
+            files.update(live)
+    return files, shards
+
+
+def iter_corpus(docs_dir):
+    """依次产出 docs_dir 中所有文档的 (source, 正文)：散 .txt 文件与分片中的有效记录。"""
+    for root, _, names in os.walk(docs_dir):
+        for name in sorted(names):
+            path = os.path.join(root, name)
+            if name.endswith(".txt"):
+                with open(path, encoding="utf-8") as f:
+                    yield path, f.read()
+            elif is_shard(name) and not name.startswith("."):
+                shard = Shard(path)
+                try:
+                    for source, (_, _, record) in shard.live_records().items():
+                        yield source, record["text"]
+                finally:
+                    shard.close()
+
+
+# --- 维护命令 ---
+
+def pack(docs_dir, out_path, remove=False):
+    """把 docs_dir 下的 .txt 文件打包进分片，source 保持原路径不变。"""
+    paths = sorted(os.path.join(root, name) for root, _, names in os.walk(docs_dir) for name in names if name.endswith(".txt"))
+    with ShardWriter(out_path) as writer:
+        for path in paths:
+            with open(path, encoding="utf-8") as f:
+                writer.append(path, f.read(), timestamp=os.stat(path).st_mtime)
+    if remove:
+        for path in paths:
+            os.remove(path)
+    print(f"[shards] packed {len(paths)} files -> {out_path}")
+
+
+def compact(path):
+    """只保留有效记录重写分片，原子替换数据与索引文件。"""
+    shard = Shard(path)
+    try:
+        live = shard.live_records()
+        before = len(shard)
+        # 临时文件以 . 开头，扫描时会被跳过
+        tmp = os.path.join(os.path.dirname(path), "." + os.path.basename(path)[:-len(SHARD_SUFFIX)] + ".tmp" + SHARD_SUFFIX)
+        with ShardWriter(tmp) as writer:
+            for _, _, record in live.values():
+                writer.append(record["source"], record["text"], record.get("category"), record.get("timestamp"))
+    finally:
+        shard.close()
+    # 先替换索引再替换数据：两次替换之间的读者看到的索引会因偏移不匹配被丢弃并从数据中重建
+    os.replace(index_path(tmp), index_path(path))
+    os.replace(tmp, path)
+    print(f"[shards] {path}: {before} -> {len(live)} records")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="打包语料分片：由散文件打包、压缩、查看统计")
+    commands = parser.add_subparsers(dest="command", required=True)
+    p = commands.add_parser("pack", help="把目录下的 .txt 打包进一个分片")
+    p.add_argument("docs_dir")
+    p.add_argument("-o", "--out", required=True, help=f"分片路径，须以 {SHARD_SUFFIX} 结尾")
+    p.add_argument("--remove", action="store_true", help="打包后删除原 .txt 文件")
+    p = commands.add_parser("compact", help="丢弃被覆盖与已删除的记录")
+    p.add_argument("shards", nargs="+")
+    p = commands.add_parser("stats")
+    p.add_argument("shards", nargs="+")
+    args = parser.parse_args()
+
+    if args.command == "pack":
+        if not is_shard(args.out):
+            raise SystemExit(f"分片路径须以 {SHARD_SUFFIX} 结尾")
+        pack(args.docs_dir, args.out, args.remove)
+    elif args.command == "compact":
+        for path in args.shards:
+            compact(path)
+    else:
+        for path in args.shards:
+            shard = Shard(path)
+            print(f"{path}: {len(shard)} records, {len(shard.live_records())} live, {shard.size / 2**20:.1f} MiB")
+            shard.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+import zlib
+
+import numpy as np
+
+from config import DEDUP_THRESHOLD, MINHASH_BANDS, MINHASH_PERMUTATIONS, SHINGLE_SIZE
+from lexical import tokenize
+
+# --- 近重复检测（MinHash + LSH） ---
+# 文本 -> 词元（与 BM25 相同的分词）-> 连续 SHINGLE_SIZE 个词元组成的 shingle 集合；
+# 两篇文本 shingle 集合的 Jaccard 相似度，用 MinHash 签名中取值相同的位置比例来估计。
+# LSH：签名切成 MINHASH_BANDS 段，任一段完全相同的文档成为候选，再用签名估计的相似度确认。
+#
+# 导入时（见 ingest.prepare_window）：
+#   文档级 -> 与已入库文档近重复的文档不切分、不嵌入，manifest 中记 dup_of 指向已入库的那一篇；
+#             被指向的文档修改或删除时，重复文档重新导入
+#   chunk 级 -> 同一文档内近乎相同的 chunk（重复段落、模板文字）只保留第一个，候选同样来自 LSH 分桶
+
+_PRIME = (1 << 31) - 1
+_rng = np.random.RandomState(1)
+# 哈希族 (a·x + b) mod p：a < 2^31、x < 2^32，乘积不会溢出 int64
+_A = _rng.randint(1, _PRIME, MINHASH_PERMUTATIONS).astype(np.int64)
+_B = _rng.randint(0, _PRIME, MINHASH_PERMUTATIONS).astype(np.int64)
+
+
+def shingles(text, size=SHINGLE_SIZE):
+    tokens = tokenize(text)
+    if len(tokens) <= size:
+        return {" ".join(tokens)} if tokens else set()
+    return {" ".join(tokens[i:i + size]) for i in range(len(tokens) - size + 1)}
+
+
+def signature(text):
+    """MinHash 签名（uint32 数组）；没有任何词元的文本返回 None。"""
+    items = shingles(text)
+    if not items:
+        return None
+    hashes = np.fromiter((zlib.crc32(s.encode("utf-8")) for s in items), dtype=np.int64, count=len(items))
+    sig = np.full(len(_A), _PRIME, dtype=np.int64)
+    # 分块计算，长文档也不会生成 shingle 数 × 哈希数 的大矩阵
+    for i in range(0, len(hashes), 4096):
+        block = hashes[i:i + 4096, None]
+        np.minimum(sig, ((block * _A + _B) % _PRIME).min(axis=0), out=sig)
+    return sig.astype(np.uint32)
+
+
+def similarity(a, b):
+    return float(np.mean(a == b))
+
+
+class DuplicateIndex:
+    """已入库文档签名的 LSH 索引（source -> 签名），支持增删，随快照持久化。"""
+
+    def __init__(self, threshold=DEDUP_THRESHOLD, bands=MINHASH_BANDS):
+        self.threshold = threshold
+        self.bands = bands
+        self.signatures = {}
+        self.buckets = [{} for _ in range(bands)]
+
+    def __len__(self):
+        return len(self.signatures)
+
+    @classmethod
+    def from_vector_db(cls, vector_db, threshold=DEDUP_THRESHOLD):
+        # 快照中没有签名时，用 docstore 中各文档 chunk 文本的并集重建（shingle 是集合，chunk 重叠部分不影响）
+        index = cls(threshold)
+        if vector_db is not None:
+            texts = {}
+            for _id in vector_db.index_to_docstore_id.values():
+                doc = vector_db.docstore.search(_id)
+                texts.setdefault(doc.metadata['source'], []).append(doc.page_content)
+            for source, chunks in texts.items():
+                index.add(source, signature("\n".join(chunks)))
+        return index
+
+    def _keys(self, sig):
+        rows = len(sig) // self.bands
+        return [sig[i * rows:(i + 1) * rows].tobytes() for i in range(self.bands)]
+
+    def find(self, sig):
+        """返回估计相似度最高且不低于阈值的已入库 source，没有时返回 None。"""
+        best, best_score = None, self.threshold
+        seen = set()
+        for bucket, key in zip(self.buckets, self._keys(sig)):
+            for source in bucket.get(key, ()):
+                if source in seen:
+                    continue
+                seen.add(source)
+                score = similarity(self.signatures[source], sig)
+                if score >= best_score:
+                    best, best_score = source, score
+        return best
+
+    def add(self, source, sig):
+        self.remove(source)
+        if sig is None:
+            return
+        self.signatures[source] = sig
+        for bucket, key in zip(self.buckets, self._keys(sig)):
+            bucket.setdefault(key, []).append(source)
+
+    def remove(self, source):
+        sig = self.signatures.pop(source, None)
+        if sig is None:
+            return
+        for bucket, key in zip(self.buckets, self._keys(sig)):
+            members = bucket[key]
+            members.remove(source)
+            if not members:
+                del bucket[key]
+
+
+def mark_duplicates(index, docs):
+    """逐篇查找近重复的已入库文档：找到时记 metadata['dup_of']，否则把该文档加入索引。返回重复篇数。"""
+    duplicates = 0
+    for doc in docs:
+        sig = signature(doc.page_content)
+        original = index.find(sig) if sig is not None else None
+        if original is not None and original != doc.metadata['source']:
+            doc.metadata['dup_of'] = original
+            duplicates += 1
+        else:
+            index.add(doc.metadata['source'], sig)
+    return duplicates
+
+
+def dedup_chunks(splits, threshold=DEDUP_THRESHOLD):
+    """去掉同一文档内与前面某个 chunk 近乎相同的 chunk，返回 (保留的 chunk, 去掉的个数)。
+
+    每个文档的 chunk 签名放进一个 DuplicateIndex，只与 LSH 同桶的 chunk 比较相似度，不必两两比较。
+    """
+    kept, seen = [], {}
+    for i, chunk in enumerate(splits):
+        sig = signature(chunk.page_content)
+        previous = seen.get(chunk.metadata['source'])
+        if previous is None:
+            previous = seen[chunk.metadata['source']] = DuplicateIndex(threshold)
+        if sig is not None and previous.find(sig) is not None:
+            continue
+        previous.add(i, sig)
+        kept.append(chunk)
+    return kept, len(splits) - len(kept)
@@ -0,0 +1,110 @@
+import hashlib
+from collections import Counter
+from functools import lru_cache
+
+from corpus_shards import location, read_record, text_digest
+
+# --- 文档存储 ---
+# 内存中只保留每篇文档的元数据（doc_id、路径、分类、摘要），chunk 通过 metadata['doc_id'] 直接引用。
+# 全文只在用户展开查看时才从磁盘读取，常驻内存不随语料总字节数增长。
+# 打包分片中的文档记录 (分片, 偏移, 长度)，展开时只 pread 这一条记录。
+# 读到的内容与 manifest 中的摘要不一致（文件在两次同步之间被修改或删除）时视为过期、不返回：
+# chunk 的区间只对入库时的版本有效，不能从另一个版本中切片。
+
+
+class StaleText(ValueError):
+    """磁盘上的文档已不是入库时的版本。"""
+
+
+class DocRecord:
+    __slots__ = ("doc_id", "source", "category", "sha256", "location")
+
+    def __init__(self, doc_id, source, category, sha256, location=None):
+        self.doc_id = doc_id
+        self.source = source
+        self.category = category
+        self.sha256 = sha256
+        self.location = location
+
+
+@lru_cache(maxsize=64)
+def _read_text(path, sha256, location=None):
+    # 读到的内容须与入库时的摘要（散文件为字节摘要，分片记录为正文摘要，见 index_store / corpus_shards）一致；
+    # 缓存中因此只有校验过的全文，文件之后再变化也不会影响已缓存的条目
+    if location is None:
+        with open(path, "rb") as f:
+            data = f.read()
+        if hashlib.sha256(data).hexdigest() != sha256:
+            raise StaleText(f"{path} changed since it was indexed")
+        return data.decode("utf-8")
+    record = read_record(*location)
+    # 分片被 compact 替换而 manifest 尚未同步时，旧偏移处可能已是别的记录
+    if record.get("source") != path:
+        raise OSError(f"{location[0]}: record at {location[1]} is not {path}")
+    if text_digest(record["text"]) != sha256:
+        raise StaleText(f"{path} changed since it was indexed")
+    return record["text"]
+
+
+class DocStore:
+    def __init__(self):
+        self._records = {}
+        self._by_source = {}
+        self._next_id = 0
+        self.category_counts = Counter()
+
+    @classmethod
+    def from_manifest(cls, files):
+        store = cls()
+        for path, entry in files.items():
+            # 按分类分片时，属于其他分片的文档也记在 manifest 中（避免每次同步重新读取），但不进入本分片
+            if entry.get("foreign"):
+                continue
+            store.add(path, entry["category"], entry["sha256"], entry["doc_id"], location(entry))
+        return store
+
+    def __len__(self):
+        return len(self._records)
+
+    def reserve_id(self, source):
+        # 已存在的文件沿用原 doc_id，新文件分配下一个编号
+        if source in self._by_source:
+            return self._by_source[source]
+        doc_id = self._next_id
+        self._next_id += 1
+        return doc_id
+
+    def add(self, source, category, sha256, doc_id=None, location=None):
+        if doc_id is None:
+            doc_id = self.reserve_id(source)
+        self.remove(source)
+        self._records[doc_id] = DocRecord(doc_id, source, category, sha256, location)
+        self._by_source[source] = doc_id
+        self._next_id = max(self._next_id, doc_id + 1)
+        self.category_counts[category] += 1
+        return doc_id
+
+    def remove(self, source):
+        doc_id = self._by_source.pop(source, None)
+        if doc_id is not None:
+            record = self._records.pop(doc_id)
+            self.category_counts[record.category] -= 1
+
+    def relocate(self, source, location):
+        # 内容未变、只是分片被重写（compact）后位置改变
+        doc_id = self._by_source.get(source)
+        if doc_id is not None:
+            self._records[doc_id].location = location
+
+    def get(self, doc_id):
+        return self._records.get(doc_id)
+
+    def read_text(self, doc_id):
+        # 文档不存在、读取失败或已不是入库时的版本时返回 None
+        record = self._records.get(doc_id)
+        if record is None:
+            return None
+        try:
+            return _read_text(record.source, record.sha256, record.location)
+        except (OSError, ValueError):
+            return None
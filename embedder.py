@@ -0,0 +1,210 @@
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+from langchain_core.embeddings import Embeddings
+
+from config import EMBEDDING_MODEL, EMBEDDING_ID, EMBED_BACKEND, ONNX_THREADS, EMBEDDING_CACHE_PATH, EMBEDDING_CACHE_MAX_ENTRIES
+from config import EMBED_BATCH_SIZE, EMBED_WORKERS, EMBED_EXECUTOR, QUERY_CACHE_SIZE, QUERY_CACHE_TTL
+from embedding_cache import CachedEmbeddings
+from query_cache import LRUCache
+
+# --- 批量并行嵌入 ---
+# chunk 先按长度排序再分批，同一批内长度相近，padding 浪费最小；
+# 各批在线程池或进程池中并行嵌入，完成一批就交给调用方（写入索引），并定期打印吞吐与预计剩余时间。
+
+
+class Progress:
+    def __init__(self, total, label="embed", every=5.0):
+        self.total = total
+        self.done = 0
+        self.label = label
+        self.every = every
+        self.start = self._last = time.time()
+
+    def update(self, n):
+        self.done += n
+        now = time.time()
+        if now - self._last >= self.every or self.done >= self.total:
+            self._last = now
+            print(f"[{self.label}] {self.report()}")
+
+    def report(self):
+        elapsed = max(time.time() - self.start, 1e-9)
+        rate = self.done / elapsed
+        eta = (self.total - self.done) / rate if rate else float("inf")
+        return f"{self.done}/{self.total} chunks, {rate:.1f} chunks/s, ETA {eta:.0f}s"
+
+
+# 进程池模式：每个子进程各自加载一份模型，并限制其 PyTorch 线程数，避免与其他子进程抢占核心
+_worker_embeddings = None
+
+
+def _init_worker(model_name, threads):
+    global _worker_embeddings
+    _worker_embeddings = load_model(model_name, threads)
+
+
+def _embed_in_worker(texts):
+    return _worker_embeddings.embed_documents(texts)
+
+
+class BatchedEmbeddings(Embeddings):
+    """包装底层 Embeddings，按长度排序分批、并行嵌入，并以流的形式逐批返回结果。
+
+    executor="thread" 时各线程共享同一个模型；"process" 时每个子进程加载自己的模型（需提供 model_name），
+    threads_per_worker 为每个子进程的推理线程数（PyTorch 或 ONNX Runtime）。workers <= 1 时在当前线程顺序执行。
+    """
+
+    def __init__(self, embeddings, batch_size=64, workers=1, executor="thread", model_name=None, threads_per_worker=1):
+        self.embeddings = embeddings
+        self.batch_size = batch_size
+        self.workers = workers
+        self.executor = executor
+        self.model_name = model_name
+        self.threads_per_worker = threads_per_worker
+
+    def _pool(self):
+        if self.executor == "process":
+            return ProcessPoolExecutor(
+                max_workers=self.workers,
+                initializer=_init_worker,
+                initargs=(self.model_name, self.threads_per_worker),
+            )
+        return ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="embed")
+
+    def iter_documents(self, texts):
+        """逐批产出 (在 texts 中的下标列表, 向量列表)，顺序为完成顺序。"""
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        batches = [order[i:i + self.batch_size] for i in range(0, len(order), self.batch_size)]
+        progress = Progress(len(texts))
+
+        if self.workers <= 1:
+            for batch in batches:
+                vectors = self.embeddings.embed_documents([texts[i] for i in batch])
+                progress.update(len(batch))
+                yield batch, vectors
+            return
+
+        fn = _embed_in_worker if self.executor == "process" else self.embeddings.embed_documents
+        with self._pool() as pool:
+            pending = {}
+            queue = iter(batches)
+            # 最多 2 x workers 个批次在途，结果被消费后才提交新批次
+            for batch in queue:
+                pending[pool.submit(fn, [texts[i] for i in batch])] = batch
+                if len(pending) >= 2 * self.workers:
+                    break
+            while pending:
+                finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    batch = pending.pop(future)
+                    progress.update(len(batch))
+                    yield batch, future.result()
+                    nxt = next(queue, None)
+                    if nxt is not None:
+                        pending[pool.submit(fn, [texts[i] for i in nxt])] = nxt
+
+    def embed_documents(self, texts):
+        out = [None] * len(texts)
+        for batch, vectors in self.iter_documents(texts):
+            for i, vec in zip(batch, vectors):
+                out[i] = vec
+        return out
+
+    def embed_query(self, text):
+        return self.embeddings.embed_query(text)
+
+    def embed_queries(self, texts):
+        # HuggingFaceEmbeddings 未设置 query_encode_kwargs 时查询与文档的编码方式相同，整批查询一次前向计算；
+        # 超过一批的大量查询（离线批量查询）走与文档相同的排序分批与并行路径
+        if hasattr(self.embeddings, "query_encode_kwargs") and not self.embeddings.query_encode_kwargs:
+            if len(texts) > self.batch_size:
+                return self.embed_documents(texts)
+            return self.embeddings.embed_documents(texts)
+        return [self.embeddings.embed_query(text) for text in texts]
+
+
+class LazyEmbeddings(Embeddings):
+    """首次使用时才导入 torch / sentence-transformers 并加载模型。
+
+    load() 可以提前在后台线程调用；加载期间其他线程的嵌入调用会等待它完成，而不是重复加载。
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._model = None
+        self._lock = threading.Lock()
+
+    @property
+    def ready(self):
+        return self._model is not None
+
+    def load(self):
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    start = time.time()
+                    self._model = self._factory()
+                    print(f"[embed] model loaded in {time.time() - start:.1f}s")
+        return self._model
+
+    def embed_documents(self, texts):
+        return self.load().embed_documents(texts)
+
+    def embed_query(self, text):
+        return self.load().embed_query(text)
+
+    def __getattr__(self, name):
+        # query_encode_kwargs 等模型属性转发给真实模型（会触发加载）
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self.load(), name)
+
+
+def _lazy_model(embeddings):
+    # 沿 CachedEmbeddings -> BatchedEmbeddings -> ... 的 .embeddings 链找到 LazyEmbeddings
+    while embeddings is not None and not isinstance(embeddings, LazyEmbeddings):
+        embeddings = getattr(embeddings, "embeddings", None)
+    return embeddings
+
+
+def embeddings_ready(embeddings):
+    """嵌入栈中的模型是否已加载；没有 LazyEmbeddings 的嵌入栈总是就绪。"""
+    lazy = _lazy_model(embeddings)
+    return lazy is None or lazy.ready
+
+
+def warm_up(embeddings):
+    """加载模型并做一次前向计算（分词器、首次推理的初始化都在这里完成），不写入任何缓存。"""
+    lazy = _lazy_model(embeddings)
+    if lazy is not None:
+        lazy.load().embed_query("预热")
+
+
+def load_model(model_name=EMBEDDING_MODEL, threads=None):
+    """按 EMBED_BACKEND 加载底层模型；threads 为推理线程数，None 表示使用后端默认值。"""
+    if EMBED_BACKEND == "onnx":
+        from onnx_embedder import OnnxEmbeddings
+
+        return OnnxEmbeddings(threads=threads or ONNX_THREADS)
+    from langchain_huggingface import HuggingFaceEmbeddings
+
+    if threads:
+        import torch
+
+        torch.set_num_threads(threads)
+    return HuggingFaceEmbeddings(model_name=model_name)
+
+
+def make_embeddings(workers=EMBED_WORKERS, batch_size=EMBED_BATCH_SIZE, executor=EMBED_EXECUTOR, threads_per_worker=1, lazy=False,
+                    threads=None):
+    """app 与离线脚本共用的嵌入栈：内容寻址缓存（查询向量走进程内 LRU）-> 批量并行嵌入 -> bge-small-zh（torch 或 ONNX）。
+
+    lazy=True 时立即返回，模型在第一次嵌入或 warm_up() 时才加载。threads 为本进程模型的推理线程数（见 load_model）。
+    """
+    base = LazyEmbeddings(lambda: load_model(threads=threads)) if lazy else load_model(threads=threads)
+    batched = BatchedEmbeddings(base, batch_size, workers, executor, EMBEDDING_MODEL, threads_per_worker)
+    # 缓存键使用 EMBEDDING_ID（模型 + 后端），torch 与 ONNX/int8 的向量不会混用
+    return CachedEmbeddings(batched, EMBEDDING_ID, EMBEDDING_CACHE_PATH, max_entries=EMBEDDING_CACHE_MAX_ENTRIES,
+                            query_cache=LRUCache(QUERY_CACHE_SIZE, QUERY_CACHE_TTL))
@@ -0,0 +1,207 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from array import array
+
+from langchain_core.embeddings import Embeddings
+
+# --- 内容寻址的嵌入缓存 ---
+# key = sha256(模型名 + 归一化后的 chunk 文本)，value = float32 向量。
+# 调整 chunk 参数或新增文档时，只有缓存未命中的 chunk 才会真正送入模型。
+
+_SQL_BATCH = 500  # 单条 SQL 中 IN (...) 的参数上限
+
+
+def iter_embeddings(embeddings, texts):
+    # 支持流式的 Embeddings 逐批产出，其余一次性返回
+    if hasattr(embeddings, "iter_documents"):
+        yield from embeddings.iter_documents(texts)
+    elif texts:
+        yield list(range(len(texts))), embeddings.embed_documents(texts)
+
+
+def embed_queries(embeddings, texts):
+    # 支持批量查询嵌入的 Embeddings 一次前向计算，其余逐条调用 embed_query
+    if hasattr(embeddings, "embed_queries"):
+        return embeddings.embed_queries(texts)
+    return [embeddings.embed_query(text) for text in texts]
+
+
+def normalize_text(text):
+    return " ".join(unicodedata.normalize("NFKC", text).split())
+
+
+def cache_key(model_name, text):
+    return hashlib.sha256(f"{model_name}\0{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+
+class CachedEmbeddings(Embeddings):
+    """包装任意 Embeddings：embed_documents 先查 SQLite 缓存，只嵌入未命中的文本。
+
+    max_entries 为缓存条目上限，超出后按最近使用时间淘汰最旧的条目；<= 0 表示不限。
+    查询向量不写入 SQLite，只在传入 query_cache（进程内 LRU）时按归一化后的查询文本缓存。
+    """
+
+    def __init__(self, embeddings, model_name, path, max_entries=1_000_000, query_cache=None):
+        self.embeddings = embeddings
+        self.query_cache = query_cache
+        self.model_name = model_name
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            " key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_last_used ON embeddings(last_used)")
+        self._conn.commit()
+        # 条目数存在单行表中，由触发器随每次插入与删除在同一事务内增减：共用同一个缓存文件的各进程
+        # （导入命令、app / service 的同步、分片工作进程）看到的都是准确的条目数，写入时不必 COUNT(*) 全表。
+        # 建表、初始计数与触发器在同一个写事务中完成，旧的缓存文件第一次打开时统计一次
+        self._conn.execute("BEGIN IMMEDIATE")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS cache_size (id INTEGER PRIMARY KEY CHECK (id = 0), entries INTEGER NOT NULL)")
+        self._conn.execute("INSERT OR IGNORE INTO cache_size (id, entries) SELECT 0, COUNT(*) FROM embeddings")
+        self._conn.execute(
+            "CREATE TRIGGER IF NOT EXISTS embeddings_inserted AFTER INSERT ON embeddings"
+            " BEGIN UPDATE cache_size SET entries = entries + 1 WHERE id = 0; END"
+        )
+        self._conn.execute(
+            "CREATE TRIGGER IF NOT EXISTS embeddings_deleted AFTER DELETE ON embeddings"
+            " BEGIN UPDATE cache_size SET entries = entries - 1 WHERE id = 0; END"
+        )
+        self._conn.commit()
+
+    def _size(self):
+        (entries,) = self._conn.execute("SELECT entries FROM cache_size WHERE id = 0").fetchone()
+        return entries
+
+    def _lookup(self, keys):
+        found = {}
+        now = time.time()
+        with self._lock:
+            for i in range(0, len(keys), _SQL_BATCH):
+                batch = keys[i:i + _SQL_BATCH]
+                marks = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({marks})", batch
+                ).fetchall()
+                for key, blob in rows:
+                    vec = array("f")
+                    vec.frombytes(blob)
+                    found[key] = vec.tolist()
+                if rows:
+                    self._conn.executemany(
+                        "UPDATE embeddings SET last_used = ? WHERE key = ?", [(now, k) for k, _ in rows]
+                    )
+            self._conn.commit()
+        return found
+
+    def _store(self, items):
+        now = time.time()
+        with self._lock:
+            # 已有的 key（其他进程或并发批次刚写入）向量相同，只刷新使用时间（INSERT OR IGNORE 不触发删除，计数保持准确）
+            inserted = self._conn.executemany(
+                "INSERT OR IGNORE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)",
+                [(key, array("f", vec).tobytes(), now) for key, vec in items],
+            ).rowcount
+            if inserted < len(items):
+                self._conn.executemany("UPDATE embeddings SET last_used = ? WHERE key = ?", [(now, key) for key, _ in items])
+            self._conn.commit()
+            self._evict()
+
+    def _evict(self):
+        if self.max_entries <= 0:
+            return
+        overflow = self._size() - self.max_entries
+        if overflow > 0:
+            deleted = self._conn.execute(
+                "DELETE FROM embeddings WHERE key IN "
+                "(SELECT key FROM embeddings ORDER BY last_used LIMIT ?)",
+                (overflow,),
+            ).rowcount
+            self._conn.commit()
+            self.evictions += deleted
+
+    def iter_documents(self, texts):
+        """逐批产出 (在 texts 中的下标列表, 向量列表)：先一次性产出全部命中，再随底层模型逐批产出未命中。"""
+        keys = [cache_key(self.model_name, t) for t in texts]
+        found = self._lookup(list(set(keys)))
+
+        # 同一批次内重复的文本只嵌入一次
+        positions = {}
+        hit_positions = []
+        for i, key in enumerate(keys):
+            if key in found:
+                hit_positions.append(i)
+            else:
+                positions.setdefault(key, []).append(i)
+        self.hits += len(hit_positions)
+        self.misses += len(keys) - len(hit_positions)
+        if hit_positions:
+            yield hit_positions, [found[keys[i]] for i in hit_positions]
+
+        pending = list(positions)
+        pending_texts = [texts[positions[k][0]] for k in pending]
+        for batch, vectors in iter_embeddings(self.embeddings, pending_texts):
+            computed = [(pending[j], vec) for j, vec in zip(batch, vectors)]
+            self._store(computed)
+            out_positions, out_vectors = [], []
+            for key, vec in computed:
+                for i in positions[key]:
+                    out_positions.append(i)
+                    out_vectors.append(vec)
+            yield out_positions, out_vectors
+
+    def embed_documents(self, texts):
+        out = [None] * len(texts)
+        for batch, vectors in self.iter_documents(texts):
+            for i, vec in zip(batch, vectors):
+                out[i] = vec
+        return out
+
+    def embed_query(self, text):
+        if self.query_cache is None:
+            return self.embeddings.embed_query(text)
+        key = normalize_text(text)
+        vector = self.query_cache.get(key)
+        if vector is None:
+            vector = self.embeddings.embed_query(text)
+            self.query_cache.put(key, vector)
+        return vector
+
+    def embed_queries(self, texts):
+        if self.query_cache is None:
+            return embed_queries(self.embeddings, texts)
+        keys = [normalize_text(text) for text in texts]
+        found = {key: self.query_cache.get(key) for key in set(keys)}
+        missing = [key for key, vector in found.items() if vector is None]
+        if missing:
+            first_text = {}
+            for key, text in zip(keys, texts):
+                first_text.setdefault(key, text)
+            for key, vector in zip(missing, embed_queries(self.embeddings, [first_text[key] for key in missing])):
+                self.query_cache.put(key, vector)
+                found[key] = vector
+        return [found[key] for key in keys]
+
+    def stats(self):
+        total = self.hits + self.misses
+        with self._lock:
+            size = self._size()
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "evictions": self.evictions,
+            "entries": size,
+        }
@@ -1,4 +1,5 @@
 import os
+import sys
 
 # --- ⚠️ 注意：这里使用 my_docs 以防止与关键词 'data' 冲突 ---
 output_dir = "docs"
@@ -263,14 +264,23 @@ news_data = {
     在这个分裂的世界中，博物馆（Museum）保存了物质遗产，而比较文学则保存了精神遗产的对话记录。它提醒我们要警惕狭隘的民族主义历史（History）观，拥抱一种更包容的“世界文学”视野。艺术（Art）的终极目的，是促进人类心灵的相通。"""
 }
 
-# 写入文件
+# 写入文件；python generate_news_data.py --packed 时整批写入一个打包分片（见 corpus_shards.py），source 仍为原文件路径
 count = 0
-for filename, content in news_data.items():
-    file_path = os.path.join(output_dir, filename)
-    with open(file_path, "w", encoding='utf-8') as f:
-        f.write(content)
-    count += 1
-    print(f"✅ 文章生成成功: {file_path}")
+if "--packed" in sys.argv:
+    from corpus_shards import ShardWriter
+
+    with ShardWriter(os.path.join(output_dir, "news.docs.jsonl")) as writer:
+        for filename, content in news_data.items():
+            writer.append(os.path.join(output_dir, filename), content)
+            count += 1
+    print(f"✅ 文章已写入分片: {writer.path}")
+else:
+    for filename, content in news_data.items():
+        file_path = os.path.join(output_dir, filename)
+        with open(file_path, "w", encoding='utf-8') as f:
+            f.write(content)
+        count += 1
+        print(f"✅ 文章生成成功: {file_path}")
 
 print(f"\n🎉 恭喜！已为您生成了 {count} 篇长篇深度报道文章。")
 print(f"这些文章已经存放在 '{output_dir}' 文件夹中。")
@@ -0,0 +1,262 @@
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import threading
+import time
+
+import corpus_shards
+
+# --- 索引快照 ---
+# 目录结构：
+#   index/
+#     CURRENT                 -> 当前生效的版本名
+#     20260101-120000-123456789-ab12cd34/   版本名 = UTC 时间（精确到纳秒，严格递增）+ manifest 指纹
+#       index.faiss           -> 向量索引
+#       index.pkl             -> docstore + index_to_docstore_id（chunk 只存 doc_id、原文区间与 category，见 chunk_store.py）
+#       manifest.json         -> 构建时的源文件清单（含 doc_id、category）、分片状态、模型与切分参数
+#       vectors.npy           -> 可选：有损索引精排用的 float32 原始向量，行号即 FAISS 位置
+#       lexical.pkl           -> chunk 文本的 BM25 倒排索引
+#       dedup.pkl             -> 可选：已入库文档的 MinHash 签名与 LSH 分桶（近重复检测）
+
+SNAPSHOT_FORMAT = 3
+MANIFEST_FILE = "manifest.json"
+CURRENT_FILE = "CURRENT"
+VECTORS_FILE = "vectors.npy"
+LEXICAL_FILE = "lexical.pkl"
+DEDUP_FILE = "dedup.pkl"
+
+
+def file_digest(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def scan_sources(docs_dir, previous=None):
+    """扫描 docs_dir 下所有 .txt，返回 {source: {size, mtime, sha256}}。
+
+    size 与 mtime 都未变化的文件直接沿用 previous 中的摘要，避免每次启动都重读全部内容。
+    """
+    previous = previous or {}
+    files = {}
+    for root, _, names in os.walk(docs_dir):
+        for name in sorted(names):
+            if not name.endswith(".txt"):
+                continue
+            path = os.path.join(root, name)
+            st = os.stat(path)
+            old = previous.get(path)
+            if old and old["size"] == st.st_size and old["mtime"] == st.st_mtime:
+                digest = old["sha256"]
+            else:
+                digest = file_digest(path)
+            files[path] = {"size": st.st_size, "mtime": st.st_mtime, "sha256": digest}
+    return files
+
+
+def scan_corpus(docs_dir, previous=None):
+    """散 .txt 文件与打包分片（corpus_shards）一起扫描，返回 (files, shards)。previous 为上一版 manifest。"""
+    previous = previous or {}
+    files = scan_sources(docs_dir, previous.get("files"))
+    packed, shards = corpus_shards.scan_shards(docs_dir, previous.get("files"), previous.get("shards"))
+    files.update(packed)
+    return files, shards
+
+
+def read_order(files, paths=None):
+    """导入时的读取顺序：分片中的记录按 (分片, 偏移) 排在一起，读取分片时是顺序读；散文件按路径。"""
+    paths = files if paths is None else paths
+    return sorted(paths, key=lambda p: (files[p].get("shard", ""), files[p].get("offset", 0), p))
+
+
+def build_manifest(docs_dir, model_name, chunk_size, chunk_overlap, previous=None):
+    files, shards = scan_corpus(docs_dir, previous)
+    return {
+        "format": SNAPSHOT_FORMAT,
+        "model": model_name,
+        "chunk_size": chunk_size,
+        "chunk_overlap": chunk_overlap,
+        "files": files,
+        "shards": shards,
+    }
+
+
+def manifest_compatible(saved, current):
+    """模型、切分参数、分类规则、索引类型、去重阈值与分片定义一致：快照可以直接载入，文件差异可增量同步。"""
+    if not saved or saved.get("format") != SNAPSHOT_FORMAT:
+        return False
+    return all(saved.get(key) == current.get(key)
+               for key in ("model", "chunk_size", "chunk_overlap", "categorizer", "index_factory", "dedup", "shard"))
+
+
+def manifest_matches(saved, current):
+    if not manifest_compatible(saved, current):
+        return False
+    saved_files = saved.get("files", {})
+    current_files = current["files"]
+    if saved_files.keys() != current_files.keys():
+        return False
+    # 分片被 compact 后内容不变但偏移改变，也需要同步以更新文档存储中的位置
+    return all(saved_files[p]["sha256"] == current_files[p]["sha256"]
+               and corpus_shards.location(saved_files[p]) == corpus_shards.location(current_files[p]) for p in current_files)
+
+
+def fingerprint(manifest):
+    h = hashlib.sha256()
+    h.update(f"{manifest['model']}|{manifest['chunk_size']}|{manifest['chunk_overlap']}".encode())
+    for path in sorted(manifest["files"]):
+        h.update(f"|{path}:{manifest['files'][path]['sha256']}".encode())
+    return h.hexdigest()
+
+
+def current_snapshot_dir(index_dir):
+    pointer = os.path.join(index_dir, CURRENT_FILE)
+    if not os.path.exists(pointer):
+        return None
+    with open(pointer, encoding="utf-8") as f:
+        version = f.read().strip()
+    path = os.path.join(index_dir, version)
+    return path if version and os.path.isdir(path) else None
+
+
+def load_manifest(snapshot_dir):
+    if not snapshot_dir:
+        return None
+    path = os.path.join(snapshot_dir, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _write_atomic(path, text):
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+
+_last_ns = 0
+_version_lock = threading.Lock()
+
+
+def _new_version(manifest):
+    # 版本名按字典序即按写出顺序排列（清理旧版本依赖这一点）：用 UTC 时间，夏令时回拨不会让新版本排到旧版本之前；
+    # 同一秒内的多次保存以纳秒区分，且本进程内严格递增
+    global _last_ns
+    with _version_lock:
+        _last_ns = max(time.time_ns(), _last_ns + 1)
+        ns = _last_ns
+    return f"{time.strftime('%Y%m%d-%H%M%S', time.gmtime(ns // 10**9))}-{ns % 10**9:09d}-{fingerprint(manifest)[:8]}"
+
+
+def save_snapshot(vector_db, manifest, index_dir, keep=2, float_vectors=None, lexical=None, dedup=None):
+    """写出一个新版本快照并原子地切换 CURRENT，返回快照目录。"""
+    os.makedirs(index_dir, exist_ok=True)
+    version = _new_version(manifest)
+    final_dir = os.path.join(index_dir, version)
+    tmp_dir = os.path.join(index_dir, f".tmp-{version}")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    vector_db.save_local(tmp_dir)
+    if float_vectors is not None:
+        import numpy as np
+
+        np.save(os.path.join(tmp_dir, VECTORS_FILE), np.asarray(float_vectors, dtype=np.float32))
+    if lexical is not None:
+        with open(os.path.join(tmp_dir, LEXICAL_FILE), "wb") as f:
+            pickle.dump(lexical, f, protocol=pickle.HIGHEST_PROTOCOL)
+    if dedup is not None:
+        with open(os.path.join(tmp_dir, DEDUP_FILE), "wb") as f:
+            pickle.dump(dedup, f, protocol=pickle.HIGHEST_PROTOCOL)
+    _write_atomic(os.path.join(tmp_dir, MANIFEST_FILE), json.dumps(manifest, ensure_ascii=False, indent=1))
+    if os.path.exists(final_dir):
+        shutil.rmtree(final_dir)
+    os.replace(tmp_dir, final_dir)
+    _write_atomic(os.path.join(index_dir, CURRENT_FILE), version)
+
+    _prune_snapshots(index_dir, keep, version)
+    return final_dir
+
+
+def publish_snapshot(snapshot_dir, target_dir, keep=2):
+    """把一个已写好的快照发布到另一个索引目录：先完整复制版本目录，最后原子地切换 CURRENT。
+
+    轮询 CURRENT 的读者（LiveIndex.refresh）因此不会看到复制了一半的版本。返回发布后的快照目录。
+    """
+    version = os.path.basename(os.path.normpath(snapshot_dir))
+    os.makedirs(target_dir, exist_ok=True)
+    final_dir = os.path.join(target_dir, version)
+    if not os.path.isdir(final_dir):
+        tmp_dir = os.path.join(target_dir, f".tmp-{version}")
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        shutil.copytree(snapshot_dir, tmp_dir)
+        os.replace(tmp_dir, final_dir)
+    _write_atomic(os.path.join(target_dir, CURRENT_FILE), version)
+    _prune_snapshots(target_dir, keep, version)
+    return final_dir
+
+
+def _prune_snapshots(index_dir, keep, written):
+    """只保留最新的 keep 个版本；CURRENT 指向的版本与刚写出的版本（written）无论如何都不删除。"""
+    if keep <= 0:
+        return
+    protected = {written}
+    current = current_snapshot_dir(index_dir)
+    if current:
+        protected.add(os.path.basename(current))
+    versions = sorted(
+        name for name in os.listdir(index_dir)
+        if not name.startswith(".") and name != "shards" and os.path.isdir(os.path.join(index_dir, name))
+    )
+    for name in versions[:-keep]:
+        if name not in protected:
+            shutil.rmtree(os.path.join(index_dir, name), ignore_errors=True)
+
+
+def load_snapshot(snapshot_dir, embeddings, mmap=True):
+    """载入快照。mmap=True 时向量以只读内存映射方式打开，不支持的索引类型自动回退为常规读取。
+
+    注意：内存映射的索引不能再 add/remove，需要写入时请用 mmap=False 重新载入。
+    """
+    import faiss
+    from langchain_community.vectorstores import FAISS
+
+    # 快照由本进程写出，pickle 来源可信
+    if mmap:
+        flags = faiss.IO_FLAG_READ_ONLY | faiss.IO_FLAG_MMAP | getattr(faiss, "IO_FLAG_MMAP_IFC", 0)
+        try:
+            return FAISS.load_local(snapshot_dir, embeddings, allow_dangerous_deserialization=True, io_flags=flags)
+        except RuntimeError:
+            pass
+    return FAISS.load_local(snapshot_dir, embeddings, allow_dangerous_deserialization=True)
+
+
+def load_vectors(snapshot_dir):
+    """以只读内存映射方式打开精排用的原始向量；快照中没有时返回 None。"""
+    import numpy as np
+
+    path = os.path.join(snapshot_dir, VECTORS_FILE) if snapshot_dir else None
+    if not path or not os.path.exists(path):
+        return None
+    return np.load(path, mmap_mode="r")
+
+
+def load_lexical(snapshot_dir):
+    path = os.path.join(snapshot_dir, LEXICAL_FILE) if snapshot_dir else None
+    if not path or not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        return pickle.load(f)
+
+
+def load_dedup(snapshot_dir):
+    path = os.path.join(snapshot_dir, DEDUP_FILE) if snapshot_dir else None
+    if not path or not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        return pickle.load(f)
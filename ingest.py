@@ -0,0 +1,795 @@
+import argparse
+import gc
+import os
+import threading
+import time
+from collections import Counter
+
+import numpy as np
+
+from langchain_community.document_loaders import TextLoader
+from langchain_core.documents import Document
+from langchain_community.vectorstores import FAISS
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+import ann_index
+import corpus_shards
+from chunk_store import ChunkStore
+import index_store
+from categorizer import DEFAULT_CATEGORY, DISPLAY_CATEGORIES, categorize_documents, set_categorize_workers
+from classifier import CentroidClassifier, document_vectors, load_seeds
+from config import DOCS_DIR, INDEX_DIR, EMBEDDING_ID, CHUNK_SIZE, CHUNK_OVERLAP, SNAPSHOT_KEEP
+from config import CATEGORY_RULES_PATH, CLASSIFIER_MODE, CLASSIFIER_SEEDS_PATH
+from config import CLASSIFIER_MIN_CONFIDENCE, CLASSIFIER_MIN_MARGIN
+from config import EMBED_BATCH_SIZE, EMBED_WORKERS, EMBED_EXECUTOR, INGEST_WINDOW_CHARS, INDEX_FACTORY
+from config import DEDUP_THRESHOLD
+from config import SEARCH_MODE, RESULT_CACHE_SIZE, RESULT_CACHE_TTL
+from dedup import DuplicateIndex, dedup_chunks, mark_duplicates
+from doc_store import DocStore
+from embedder import embeddings_ready
+from embedding_cache import embed_queries, iter_embeddings, normalize_text
+from lexical import LexicalIndex
+from metrics import NULL_TIMER, PROFILER, REGISTRY, StageTimer, span
+from query_cache import LRUCache
+from rwlock import RWLock
+from search import ALL_CATEGORIES, CategoryFilter, drop_stale, hybrid_search_many, lexical_search, search_by_vectors
+
+# --- 1. 流式管线：文件 -> 分类 -> 去重 -> 切分 -> 嵌入 -> 写索引 ---
+# 文件按需逐个读取并攒成“窗口”，每个窗口的正文总字符数不超过 window_chars；
+# 下游处理完一个窗口，上游才会继续读文件，因此峰值内存只取决于窗口大小，而非语料规模。
+# 打包分片中的文档（manifest 条目带 shard/offset/length）用 mmap 按偏移读取，paths 按 index_store.read_order 排序时为顺序读。
+
+def iter_documents(paths, files=None):
+    shard = None
+    try:
+        for path in paths:
+            entry = files.get(path) if files else None
+            if entry is None or "shard" not in entry:
+                yield from TextLoader(path, encoding='utf-8').load()
+                continue
+            if shard is None or shard.path != entry["shard"]:
+                if shard is not None:
+                    shard.close()
+                shard = corpus_shards.Shard(entry["shard"], load_index=False)
+            record = shard.read(entry["offset"], entry["length"])
+            yield Document(page_content=record["text"], metadata={"source": path})
+    finally:
+        if shard is not None:
+            shard.close()
+
+
+def iter_windows(paths, window_chars=INGEST_WINDOW_CHARS, files=None):
+    window, size = [], 0
+    for doc in iter_documents(paths, files):
+        window.append(doc)
+        size += len(doc.page_content)
+        if size >= window_chars:
+            yield window
+            window, size = [], 0
+    if window:
+        yield window
+
+
+def split_documents(docs):
+    # start_index：chunk 在原文中的起始偏移，索引中只保存 (doc_id, start, end)，见 chunk_store.py
+    text_splitter = RecursiveCharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP, add_start_index=True)
+    return text_splitter.split_documents(docs)
+
+
+def prepare_window(window, assign_doc_id, timer=NULL_TIMER, dedup=None, shard=None):
+    """分类、分配 doc_id 并切分；切分后立即丢弃全文，窗口内只保留 chunk。
+
+    传入 dedup（DuplicateIndex）时，近重复文档只记 metadata['dup_of'] 不切分，文档内重复的 chunk 也不保留。
+    传入 shard（sharding.ShardSpec）时，不属于该分片的文档记 metadata['foreign']，同样不切分。
+    """
+    with timer("categorize", len(window)):
+        categorize_documents(window)
+    for doc in window:
+        doc.metadata['doc_id'] = assign_doc_id(doc.metadata['source'])
+        if shard is not None and not shard.owns(doc):
+            doc.metadata['foreign'] = True
+    originals = [doc for doc in window if 'foreign' not in doc.metadata]
+    if dedup is not None:
+        with timer("dedup", len(originals)):
+            duplicates = mark_duplicates(dedup, originals)
+        REGISTRY.inc("ingest_duplicates_total", duplicates, level="document")
+        originals = [doc for doc in originals if 'dup_of' not in doc.metadata]
+    with timer("split", len(originals)):
+        splits = split_documents(originals)
+    if dedup is not None:
+        with timer("dedup", len(splits)):
+            splits, dropped = dedup_chunks(splits, dedup.threshold)
+        REGISTRY.inc("ingest_duplicates_total", dropped, level="chunk")
+    for doc in window:
+        doc.page_content = ""
+    return splits
+
+
+def record_document(entry, doc):
+    # 把窗口处理的结果写回 manifest 条目
+    entry.update(category=doc.metadata['category'], doc_id=doc.metadata['doc_id'])
+    for key in ('dup_of', 'foreign'):
+        entry.pop(key, None)
+        if key in doc.metadata:
+            entry[key] = doc.metadata[key]
+
+
+def chunk_ids(splits):
+    # chunk id = 源文件路径 + 文件内序号，同一文件的 chunk 可以按来源整体删除
+    seen = Counter()
+    ids = []
+    for chunk in splits:
+        source = chunk.metadata['source']
+        ids.append(f"{source}#{seen[source]}")
+        seen[source] += 1
+    return ids
+
+
+def embed_splits(splits, embeddings):
+    return embeddings.embed_documents([chunk.page_content for chunk in splits]) if splits else []
+
+
+def add_to_index(vector_db, splits, vectors, embeddings):
+    texts = [chunk.page_content for chunk in splits]
+    metadatas = [chunk.metadata for chunk in splits]
+    if vector_db is None:
+        return FAISS.from_embeddings(list(zip(texts, vectors)), embeddings, metadatas=metadatas, ids=chunk_ids(splits),
+                                     docstore=ChunkStore())
+    ann_index.add_chunks(vector_db, chunk_documents(splits), vectors)
+    return vector_db
+
+
+def chunk_documents(splits):
+    # ann_index.add_chunks 的输入：{chunk id: Document}
+    return {_id: Document(id=_id, page_content=chunk.page_content, metadata=chunk.metadata)
+            for _id, chunk in zip(chunk_ids(splits), splits)}
+
+
+def add_to_lexical(lexical, splits):
+    lexical.add(chunk_ids(splits), [chunk.page_content for chunk in splits], [chunk.metadata['category'] for chunk in splits])
+
+
+def stream_into_index(splits, embeddings, vector_db=None, timer=NULL_TIMER):
+    """边嵌入边写索引：每完成一批就 add 进 FAISS，无需等全部 chunk 嵌入完。"""
+    texts = [chunk.page_content for chunk in splits]
+    ids = chunk_ids(splits)
+    for batch, vectors in timer.iterate("embed", iter_embeddings(embeddings, texts)):
+        pairs = [(texts[i], vec) for i, vec in zip(batch, vectors)]
+        metadatas = [splits[i].metadata for i in batch]
+        batch_ids = [ids[i] for i in batch]
+        with timer("index", len(batch)):
+            if vector_db is None:
+                vector_db = FAISS.from_embeddings(pairs, embeddings, metadatas=metadatas, ids=batch_ids, docstore=ChunkStore())
+            else:
+                vector_db.add_embeddings(pairs, metadatas=metadatas, ids=batch_ids)
+    return vector_db
+
+
+# --- 2. 基于嵌入的分类（CLASSIFIER_MODE = "centroid" 时启用） ---
+
+def fit_classifier(docs, splits, vectors):
+    # 种子集优先；没有种子文件时用关键词分类结果（排除默认分类）作为标注
+    seeds = load_seeds(CLASSIFIER_SEEDS_PATH)
+    if seeds:
+        labels = {source: category for category, sources in seeds.items() for source in sources}
+    else:
+        labels = {doc.metadata['source']: doc.metadata['category'] for doc in docs if doc.metadata['category'] != DEFAULT_CATEGORY}
+    sources, doc_vectors = document_vectors(splits, vectors)
+    classifier = CentroidClassifier(DISPLAY_CATEGORIES, DEFAULT_CATEGORY, CLASSIFIER_MIN_CONFIDENCE, CLASSIFIER_MIN_MARGIN)
+    return classifier.fit(sources, doc_vectors, labels)
+
+
+def apply_classifier(classifier, docs, splits, vectors):
+    """用 chunk 向量均值重新分类，同步更新文档与其所有 chunk 的 category。"""
+    if classifier is None or not splits:
+        return
+    sources, doc_vectors = document_vectors(splits, vectors)
+    labels, _ = classifier.predict(doc_vectors)
+    assigned = dict(zip(sources, labels))
+    for doc in docs:
+        doc.metadata['category'] = assigned.get(doc.metadata['source'], doc.metadata['category'])
+    for chunk in splits:
+        chunk.metadata['category'] = assigned[chunk.metadata['source']]
+
+
+def classify_window(classifier, docs, splits, vectors):
+    # 流式构建时没有全量数据，质心由第一个窗口拟合，后续窗口沿用
+    if CLASSIFIER_MODE != "centroid" or not splits:
+        return classifier
+    if classifier is None:
+        classifier = fit_classifier(docs, splits, vectors)
+    apply_classifier(classifier, docs, splits, vectors)
+    return classifier
+
+
+def categorizer_signature():
+    # 分类规则或分类模式变化时快照失效
+    return {"mode": CLASSIFIER_MODE, "rules": index_store.file_digest(CATEGORY_RULES_PATH)}
+
+
+# --- 3. 可增量更新的在线索引 ---
+
+def scan_chunk_ids(vector_db):
+    # chunk id 为 "来源#序号"（见 chunk_ids），不必逐个取出 chunk
+    ids = {}
+    if vector_db is None:
+        return ids
+    for _id in vector_db.index_to_docstore_id.values():
+        ids.setdefault(_id.rpartition('#')[0], []).append(_id)
+    return ids
+
+
+def attach_texts(vector_db, doc_store):
+    # 区间形式的 chunk 存储从文档存储读取原文；快照载入后需要重新设置
+    if vector_db is not None and isinstance(vector_db.docstore, ChunkStore):
+        vector_db.docstore.attach(doc_store.read_text)
+
+
+def snapshot_state(vector_db, manifest, snapshot_dir=None, float_vectors=None, lexical=None, dedup=None):
+    """由一份快照的内容得到 LiveIndex 检索所需的全部状态（属性名 -> 值），构造与换入新版本时共用。"""
+    classifier = manifest.get('classifier')
+    doc_store = DocStore.from_manifest(manifest['files'])
+    attach_texts(vector_db, doc_store)
+    if dedup is None and DEDUP_THRESHOLD > 0:
+        dedup = DuplicateIndex.from_vector_db(vector_db)
+    return {
+        "vector_db": vector_db,
+        # BM25 倒排索引与向量库同步增删，关键词检索不经过嵌入模型
+        "lexical": lexical if lexical is not None else LexicalIndex.from_vector_db(vector_db),
+        # 已入库文档的 MinHash 签名，只由 sync 读写（_sync_lock 内）
+        "dedup": dedup,
+        # 有损索引精排用的原始向量（行号 = FAISS 位置），通常是快照中 vectors.npy 的内存映射
+        "float_vectors": float_vectors,
+        "doc_store": doc_store,
+        "manifest": manifest,
+        "classifier": CentroidClassifier.from_dict(classifier) if classifier else None,
+        "snapshot_dir": snapshot_dir,
+        # 以内存映射方式载入的快照是只读的，第一次写入前需要重新载入一份可写副本
+        "_mmap_snapshot_dir": snapshot_dir,
+        "chunk_ids": scan_chunk_ids(vector_db),
+        "category_filter": CategoryFilter.from_vector_db(vector_db),
+    }
+
+
+class LiveIndex:
+    """app 持有的索引状态：向量库 + 文档存储 + manifest，三者在同一把读写锁下保持一致。
+
+    读者（检索、侧边栏统计、doc_id 查找）使用 `with live.lock.read():`；
+    sync() 把读文件、分类、切分、嵌入这些慢操作放在锁外，写锁内只做内存中的 add/delete。
+    """
+
+    def __init__(self, vector_db, manifest, embeddings, docs_dir, index_dir, snapshot_dir=None, window_chars=INGEST_WINDOW_CHARS,
+                 float_vectors=None, lexical=None, dedup=None, shard=None):
+        for name, value in snapshot_state(vector_db, manifest, snapshot_dir, float_vectors, lexical, dedup).items():
+            setattr(self, name, value)
+        self.embeddings = embeddings
+        self.docs_dir = docs_dir
+        self.index_dir = index_dir
+        self.window_chars = window_chars
+        # 分片索引中本索引负责的部分（sharding.ShardSpec），None 为整个语料
+        self.shard = shard
+        self.version = 0
+        self.lock = RWLock("index")
+        self._sync_lock = threading.Lock()
+        self._skipped_snapshot = None
+        # 键中含索引版本，旧版本的结果不会被读到；版本变化时整体清空以释放内存
+        self.result_cache = LRUCache(RESULT_CACHE_SIZE, RESULT_CACHE_TTL)
+        # 增量同步各阶段耗时记入 ingest_stage_seconds；规模与缓存命中率在导出指标时读取
+        self.timer = StageTimer(REGISTRY)
+        self._register_gauges()
+
+    def _register_gauges(self):
+        REGISTRY.gauge("index_documents", lambda: len(self.doc_store), help="Documents in the live index")
+        REGISTRY.gauge("index_chunks", lambda: len(self.vector_db.index_to_docstore_id) if self.vector_db is not None else 0,
+                       help="Chunks in the vector index")
+        REGISTRY.gauge("index_category_documents", lambda: dict(self.doc_store.category_counts), label="category")
+        REGISTRY.gauge("index_version", lambda: self.version)
+        REGISTRY.gauge("cache_entries", lambda: {name: s["entries"] for name, s in self.cache_stats().items() if s}, label="cache")
+        REGISTRY.gauge("cache_hit_rate", lambda: {name: s["hit_rate"] for name, s in self.cache_stats().items() if s}, label="cache")
+
+    @property
+    def ready(self):
+        return self.vector_db is not None and len(self.vector_db.index_to_docstore_id) > 0
+
+    def _writable_vector_db(self):
+        if self._mmap_snapshot_dir:
+            return index_store.load_snapshot(self._mmap_snapshot_dir, self.embeddings, mmap=False)
+        return self.vector_db
+
+    def _apply(self, vector_db, stale_sources, window, splits, vectors, entries):
+        """删除 stale_sources 的旧 chunk，写入本窗口的新 chunk，并同步文档存储与 manifest。
+
+        与 chunk 总数成正比的工作（新的位置映射、分类过滤器、精排向量、manifest）在锁外基于当前版本完成
+        （sync 是唯一的写者，由 _sync_lock 保证），写锁内只做本窗口在 FAISS、docstore 与倒排索引中的增删和引用替换。
+        """
+        stale = [_id for p in stale_sources for _id in self.chunk_ids.get(p, [])]
+        float_vectors = self.float_vectors
+        plan = None
+        if vector_db is None:
+            vector_db = add_to_index(vector_db, splits, vectors, self.embeddings) if splits else None
+            category_filter = CategoryFilter.from_vector_db(vector_db)
+        else:
+            plan = ann_index.plan_update(vector_db, stale, chunk_documents(splits), vectors)
+            if float_vectors is not None:
+                if plan["keep"] is not None:
+                    float_vectors = float_vectors[plan["keep"]]
+                if splits:
+                    float_vectors = ann_index.place_rows(float_vectors, plan["positions"], vectors)
+            index = plan["index"] if plan["index"] is not None else vector_db.index
+            category_filter = self.category_filter.updated(index, plan, [chunk.metadata['category'] for chunk in splits])
+            if vector_db is not self.vector_db:
+                # 刚载入的可写副本（或新建的向量库）还没有读者，不必等写锁
+                ann_index.apply_update(vector_db, plan)
+                plan = None
+        files = dict(self.manifest['files'])
+        for path in stale_sources:
+            files.pop(path, None)
+        files.update({doc.metadata['source']: entries[doc.metadata['source']] for doc in window})
+
+        with self.lock.write():
+            if plan is not None:
+                ann_index.apply_update(vector_db, plan)
+            if stale:
+                self.lexical.remove(stale)
+            if splits:
+                add_to_lexical(self.lexical, splits)
+            for path in stale_sources:
+                self.doc_store.remove(path)
+                self.chunk_ids.pop(path, None)
+            for doc in window:
+                source = doc.metadata['source']
+                if 'foreign' in doc.metadata:
+                    continue
+                self.doc_store.add(source, doc.metadata['category'], entries[source]['sha256'], doc.metadata['doc_id'],
+                                   corpus_shards.location(entries[source]))
+            for _id, chunk in zip(chunk_ids(splits), splits):
+                self.chunk_ids.setdefault(chunk.metadata['source'], []).append(_id)
+
+            self.vector_db = vector_db
+            attach_texts(vector_db, self.doc_store)
+            # 变更后的原始向量暂存在内存中，下次保存快照后重新映射
+            self.float_vectors = float_vectors
+            self.category_filter = category_filter
+            self._mmap_snapshot_dir = None
+            self.manifest = dict(self.manifest, files=files)
+            self.version += 1
+            self.result_cache.clear()
+        return len(stale)
+
+    def search(self, query, category=ALL_CATEGORIES, k=5, mode=SEARCH_MODE):
+        """带缓存的检索，返回 [(Document, 分数)]。"""
+        return self.search_many([(query, category, k, mode)])[0]
+
+    def search_many(self, requests, query_vectors=None):
+        """批量检索 [(query, category, k, mode)]，返回每条请求的 [(Document, 分数)]。
+
+        未命中结果缓存的查询在锁外一次性嵌入；同一 (分类, k, 模式) 的查询在读锁内合并为一次 FAISS 调用。
+        query_vectors 与 requests 一一对应时直接使用（分片工作进程由协调进程统一嵌入查询），不运行嵌入模型。
+        """
+        with PROFILER.capture():
+            keys = [(normalize_text(query), category, k, mode) for query, category, k, mode in requests]
+            version = self.version
+            results = [self.result_cache.get(key + (version,)) for key in keys]
+            pending = [i for i, hits in enumerate(results) if hits is None]
+            for i, (_, _, _, mode) in enumerate(requests):
+                REGISTRY.inc("query_requests_total", mode=mode, cache="miss" if results[i] is None else "hit")
+            if not pending:
+                return results
+
+            # 嵌入模型仍在后台加载时，向量/混合检索暂以关键词检索代替，这些结果不写入缓存
+            degraded = set()
+            if query_vectors is None and not embeddings_ready(self.embeddings):
+                degraded = {i for i in pending if requests[i][3] != "lexical"}
+                requests = [(query, category, k, "lexical") if i in degraded else (query, category, k, mode)
+                            for i, (query, category, k, mode) in enumerate(requests)]
+                REGISTRY.inc("query_degraded_total", len(degraded))
+
+            dense = [i for i in pending if requests[i][3] != "lexical"]
+            if query_vectors is not None:
+                vectors = {i: query_vectors[i] for i in dense}
+            else:
+                with span("embed", len(dense)):
+                    vectors = dict(zip(dense, embed_queries(self.embeddings, [requests[i][0] for i in dense])))
+            groups = {}
+            for i in pending:
+                groups.setdefault(requests[i][1:], []).append(i)
+            with self.lock.read():
+                version = self.version
+                for (category, k, mode), idxs in groups.items():
+                    batch = hybrid_search_many(self.vector_db, self.category_filter, self.lexical, [requests[i][0] for i in idxs],
+                                               [vectors.get(i) for i in idxs], category, k, mode, float_vectors=self.float_vectors)
+                    for i, hits in zip(idxs, batch):
+                        results[i] = hits
+            for i in pending:
+                if i not in degraded:
+                    self.result_cache.put(keys[i] + (version,), results[i])
+            return results
+
+    def search_parts(self, requests, query_vectors, corpora=None):
+        """分片端检索 [(query, category, depth, mode)]：向量与 BM25 两路各取 depth 条，不融合、不折叠，
+        返回每条请求的 {"dense": [(Document, L2 距离)], "lexical": [(Document, BM25 分数)]}（只含 mode 需要的部分）。
+
+        协调端把各分片的同一路结果合并为全局前 depth 条后再融合与折叠（见 sharding.ShardedIndex）。
+        corpora 与 requests 一一对应，为全局 BM25 统计（LexicalIndex.search 的 corpus），各分片的分数因此可比。
+        """
+        results = [{} for _ in requests]
+        with PROFILER.capture(), self.lock.read():
+            if self.vector_db is None:
+                return results
+            groups = {}
+            for i, (query, category, depth, mode) in enumerate(requests):
+                if mode != "lexical":
+                    groups.setdefault((category, depth), []).append(i)
+                if mode != "dense":
+                    results[i]["lexical"] = lexical_search(self.vector_db, self.lexical, query, category, depth,
+                                                           corpora[i] if corpora else None)
+            for (category, depth), idxs in groups.items():
+                batch = search_by_vectors(self.vector_db, self.category_filter, [query_vectors[i] for i in idxs], category, depth,
+                                          self.float_vectors)
+                for i, hits in zip(idxs, batch):
+                    results[i]["dense"] = hits
+            # 返回前序列化时要读取原文，原文已过期的命中在合并之前去掉
+            results = [{part: drop_stale(hits) for part, hits in parts.items()} for parts in results]
+        return results
+
+    def stats(self):
+        """文档总数、各分类文档数、模型是否就绪与缓存命中率，供侧边栏与服务的 /stats 使用。"""
+        with self.lock.read():
+            docs = len(self.doc_store)
+            categories = dict(self.doc_store.category_counts)
+            ready = self.ready
+        return {"docs": docs, "categories": categories, "ready": ready, "model_ready": embeddings_ready(self.embeddings),
+                "version": self.version, "snapshot": os.path.basename(self.snapshot_dir) if self.snapshot_dir else None,
+                "cache": self.cache_stats()}
+
+    def read_text(self, doc_id):
+        with self.lock.read():
+            return self.doc_store.read_text(doc_id)
+
+    def cache_stats(self):
+        query_cache = getattr(self.embeddings, "query_cache", None)
+        return {
+            "query_embedding": query_cache.stats() if query_cache is not None else None,
+            "results": self.result_cache.stats(),
+        }
+
+    def metrics(self):
+        return REGISTRY.snapshot()
+
+    def start_profile(self, mode):
+        PROFILER.start(mode)
+        return {"profiling": PROFILER.mode}
+
+    def stop_profile(self):
+        return PROFILER.stop()
+
+    def sync(self):
+        """对比 docs_dir 与 manifest，只处理新增、修改、删除的文件。返回变更统计。
+
+        变更按窗口流式处理，每个窗口在锁外完成分类、切分、嵌入，再用一次短暂的写锁落入索引。
+        """
+        with self._sync_lock:
+            old_files = self.manifest['files']
+            current, shards = index_store.scan_corpus(self.docs_dir, self.manifest)
+            if self.shard is not None:
+                current = self.shard.select(current)
+            added = [p for p in current if p not in old_files]
+            updated = [p for p in current if p in old_files and current[p]['sha256'] != old_files[p]['sha256']]
+            removed = [p for p in old_files if p not in current]
+            report = {"added": len(added), "updated": len(updated), "removed": len(removed), "chunks_added": 0, "chunks_removed": 0,
+                      "duplicates": 0}
+
+            # 仅 mtime 变化的文件沿用原分类与 doc_id，刷新 mtime 避免下次重复计算摘要；
+            # 分片 compact 后内容不变的记录只更新位置
+            moved = []
+            for path, entry in current.items():
+                if path in old_files and path not in updated:
+                    entry['category'] = old_files[path]['category']
+                    entry['doc_id'] = old_files[path]['doc_id']
+                    for key in ('dup_of', 'foreign'):
+                        if key in old_files[path]:
+                            entry[key] = old_files[path][key]
+                    if corpus_shards.location(entry) != corpus_shards.location(old_files[path]):
+                        moved.append(path)
+            if moved:
+                with self.lock.write():
+                    for path in moved:
+                        self.doc_store.relocate(path, corpus_shards.location(current[path]))
+            if not (added or updated or removed):
+                self.manifest = dict(self.manifest, files=current, shards=shards)
+                return report
+
+            if self.dedup is not None:
+                # 修改或删除的文档不能再作为近重复的原文；指向它们的重复文档重新导入
+                gone = set(updated) | set(removed)
+                for path in gone:
+                    self.dedup.remove(path)
+                reprocess = set(added) | set(updated)
+                updated += [p for p, entry in old_files.items() if entry.get('dup_of') in gone and p in current and p not in reprocess]
+                report["updated"] = len(updated)
+
+            vector_db = self._writable_vector_db()
+            updated_set = set(updated)
+            for window in iter_windows(index_store.read_order(current, added + updated), self.window_chars, current):
+                # --- 锁外：分类、去重、切分、嵌入 ---
+                splits = prepare_window(window, self.doc_store.reserve_id, self.timer, self.dedup, self.shard)
+                with self.timer("embed", len(splits)):
+                    vectors = embed_splits(splits, self.embeddings)
+                self.classifier = classify_window(self.classifier, window, splits, vectors)
+                for doc in window:
+                    record_document(current[doc.metadata['source']], doc)
+                report["duplicates"] += sum('dup_of' in doc.metadata for doc in window)
+
+                # --- 写锁内：只做内存中的 delete/add ---
+                stale_sources = [doc.metadata['source'] for doc in window if doc.metadata['source'] in updated_set]
+                with self.timer("index", len(splits)):
+                    report["chunks_removed"] += self._apply(vector_db, stale_sources, window, splits, vectors, current)
+                report["chunks_added"] += len(splits)
+                vector_db = self.vector_db
+
+            if removed:
+                report["chunks_removed"] += self._apply(vector_db, removed, [], [], [], current)
+            with self.lock.write():
+                self.manifest = dict(self.manifest, files=current, shards=shards, classifier=self.classifier.to_dict() if self.classifier else None)
+
+            # 持久化新快照，进程重启后无需重新嵌入；保存期间读者不受影响
+            with self.lock.read(), self.timer("save"):
+                snapshot_dir = None
+                if self.vector_db is not None:
+                    snapshot_dir = index_store.save_snapshot(self.vector_db, self.manifest, self.index_dir, keep=SNAPSHOT_KEEP,
+                                                             float_vectors=self.float_vectors, lexical=self.lexical, dedup=self.dedup)
+            if snapshot_dir and self.float_vectors is not None:
+                # 换成刚写出文件的内存映射以释放内存；文件不存在时保留内存中的副本，不能让精排悄悄失效
+                mapped = index_store.load_vectors(snapshot_dir)
+                if mapped is not None:
+                    with self.lock.write():
+                        self.float_vectors = mapped
+            self.snapshot_dir = snapshot_dir or self.snapshot_dir
+            for name in ("added", "updated", "removed"):
+                REGISTRY.inc("ingest_files_total", report[name], change=name)
+            REGISTRY.inc("ingest_chunks_total", report["chunks_added"], change="added")
+            REGISTRY.inc("ingest_chunks_total", report["chunks_removed"], change="removed")
+            return report
+
+    def start_watcher(self, interval):
+        def loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    with PROFILER.capture():
+                        report = self.sync()
+                    if report["added"] or report["updated"] or report["removed"]:
+                        print(f"[ingest] {report}")
+                except Exception as e:
+                    print(f"[ingest] sync failed: {e}")
+
+        threading.Thread(target=loop, name="docs-watcher", daemon=True).start()
+
+    def refresh(self):
+        """follow 模式：CURRENT 指向了其他进程写出的新版本时换入该快照，返回是否换入。
+
+        新快照在锁外完整载入；写锁要等正在执行的检索都读完旧版本才能拿到，锁内只替换引用，
+        之后旧版本不再被引用，其内存（与内存映射）随即释放。
+        """
+        with self._sync_lock:
+            snapshot_dir = index_store.current_snapshot_dir(self.index_dir)
+            if snapshot_dir is None or snapshot_dir in (self.snapshot_dir, self._skipped_snapshot):
+                return False
+            manifest = index_store.load_manifest(snapshot_dir)
+            if manifest is None or manifest.get('model') != EMBEDDING_ID:
+                # 查询向量与该快照的文档向量不可比，不换入；只提示一次
+                self._skipped_snapshot = snapshot_dir
+                print(f"[ingest] skip {snapshot_dir}: built with {manifest and manifest.get('model')}, serving {EMBEDDING_ID}")
+                return False
+            with self.timer("reload"):
+                vector_db = index_store.load_snapshot(snapshot_dir, self.embeddings)
+                state = snapshot_state(vector_db, manifest, snapshot_dir, load_float_vectors(snapshot_dir, vector_db),
+                                       index_store.load_lexical(snapshot_dir), index_store.load_dedup(snapshot_dir))
+                del vector_db
+            with self.lock.write():
+                for name, value in state.items():
+                    setattr(self, name, value)
+                self.version += 1
+                self.result_cache.clear()
+            del state
+            # FAISS 包装对象之间可能有引用环，主动回收一次，旧版本的内存不必等到下次自动回收
+            gc.collect()
+            REGISTRY.inc("index_reloads_total")
+            print(f"[ingest] switched to {os.path.basename(snapshot_dir)}")
+            return True
+
+    def start_follower(self, interval):
+        def loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.refresh()
+                except Exception as e:
+                    print(f"[ingest] reload failed: {e}")
+
+        threading.Thread(target=loop, name="index-follower", daemon=True).start()
+
+
+# --- 4. 启动：优先载入快照，否则全量构建 ---
+
+def build_index(docs_dir, index_dir, embeddings, manifest, window_chars=INGEST_WINDOW_CHARS, timer=NULL_TIMER, shard=None):
+    """全量构建。timer（metrics.StageTimer）记录 load/categorize/split/embed/index/lexical/save 各阶段耗时。"""
+    vector_db, classifier = None, None
+    lexical = LexicalIndex()
+    dedup = DuplicateIndex() if DEDUP_THRESHOLD > 0 else None
+    next_id = iter(range(len(manifest['files'])))
+    for window in timer.iterate("load", iter_windows(index_store.read_order(manifest['files']), window_chars, manifest['files'])):
+        splits = prepare_window(window, lambda source: next(next_id), timer, dedup, shard)
+        # centroid 模式需要本窗口向量到齐后才能定类别；关键词模式则边嵌入边写索引
+        if CLASSIFIER_MODE == "centroid":
+            with timer("embed", len(splits)):
+                vectors = embed_splits(splits, embeddings)
+            with timer("categorize", len(window)):
+                classifier = classify_window(classifier, window, splits, vectors)
+            if splits:
+                with timer("index", len(splits)):
+                    vector_db = add_to_index(vector_db, splits, vectors, embeddings)
+        else:
+            vector_db = stream_into_index(splits, embeddings, vector_db, timer)
+        with timer("lexical", len(splits)):
+            add_to_lexical(lexical, splits)
+        for doc in window:
+            record_document(manifest['files'][doc.metadata['source']], doc)
+
+    manifest['classifier'] = classifier.to_dict() if classifier else None
+    float_vectors, snapshot_dir = None, None
+    if vector_db is not None:
+        # 全部向量就绪后一次性训练并转换为 INDEX_FACTORY 指定的 ANN 索引；有损索引另存原始向量供精排
+        flat = vector_db.index
+        with timer("index"):
+            vector_db.index = ann_index.convert(flat, INDEX_FACTORY)
+        keep_floats = ann_index.wants_rescore(vector_db.index)
+        float_vectors = ann_index.flat_vectors(flat) if keep_floats else None
+        with timer("save"):
+            snapshot_dir = index_store.save_snapshot(vector_db, manifest, index_dir, keep=SNAPSHOT_KEEP,
+                                                     float_vectors=float_vectors, lexical=lexical, dedup=dedup)
+        del flat
+        if keep_floats:
+            # 优先使用快照文件的内存映射；映射不到时保留内存中的副本
+            mapped = index_store.load_vectors(snapshot_dir)
+            if mapped is not None:
+                float_vectors = mapped
+    live = LiveIndex(vector_db, manifest, embeddings, docs_dir, index_dir, window_chars=window_chars, float_vectors=float_vectors,
+                     lexical=lexical, dedup=dedup, shard=shard)
+    live.snapshot_dir = snapshot_dir
+    return live
+
+
+def open_live_index(docs_dir, index_dir, embeddings, window_chars=INGEST_WINDOW_CHARS, sync=True, shard=None):
+    """sync=False 时载入快照后不立即同步 docs/ 的变更（由调用方稍后调用 live.sync()），快照可以先投入使用。
+
+    shard（sharding.ShardSpec）：只索引属于该分片的文档，index_dir 为该分片自己的目录。
+    """
+    if not os.path.exists(docs_dir):
+        os.makedirs(docs_dir)
+
+    snapshot_dir = index_store.current_snapshot_dir(index_dir)
+    saved_manifest = index_store.load_manifest(snapshot_dir)
+    manifest = index_store.build_manifest(docs_dir, EMBEDDING_ID, CHUNK_SIZE, CHUNK_OVERLAP, saved_manifest)
+    manifest['categorizer'] = categorizer_signature()
+    manifest['index_factory'] = INDEX_FACTORY
+    manifest['dedup'] = DEDUP_THRESHOLD
+    manifest['shard'] = shard.key if shard is not None else None
+    if shard is not None:
+        manifest['files'] = shard.select(manifest['files'])
+    if not index_store.manifest_compatible(saved_manifest, manifest):
+        return build_index(docs_dir, index_dir, embeddings, manifest, window_chars, StageTimer(REGISTRY), shard)
+
+    # 【快照】：模型、切分参数与分类规则一致时直接载入磁盘索引，跳过读取全文、分类与全量嵌入；
+    # docs/ 与快照之间的差异（新增、修改、删除）随后增量同步
+    try:
+        live = _load_snapshot(snapshot_dir, saved_manifest, docs_dir, index_dir, embeddings, window_chars, shard)
+    except FileNotFoundError as e:
+        # 快照缺少精排所需的原始向量（如保存时 RESCORE_K_FACTOR 为 0），只能重建
+        print(f"[ingest] {e}, rebuilding")
+        return build_index(docs_dir, index_dir, embeddings, manifest, window_chars, StageTimer(REGISTRY), shard)
+    if sync and not index_store.manifest_matches(saved_manifest, manifest):
+        live.sync()
+    return live
+
+
+def open_snapshot(docs_dir, index_dir, embeddings):
+    """只读载入当前快照：不对比 docs/、不重建也不写盘，离线批量查询用。没有快照时返回 None。"""
+    snapshot_dir = index_store.current_snapshot_dir(index_dir)
+    manifest = index_store.load_manifest(snapshot_dir)
+    if manifest is None:
+        return None
+    return _load_snapshot(snapshot_dir, manifest, docs_dir, index_dir, embeddings)
+
+
+def follow_live_index(docs_dir, index_dir, embeddings):
+    """follow 模式：不读 docs/、不构建也不嵌入文档，只换入其他进程（python ingest.py）写出的快照。
+
+    当前还没有可用快照时返回空索引，之后由 start_follower 轮询 CURRENT。
+    """
+    live = LiveIndex(None, {'files': {}}, embeddings, docs_dir, index_dir)
+    live.refresh()
+    return live
+
+
+def load_float_vectors(snapshot_dir, vector_db):
+    """快照中精排用的原始向量。索引需要精排而快照里没有时抛出 FileNotFoundError，而不是退化为不精排的有损检索。"""
+    float_vectors = index_store.load_vectors(snapshot_dir)
+    if float_vectors is None and vector_db is not None and ann_index.wants_rescore(vector_db.index):
+        raise FileNotFoundError(f"{snapshot_dir}: {index_store.VECTORS_FILE} missing, the lossy index needs it for rescoring")
+    return float_vectors
+
+
+def _load_snapshot(snapshot_dir, manifest, docs_dir, index_dir, embeddings, window_chars=INGEST_WINDOW_CHARS, shard=None):
+    vector_db = index_store.load_snapshot(snapshot_dir, embeddings)
+    return LiveIndex(vector_db, manifest, embeddings, docs_dir, index_dir, snapshot_dir=snapshot_dir, window_chars=window_chars,
+                     float_vectors=load_float_vectors(snapshot_dir, vector_db), lexical=index_store.load_lexical(snapshot_dir),
+                     dedup=index_store.load_dedup(snapshot_dir), shard=shard)
+
+
+# --- 5. 命令行：不启动 app，直接把 docs/ 的变更写入磁盘快照 ---
+# 也是 follow 模式（config.INDEX_MODE）下的构建进程：在另一个进程或另一台机器上运行，
+# --publish 把写好的快照复制到 app 读取的索引目录（如共享存储），app 轮询 CURRENT 换入新版本。
+# 分片索引（config.INDEX_SHARDS）的每个分片单独构建：--shard 名称 只更新 index/shards/<名称>/，--shard all 依次构建全部分片。
+
+def run_ingest(docs_dir=DOCS_DIR, index_dir=INDEX_DIR, workers=EMBED_WORKERS, batch_size=EMBED_BATCH_SIZE,
+               executor=EMBED_EXECUTOR, window_chars=INGEST_WINDOW_CHARS, publish_dir=None, shards=None):
+    from embedder import make_embeddings
+
+    embeddings = make_embeddings(workers=workers, batch_size=batch_size, executor=executor)
+    if not shards:
+        return _ingest_one(docs_dir, index_dir, embeddings, window_chars, publish_dir)
+    from sharding import shard_index_dir
+
+    # 各分片共用同一个嵌入模型与缓存
+    for spec in shards:
+        print(f"[ingest] shard {spec.name}")
+        live = _ingest_one(docs_dir, shard_index_dir(index_dir, spec.name), embeddings, window_chars,
+                           shard_index_dir(publish_dir, spec.name) if publish_dir else None, spec)
+    return live
+
+
+def _ingest_one(docs_dir, index_dir, embeddings, window_chars, publish_dir=None, shard=None):
+    start = time.time()
+    live = open_live_index(docs_dir, index_dir, embeddings, window_chars, shard=shard)
+    total = len(live.vector_db.index_to_docstore_id) if live.vector_db is not None else 0
+    print(f"[ingest] {len(live.doc_store)} docs, {total} chunks in {time.time() - start:.1f}s; cache {embeddings.stats()}")
+    if live.vector_db is not None:
+        # 常驻内存的是索引本身；精排用的原始向量是内存映射文件，只占可回收的页缓存
+        index_mb = ann_index.index_bytes(live.vector_db.index) / 2**20
+        float_mb = total * live.vector_db.index.d * 4 / 2**20
+        print(f"[ingest] index {index_mb:.1f} MiB in RAM (float32 would be {float_mb:.1f} MiB, {float_mb / max(index_mb, 1e-9):.1f}x)")
+    if publish_dir and live.snapshot_dir:
+        print(f"[ingest] published {index_store.publish_snapshot(live.snapshot_dir, publish_dir, keep=SNAPSHOT_KEEP)}")
+    return live
+
+
+def main():
+    parser = argparse.ArgumentParser(description="把 docs/ 目录增量写入磁盘索引快照")
+    parser.add_argument("--docs", default=DOCS_DIR)
+    parser.add_argument("--index", default=INDEX_DIR)
+    parser.add_argument("--workers", type=int, default=EMBED_WORKERS)
+    parser.add_argument("--batch-size", type=int, default=EMBED_BATCH_SIZE)
+    parser.add_argument("--executor", choices=["thread", "process"], default=EMBED_EXECUTOR)
+    parser.add_argument("--window-chars", type=int, default=INGEST_WINDOW_CHARS, help="每个处理窗口的正文字符上限，决定峰值内存")
+    parser.add_argument("--publish", help="构建完成后把快照发布到该索引目录（follow 模式的 app 从这里换入新版本）")
+    parser.add_argument("--shard", help="分片索引（config.INDEX_SHARDS）：只构建该分片，all 为全部分片")
+    parser.add_argument("--categorize-workers", type=int, default=os.cpu_count() or 1,
+                        help="关键词分类的进程数（进程池在各窗口之间复用），1 为串行")
+    args = parser.parse_args()
+    set_categorize_workers(args.categorize_workers)
+    shards = None
+    if args.shard:
+        from sharding import shard_spec, shard_specs
+
+        try:
+            shards = shard_specs() if args.shard == "all" else [shard_spec(args.shard)]
+        except ValueError as e:
+            parser.error(str(e))
+        if not shards:
+            parser.error("config.INDEX_SHARDS 未设置")
+    run_ingest(args.docs, args.index, args.workers, args.batch_size, args.executor, args.window_chars, args.publish, shards)
+
+
+if __name__ == "__main__":
+    main()
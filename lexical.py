@@ -0,0 +1,170 @@
+import math
+import re
+import unicodedata
+from array import array
+from collections import Counter
+
+import numpy as np
+
+# --- 关键词倒排索引（BM25） ---
+# 分词不依赖中文分词器：连续的汉字切成字符二元组（单字则保留单字），拉丁字母与数字按连续片段成词，
+# 统一做 NFKC 归一化并转小写。"AlphaFold" -> ["alphafold"]，"斯多葛" -> ["斯多", "多葛"]。
+# 每个 chunk 占一个槽位，倒排表为 词 -> (槽位数组, 词频数组)，槽位的长度、分类编号与存活标记也各是一个数组，
+# 都用紧凑、可追加的 array 存储；检索时以 numpy 视图（不复制）读取，BM25 按倒排表整段向量化计算。
+# 删除只把槽位标记为空，空槽超过一定比例时整体压缩重排。
+
+_TOKEN = re.compile(r"[a-z0-9]+|[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+")
+
+
+def tokenize(text):
+    tokens = []
+    for match in _TOKEN.finditer(unicodedata.normalize("NFKC", text).lower()):
+        token = match.group()
+        if token.isascii() or len(token) == 1:
+            tokens.append(token)
+        else:
+            tokens.extend(token[i:i + 2] for i in range(len(token) - 1))
+    return tokens
+
+
+class LexicalIndex:
+    """chunk id -> BM25 可检索的倒排索引，与 FAISS 索引中的 chunk 一一对应。"""
+
+    def __init__(self, k1=1.2, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings = {}
+        self.ids = []
+        self.category_codes = array("H")
+        self.category_names = []
+        self.lengths = array("I")
+        self.alive = array("B")
+        self.slot_of = {}
+        self.total_length = 0
+
+    def __len__(self):
+        return len(self.slot_of)
+
+    def __setstate__(self, state):
+        # 早期快照的 lexical.pkl 按槽位保存分类名列表，没有分类编号与存活标记
+        categories = state.pop("categories", None)
+        self.__dict__.update(state)
+        if categories is not None:
+            self.category_names = []
+            self.category_codes = array("H", (self._category_code(c) for c in categories))
+            self.alive = array("B", (_id is not None for _id in self.ids))
+
+    def _category_code(self, category):
+        try:
+            return self.category_names.index(category)
+        except ValueError:
+            self.category_names.append(category)
+            return len(self.category_names) - 1
+
+    @classmethod
+    def from_vector_db(cls, vector_db):
+        # 旧快照没有倒排索引时，从 docstore 中的 chunk 文本重建
+        index = cls()
+        if vector_db is not None:
+            ids = list(vector_db.index_to_docstore_id.values())
+            docs = [vector_db.docstore.search(_id) for _id in ids]
+            index.add(ids, [d.page_content for d in docs], [d.metadata.get('category') for d in docs])
+        return index
+
+    def add(self, ids, texts, categories):
+        for _id, text, category in zip(ids, texts, categories):
+            self.remove([_id])
+            slot = len(self.ids)
+            tokens = tokenize(text)
+            self.ids.append(_id)
+            self.category_codes.append(self._category_code(category))
+            self.lengths.append(len(tokens))
+            self.alive.append(1)
+            self.slot_of[_id] = slot
+            self.total_length += len(tokens)
+            for term, tf in Counter(tokens).items():
+                entry = self.postings.get(term)
+                if entry is None:
+                    entry = self.postings[term] = (array("I"), array("H"))
+                entry[0].append(slot)
+                entry[1].append(min(tf, 65535))
+
+    def remove(self, ids):
+        for _id in ids:
+            slot = self.slot_of.pop(_id, None)
+            if slot is not None:
+                self.ids[slot] = None
+                self.alive[slot] = 0
+                self.total_length -= self.lengths[slot]
+        if len(self.ids) > 1024 and len(self.slot_of) < 0.8 * len(self.ids):
+            self.compact()
+
+    def compact(self):
+        """丢弃已删除的槽位并重新编号，同时修正各词的文档频率。"""
+        remap = {}
+        for slot, _id in enumerate(self.ids):
+            if _id is not None:
+                remap[slot] = len(remap)
+        postings = {}
+        for term, (slots, tfs) in self.postings.items():
+            kept = [(remap[s], tf) for s, tf in zip(slots, tfs) if s in remap]
+            if kept:
+                postings[term] = (array("I", (s for s, _ in kept)), array("H", (tf for _, tf in kept)))
+        self.postings = postings
+        live = sorted(remap)
+        self.ids = [self.ids[s] for s in live]
+        self.category_codes = array("H", (self.category_codes[s] for s in live))
+        self.lengths = array("I", (self.lengths[s] for s in live))
+        self.alive = array("B", [1]) * len(live)
+        self.slot_of = {_id: slot for slot, _id in enumerate(self.ids)}
+
+    def corpus_stats(self):
+        """BM25 的语料统计：chunk 数、总词元数与各词的文档频率。分片索引把各分片的统计相加，得到全局统计。"""
+        return {"n": len(self.slot_of), "total_length": self.total_length,
+                "df": {term: len(slots) for term, (slots, _) in self.postings.items()}}
+
+    def search(self, query, k=5, category=None, corpus=None):
+        """返回 [(chunk id, BM25 分数)]，category 不为 None 时只在该分类的 chunk 中检索。
+
+        corpus（corpus_stats() 的格式，df 只需包含查询词）给出时按它计算 IDF 与平均长度：
+        各分片按同一份全局统计打分，分数在分片之间可比。
+        """
+        if not self.slot_of:
+            return []
+        code = None
+        if category is not None:
+            if category not in self.category_names:
+                return []
+            code = self.category_names.index(category)
+        n, total_length = (corpus["n"], corpus["total_length"]) if corpus else (len(self.slot_of), self.total_length)
+        avg_length = total_length / n
+        k1, b = self.k1, self.b
+        # 视图只在本次检索内使用（调用方持读锁），不会妨碍写者向这些 array 追加
+        lengths = np.frombuffer(self.lengths, dtype=np.uint32)
+        alive = np.frombuffer(self.alive, dtype=np.uint8)
+        codes = np.frombuffer(self.category_codes, dtype=np.uint16) if code is not None else None
+        touched, contributions = [], []
+        for term in set(tokenize(query)):
+            entry = self.postings.get(term)
+            if entry is None:
+                continue
+            slots = np.frombuffer(entry[0], dtype=np.uint32)
+            df = corpus["df"].get(term, len(slots)) if corpus else len(slots)
+            idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+            mask = alive[slots].astype(bool)
+            if codes is not None:
+                mask &= codes[slots] == code
+            slots = slots[mask]
+            tfs = np.frombuffer(entry[1], dtype=np.uint16)[mask].astype(np.float64)
+            norm = k1 * (1 - b + b * lengths[slots] / avg_length)
+            touched.append(slots)
+            contributions.append(idf * tfs * (k1 + 1) / (tfs + norm))
+        if not touched:
+            return []
+        # 同一槽位在各词的倒排表中各出现一次，按槽位把各词的贡献相加
+        slots, inverse = np.unique(np.concatenate(touched), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(contributions), minlength=len(slots))
+        top = np.argsort(-scores, kind="stable")[:k] if len(scores) <= 4 * k else np.argpartition(-scores, k)[:k]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        ids = self.ids
+        return [(ids[slot], float(scores[i])) for slot, i in zip(slots[top].tolist(), top.tolist())]
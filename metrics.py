@@ -0,0 +1,320 @@
+import bisect
+import cProfile
+import io
+import pstats
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+# --- 1. 运行时指标 ---
+# 进程内的计数器与直方图，覆盖导入（ingest_stage_seconds）与查询（query_stage_seconds）的各个阶段：
+#   导入：load、categorize、split、embed、index、lexical、save
+#   查询：embed（模型）、faiss、rescore、lexical、fuse、render（app 渲染）
+# 文档数、chunk 数、缓存命中率等随时读取的量注册为 gauge，导出时才取值。
+# 导出为 Prometheus 文本格式（service.py 的 GET /metrics）或 JSON（GET /metrics.json、app 的诊断面板）。
+#
+# span() 的开销为两次 perf_counter 与一次加锁，可以常开；
+# 另外 trace() 收集当前线程内的各个 span，用于显示单次请求的耗时构成。
+
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key):
+    if not key:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in key) + "}"
+
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # 最后一格为 +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """按桶线性插值估计分位数（与 Prometheus 的 histogram_quantile 相同）。"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if seen + n >= rank and n:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (rank - seen) / n
+            seen += n
+        return self.buckets[-1]
+
+
+class Registry:
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        self.help = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def inc(self, name, value=1, **labels):
+        key = (name, _label_key(labels))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, _label_key(labels))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+        trace = getattr(self._local, "trace", None)
+        if trace is not None and "stage" in labels:
+            trace[labels["stage"]] = trace.get(labels["stage"], 0.0) + value
+
+    def gauge(self, name, fn, label=None, help=None):
+        """注册取值函数。label 为 None 时 fn() 返回一个数，否则返回 {标签值: 数}。同名注册会覆盖。"""
+        self.gauges[name] = (fn, label)
+        if help:
+            self.help[name] = help
+
+    @contextmanager
+    def span(self, name, stage, n=1):
+        """记录一个阶段的耗时到直方图 name（标签 stage），并把处理的条数 n 计入 <name 去掉 _seconds>_items_total。"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, stage=stage)
+            if n:
+                self.inc(name.replace("_seconds", "_items_total"), n, stage=stage)
+
+    @contextmanager
+    def trace(self):
+        """收集本线程在 with 块内各 stage 的累计秒数：with REGISTRY.trace() as stages: ..."""
+        outer = getattr(self._local, "trace", None)
+        stages = {}
+        self._local.trace = stages
+        try:
+            yield stages
+        finally:
+            self._local.trace = outer
+            if outer is not None:
+                for stage, seconds in stages.items():
+                    outer[stage] = outer.get(stage, 0.0) + seconds
+
+    def merge_trace(self, stages):
+        """把在其他线程中收集的 stage 耗时并入本线程当前的 trace（没有 trace 时忽略）。"""
+        trace = getattr(self._local, "trace", None)
+        if trace is not None:
+            for stage, seconds in stages.items():
+                trace[stage] = trace.get(stage, 0.0) + seconds
+
+    def _gauge_values(self):
+        values = {}
+        for name, (fn, label) in list(self.gauges.items()):
+            try:
+                value = fn()
+            except Exception as e:
+                print(f"[metrics] gauge {name} failed: {e}")
+                continue
+            if label is None:
+                values[(name, ())] = value
+            else:
+                for label_value, v in value.items():
+                    values[(name, ((label, label_value),))] = v
+        return values
+
+    def snapshot(self):
+        """JSON 友好的当前值：计数器、gauge，以及直方图的 count/sum/p50/p95/p99（秒）。"""
+        with self._lock:
+            counters = dict(self.counters)
+            histograms = {key: (h.count, h.sum, *(h.quantile(q) for q in (0.5, 0.95, 0.99))) for key, h in self.histograms.items()}
+        result = {"counters": {}, "gauges": {}, "histograms": {}}
+        for (name, key), value in sorted(counters.items()):
+            result["counters"][name + _format_labels(key)] = value
+        for (name, key), value in sorted(self._gauge_values().items()):
+            result["gauges"][name + _format_labels(key)] = value
+        for (name, key), (count, total, p50, p95, p99) in sorted(histograms.items()):
+            result["histograms"][name + _format_labels(key)] = {
+                "count": count, "sum": round(total, 6),
+                **{q: round(v, 6) if v is not None else None for q, v in (("p50", p50), ("p95", p95), ("p99", p99))},
+            }
+        return result
+
+    def to_prometheus(self):
+        """Prometheus 文本格式（exposition format 0.0.4）。"""
+        lines = []
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = [(key, h.buckets, list(h.counts), h.count, h.sum) for key, h in sorted(self.histograms.items())]
+        typed = set()
+
+        def header(name, kind):
+            if name not in typed:
+                typed.add(name)
+                if name in self.help:
+                    lines.append(f"# HELP {name} {self.help[name]}")
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, key), value in counters:
+            header(name, "counter")
+            lines.append(f"{name}{_format_labels(key)} {value}")
+        for (name, key), value in sorted(self._gauge_values().items()):
+            header(name, "gauge")
+            lines.append(f"{name}{_format_labels(key)} {value}")
+        for (name, key), buckets, counts, count, total in histograms:
+            header(name, "histogram")
+            cumulative = 0
+            for bound, n in zip(buckets + (float("inf"),), counts):
+                cumulative += n
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{name}_bucket{_format_labels(key + (('le', le),))} {cumulative}")
+            lines.append(f"{name}_sum{_format_labels(key)} {total}")
+            lines.append(f"{name}_count{_format_labels(key)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def span(stage, n=1):
+    """查询路径上的阶段计时：with span("faiss"): ..."""
+    return REGISTRY.span("query_stage_seconds", stage, n)
+
+
+# --- 2. 分阶段计时 ---
+# 导入管线各阶段（读取、分类、切分、嵌入、写索引……）的累计耗时与次数，供 benchmark.py 等读取。
+# 传入 registry 时同时记入其 ingest_stage_seconds 直方图；未传入计时器时使用 NULL_TIMER，开销可以忽略。
+
+
+class StageTimer:
+    def __init__(self, registry=None):
+        self.seconds = {}
+        self.counts = {}
+        self.registry = registry
+
+    @contextmanager
+    def __call__(self, name, n=1):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start, n)
+
+    def add(self, name, seconds, n=1):
+        self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+        self.counts[name] = self.counts.get(name, 0) + n
+        if self.registry is not None:
+            self.registry.observe("ingest_stage_seconds", seconds, stage=name)
+            if n:
+                self.registry.inc("ingest_stage_items_total", n, stage=name)
+
+    def iterate(self, name, iterable):
+        """逐项计时：生成下一项所花的时间（如读文件、等嵌入结果）计入 name。"""
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add(name, time.perf_counter() - start, 0)
+                return
+            self.add(name, time.perf_counter() - start)
+            yield item
+
+    def report(self):
+        return {name: {"seconds": round(self.seconds[name], 4), "count": self.counts[name]} for name in self.seconds}
+
+
+class _NullTimer:
+    @contextmanager
+    def __call__(self, name, n=1):
+        yield
+
+    def add(self, name, seconds, n=1):
+        pass
+
+    def iterate(self, name, iterable):
+        return iter(iterable)
+
+
+NULL_TIMER = _NullTimer()
+
+
+# --- 3. 运行时剖析 ---
+# 默认关闭，可在运行中开关（service.py 的 POST /profile/start、/profile/stop，app 的诊断面板）：
+#   "cpu"    -> cProfile。cProfile 只统计启用它的线程，因此只剖析包在 capture() 里的代码（查询与同步），
+#               同一时刻只有一个线程在采集，其余调用照常执行
+#   "memory" -> tracemalloc，对所有线程生效；停止时按代码行汇总仍未释放的分配
+
+
+class Profiler:
+    def __init__(self):
+        self.mode = None
+        self._profile = None
+        self._capture_lock = threading.Lock()
+        self._started = None
+
+    def start(self, mode):
+        if mode not in ("cpu", "memory"):
+            raise ValueError(f"unknown profile mode {mode!r}")
+        if self.mode is not None:
+            raise RuntimeError(f"profiling ({self.mode}) already running")
+        if mode == "cpu":
+            self._profile = cProfile.Profile()
+        else:
+            tracemalloc.start(25)
+        self.mode = mode
+        self._started = time.time()
+
+    def stop(self, top=30):
+        """停止采集，返回文本报告。"""
+        mode, self.mode = self.mode, None
+        if mode is None:
+            return "profiling is not running"
+        header = f"# {mode} profile, {time.time() - self._started:.1f}s"
+        if mode == "cpu":
+            with self._capture_lock:
+                profile, self._profile = self._profile, None
+            out = io.StringIO()
+            try:
+                pstats.Stats(profile, stream=out).sort_stats("cumulative").print_stats(top)
+            except TypeError:
+                return header + "\nno samples captured"
+            return header + "\n" + out.getvalue()
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        lines = [header, f"current {current / 2**20:.1f} MiB, peak {peak / 2**20:.1f} MiB"]
+        lines += [str(stat) for stat in snapshot.statistics("lineno")[:top]]
+        return "\n".join(lines)
+
+    @contextmanager
+    def capture(self):
+        acquired = self.mode == "cpu" and self._capture_lock.acquire(blocking=False)
+        profile = self._profile if acquired else None
+        try:
+            if profile is not None:
+                profile.enable()
+            try:
+                yield
+            finally:
+                if profile is not None:
+                    profile.disable()
+        finally:
+            if acquired:
+                self._capture_lock.release()
+
+
+PROFILER = Profiler()
@@ -0,0 +1,199 @@
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+from config import DOCS_DIR, CHUNK_SIZE, EMBEDDING_MODEL, EMBED_BATCH_SIZE
+from config import ONNX_MODEL_DIR, ONNX_QUANTIZE, ONNX_THREADS, ONNX_PARITY_MIN_COSINE
+from corpus_shards import iter_corpus
+
+# --- ONNX Runtime 嵌入后端 ---
+# 把 bge-small-zh-v1.5 导出为 ONNX，可选 int8 动态量化（权重离线量化为 int8，激活在推理时按批量化），
+# 在 CPU 上用 ONNX Runtime 推理，运行时不需要 PyTorch。
+# 池化与 sentence-transformers 中该模型的配置一致：取 [CLS] 位置的向量，再做 L2 归一化。
+#
+#   python onnx_embedder.py export    # 生成 model.onnx、model_int8.onnx 与分词器文件（需要 torch、transformers、onnxruntime）
+#   python onnx_embedder.py check     # 与 torch 参考向量比较余弦相似度与近邻重合度，并对比单条查询延迟与批量吞吐
+# 通过检查后在 config.py 中设置 EMBED_BACKEND = "onnx"。
+
+MODEL_FILE = "model.onnx"
+QUANTIZED_FILE = "model_int8.onnx"
+META_FILE = "export.json"
+MAX_LENGTH = 512
+
+
+class OnnxEmbeddings(Embeddings):
+    # BatchedEmbeddings 据此判断查询与文档编码方式相同（bge 在 HuggingFaceEmbeddings 中也不加查询前缀），整批嵌入查询
+    query_encode_kwargs = {}
+
+    def __init__(self, model_dir=ONNX_MODEL_DIR, quantized=ONNX_QUANTIZE, threads=ONNX_THREADS, max_length=MAX_LENGTH):
+        import onnxruntime as ort
+        from tokenizers import Tokenizer
+
+        path = os.path.join(model_dir, QUANTIZED_FILE if quantized else MODEL_FILE)
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"{path} 不存在，请先运行 python onnx_embedder.py export")
+        meta_path = os.path.join(model_dir, META_FILE)
+        if os.path.exists(meta_path):
+            with open(meta_path, encoding="utf-8") as f:
+                exported = json.load(f).get("model")
+            if exported != EMBEDDING_MODEL:
+                print(f"[onnx] warning: {model_dir} was exported from {exported}, config.EMBEDDING_MODEL is {EMBEDDING_MODEL}")
+
+        options = ort.SessionOptions()
+        # 单个请求内并行（GEMM 按线程切分）；同时处理多个请求由 BatchedEmbeddings 的 workers 控制
+        options.intra_op_num_threads = threads or os.cpu_count() or 1
+        options.inter_op_num_threads = 1
+        options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        self.input_names = {i.name for i in self.session.get_inputs()}
+
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_dir, "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_length)
+        pad_id = self.tokenizer.token_to_id("[PAD]")
+        self.tokenizer.enable_padding(pad_id=pad_id if pad_id is not None else 0, pad_token="[PAD]")
+
+    def _encode(self, texts):
+        # 与 HuggingFaceEmbeddings 相同，先把换行替换为空格
+        encodings = self.tokenizer.encode_batch([text.replace("\n", " ") for text in texts])
+        feeds = {
+            "input_ids": np.array([e.ids for e in encodings], dtype=np.int64),
+            "attention_mask": np.array([e.attention_mask for e in encodings], dtype=np.int64),
+        }
+        if "token_type_ids" in self.input_names:
+            feeds["token_type_ids"] = np.array([e.type_ids for e in encodings], dtype=np.int64)
+        cls = self.session.run(None, feeds)[0][:, 0]
+        return cls / np.maximum(np.linalg.norm(cls, axis=1, keepdims=True), 1e-12)
+
+    def embed_documents(self, texts):
+        if not texts:
+            return []
+        return self._encode(texts).tolist()
+
+    def embed_query(self, text):
+        return self._encode([text])[0].tolist()
+
+
+def export(model_name=EMBEDDING_MODEL, out_dir=ONNX_MODEL_DIR, quantize=True, opset=14):
+    import torch
+    from transformers import AutoModel, AutoTokenizer
+
+    os.makedirs(out_dir, exist_ok=True)
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    tokenizer.save_pretrained(out_dir)
+    model = AutoModel.from_pretrained(model_name).eval()
+    model.config.return_dict = False
+
+    sample = tokenizer(["导出样例", "export sample"], padding=True, return_tensors="pt")
+    names = [name for name in ("input_ids", "attention_mask", "token_type_ids") if name in sample]
+    axes = {name: {0: "batch", 1: "sequence"} for name in names + ["last_hidden_state"]}
+    path = os.path.join(out_dir, MODEL_FILE)
+    with torch.no_grad():
+        torch.onnx.export(model, tuple(sample[name] for name in names), path, input_names=names,
+                          output_names=["last_hidden_state"], dynamic_axes=axes, opset_version=opset)
+    print(f"[onnx] exported {model_name} -> {path} ({os.path.getsize(path) / 2**20:.1f} MiB)")
+
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        from onnxruntime.quantization.shape_inference import quant_pre_process
+
+        # 先做形状推断与图优化（算子融合），量化后的图更小、更快
+        prepared = os.path.join(out_dir, "model_prepared.onnx")
+        quant_pre_process(path, prepared)
+        quantized = os.path.join(out_dir, QUANTIZED_FILE)
+        quantize_dynamic(prepared, quantized, weight_type=QuantType.QInt8, per_channel=True)
+        os.remove(prepared)
+        print(f"[onnx] quantized -> {quantized} ({os.path.getsize(quantized) / 2**20:.1f} MiB)")
+    with open(os.path.join(out_dir, META_FILE), "w", encoding="utf-8") as f:
+        json.dump({"model": model_name, "opset": opset, "quantized": quantize, "time": time.strftime("%Y-%m-%dT%H:%M:%S")}, f)
+
+
+def sample_texts(docs_dir, n, seed=0):
+    """从语料中抽取 chunk 长度的段落，作为对比用的输入。"""
+    texts = []
+    for _, text in iter_corpus(docs_dir):
+        texts.extend(p.strip()[:CHUNK_SIZE] for p in text.split("\n\n") if p.strip())
+    random.Random(seed).shuffle(texts)
+    return texts[:n]
+
+
+def _benchmark(embeddings, texts, batch_size, queries=50):
+    start = time.perf_counter()
+    vectors = []
+    for i in range(0, len(texts), batch_size):
+        vectors.extend(embeddings.embed_documents(texts[i:i + batch_size]))
+    docs_per_s = len(texts) / (time.perf_counter() - start)
+    latencies = []
+    for text in texts[:queries]:
+        start = time.perf_counter()
+        embeddings.embed_query(text[:30])
+        latencies.append((time.perf_counter() - start) * 1000)
+    return np.asarray(vectors, dtype=np.float32), {"docs_per_s": round(docs_per_s, 1),
+                                                   "query_ms_p50": round(float(np.percentile(latencies, 50)), 2)}
+
+
+def check(docs_dir=DOCS_DIR, n=500, model_dir=ONNX_MODEL_DIR, threads=ONNX_THREADS, batch_size=EMBED_BATCH_SIZE,
+          min_cosine=ONNX_PARITY_MIN_COSINE, k=10):
+    """以 torch 向量为参考，检查各 ONNX 变体的余弦相似度与 top-k 近邻重合度。返回 (报告, 是否全部通过)。"""
+    from langchain_huggingface import HuggingFaceEmbeddings
+
+    texts = sample_texts(docs_dir, n)
+    if not texts:
+        raise SystemExit(f"{docs_dir} 中没有可用的文本")
+    reference, report = _benchmark(HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL), texts, batch_size)
+    reference /= np.linalg.norm(reference, axis=1, keepdims=True)
+    results = {"torch": report}
+    truth = np.argsort(-(reference @ reference.T), axis=1)[:, 1:k + 1]
+    passed = True
+    for name, quantized in (("onnx", False), ("onnx-int8", True)):
+        if not os.path.exists(os.path.join(model_dir, QUANTIZED_FILE if quantized else MODEL_FILE)):
+            continue
+        vectors, report = _benchmark(OnnxEmbeddings(model_dir, quantized, threads), texts, batch_size)
+        cosine = (vectors * reference).sum(axis=1) / np.linalg.norm(vectors, axis=1)
+        found = np.argsort(-(vectors @ vectors.T), axis=1)[:, 1:k + 1]
+        overlap = np.mean([len(set(a) & set(b)) / k for a, b in zip(found, truth)])
+        report.update(cosine_min=round(float(cosine.min()), 4), cosine_mean=round(float(cosine.mean()), 4),
+                      **{f"top{k}_overlap": round(float(overlap), 4)})
+        report["pass"] = bool(cosine.min() >= min_cosine)
+        passed &= report["pass"]
+        results[name] = report
+    if len(results) == 1:
+        raise SystemExit(f"{model_dir} 中没有导出的模型，请先运行 python onnx_embedder.py export")
+    return {"texts": len(texts), "min_cosine": min_cosine, "backends": results}, passed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="导出 ONNX 嵌入模型（可选 int8 量化），并检查与 torch 参考向量的一致性")
+    commands = parser.add_subparsers(dest="command", required=True)
+    p = commands.add_parser("export")
+    p.add_argument("--model", default=EMBEDDING_MODEL)
+    p.add_argument("--out", default=ONNX_MODEL_DIR)
+    p.add_argument("--no-quantize", action="store_true")
+    p.add_argument("--opset", type=int, default=14)
+    p = commands.add_parser("check")
+    p.add_argument("--docs", default=DOCS_DIR)
+    p.add_argument("-n", type=int, default=500, help="参与比较的段落数")
+    p.add_argument("--model-dir", default=ONNX_MODEL_DIR)
+    p.add_argument("--threads", type=int, default=ONNX_THREADS)
+    p.add_argument("--batch-size", type=int, default=EMBED_BATCH_SIZE)
+    p.add_argument("--min-cosine", type=float, default=ONNX_PARITY_MIN_COSINE)
+    args = parser.parse_args()
+
+    if args.command == "export":
+        export(args.model, args.out, not args.no_quantize, args.opset)
+        return
+    report, passed = check(args.docs, args.n, args.model_dir, args.threads, args.batch_size, args.min_cosine)
+    print(json.dumps(report, ensure_ascii=False, indent=1))
+    if not passed:
+        print(f"[onnx] parity check failed: cosine below {args.min_cosine}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+import threading
+import time
+from collections import OrderedDict
+
+# --- 查询路径缓存 ---
+# 两级缓存都放在进程内存中，随 st.cache_resource 持有的对象跨 rerun 共享：
+#   查询文本 -> 查询向量              （省掉嵌入模型的前向计算，p99 的主要来源）
+#   (查询, 分类, k, 模式, 索引版本) -> 排好序的检索结果
+# 条目数有上限，按最近使用淘汰；超过 ttl 秒的条目视为过期。索引版本变化后结果缓存整体清空。
+
+
+class LRUCache:
+    def __init__(self, max_entries=1024, ttl=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and self.ttl is not None and time.monotonic() - entry[0] > self.ttl:
+                del self._data[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
@@ -0,0 +1,56 @@
+import threading
+import time
+from contextlib import contextmanager
+
+from metrics import REGISTRY
+
+
+class RWLock:
+    """读写锁：多个读者可并发；写者独占，且有写者等待时新读者让行，避免写者饿死。
+
+    给定 name 时，取锁的等待时间记入 lock_wait_seconds{lock, mode}，用于观察检索与索引更新之间的争用。
+    """
+
+    def __init__(self, name=None):
+        self.name = name
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = False
+        self._writers_waiting = 0
+
+    def _observe(self, mode, start):
+        if self.name is not None:
+            REGISTRY.observe("lock_wait_seconds", time.perf_counter() - start, lock=self.name, mode=mode)
+
+    @contextmanager
+    def read(self):
+        start = time.perf_counter()
+        with self._cond:
+            while self._writer or self._writers_waiting:
+                self._cond.wait()
+            self._readers += 1
+        self._observe("read", start)
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if not self._readers:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def write(self):
+        start = time.perf_counter()
+        with self._cond:
+            self._writers_waiting += 1
+            while self._writer or self._readers:
+                self._cond.wait()
+            self._writers_waiting -= 1
+            self._writer = True
+        self._observe("write", start)
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writer = False
+                self._cond.notify_all()
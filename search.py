@@ -0,0 +1,225 @@
+import faiss
+import numpy as np
+
+from ann_index import rescore, search_parameters
+from config import ALL_CATEGORIES, RESCORE_K_FACTOR, RRF_K, HYBRID_DEPTH, COLLAPSE_BY_SOURCE, COLLAPSE_FETCH_FACTOR
+from metrics import span
+
+# --- 分类过滤检索 ---
+# 过滤条件直接下推到 FAISS：每个分类维护一份 chunk 位置列表，检索时通过 IDSelector
+# 只对该分类的向量计算距离，耗时与分类规模成正比，且一定能取满 k 条（分类内 chunk 足够时）。
+#
+# 检索模式：
+#   "dense"   -> 只用向量检索
+#   "lexical" -> 只用 BM25 倒排索引，不运行嵌入模型
+#   "hybrid"  -> 两路各取 HYBRID_DEPTH 条，按倒数排名融合（RRF）：score = Σ 1 / (RRF_K + rank)
+# COLLAPSE_BY_SOURCE 时先取 k * COLLAPSE_FETCH_FACTOR 条，再按来源文档折叠为 k 篇不同的文档。
+
+
+class CategoryFilter:
+    """某一版本向量库的 分类 -> FAISS 位置 映射。增量同步用 updated 得到新版本的过滤器，不必重新读取 docstore。"""
+
+    def __init__(self, index, positions, tombstones=None):
+        # positions 为 {分类: 升序的位置数组}；tombstones 为 HNSW 中已删除 chunk 的位置（见 ann_index.plan_update），
+        # 它们仍在图中，不过滤时也要排除
+        self.positions = positions
+        self.tombstones = tombstones
+        self._params = {}
+        flat = isinstance(index, faiss.IndexFlat)
+        for category, ids in self.positions.items():
+            # 暴力索引对 IDSelectorArray 有专门的子集扫描路径；其余索引用哈希集合判断成员
+            sel = faiss.IDSelectorArray(ids) if flat else faiss.IDSelectorBatch(ids)
+            # 同时持有 ids，保证 selector 引用的内存在其生命周期内有效
+            self._params[category] = (search_parameters(index, sel), sel, ids)
+        # 不过滤时也要带上 nprobe/efSearch
+        self.default_params = search_parameters(index) if index is not None else None
+        if tombstones is not None:
+            self.default_params = search_parameters(index, faiss.IDSelectorNot(faiss.IDSelectorBatch(tombstones)))
+
+    @classmethod
+    def from_vector_db(cls, vector_db):
+        # 载入快照时逐个读取 chunk 的分类，耗时与 chunk 数成正比
+        if vector_db is None:
+            return cls(None, {})
+        positions = {}
+        for i, _id in vector_db.index_to_docstore_id.items():
+            category = vector_db.docstore.search(_id).metadata.get('category')
+            positions.setdefault(category, []).append(i)
+        tombstones = None
+        if len(vector_db.index_to_docstore_id) < vector_db.index.ntotal:
+            live = np.fromiter(vector_db.index_to_docstore_id, dtype=np.int64)
+            tombstones = np.setdiff1d(np.arange(vector_db.index.ntotal, dtype=np.int64), live)
+        return cls(vector_db.index, {c: np.asarray(sorted(ids), dtype=np.int64) for c, ids in positions.items()}, tombstones)
+
+    def updated(self, index, plan, categories):
+        """按 ann_index.plan_update 的结果得到更新后的过滤器，categories 为新 chunk 的分类（与 plan["positions"] 对应）。
+
+        只做位置数组的运算，原过滤器不变，锁外构建时正在进行的检索照常使用它。
+        """
+        keep, removed = plan["keep"], plan["removed"]
+        positions = {}
+        for category, ids in self.positions.items():
+            if keep is not None:
+                ids = np.searchsorted(keep, ids[np.isin(ids, keep, assume_unique=True)])
+            elif len(removed):
+                ids = np.setdiff1d(ids, removed, assume_unique=True)
+            positions[category] = ids
+        added = {}
+        for position, category in zip(plan["positions"].tolist(), categories):
+            added.setdefault(category, []).append(position)
+        for category, ids in added.items():
+            positions[category] = np.union1d(positions.get(category, np.empty(0, dtype=np.int64)), np.asarray(ids, dtype=np.int64))
+        return CategoryFilter(index, {c: ids for c, ids in positions.items() if len(ids)}, plan["tombstones"])
+
+    def count(self, category):
+        ids = self.positions.get(category)
+        return 0 if ids is None else len(ids)
+
+    def params(self, category):
+        entry = self._params.get(category)
+        return entry[0] if entry else None
+
+
+def _to_docs(vector_db, scores, indices):
+    hits = []
+    for score, i in zip(scores, indices):
+        _id = vector_db.index_to_docstore_id.get(i) if i != -1 else None
+        if _id is None:
+            continue
+        doc = vector_db.docstore.search(_id)
+        hits.append((doc, float(score)))
+    return hits
+
+
+def _deepening_search(vector_db, vector, category, k):
+    # 索引不支持 SearchParameters 时的兜底：逐步加深候选集，直到分类内取满 k 条或已遍历全部
+    ntotal = vector_db.index.ntotal
+    fetch = k * 3
+    while True:
+        scores, indices = vector_db.index.search(vector, min(fetch, ntotal))
+        hits = [(doc, s) for doc, s in _to_docs(vector_db, scores[0], indices[0]) if doc.metadata.get('category') == category]
+        if len(hits) >= k or fetch >= ntotal:
+            return hits[:k]
+        fetch *= 4
+
+
+def search_by_vectors(vector_db, category_filter, vectors, category=ALL_CATEGORIES, k=5, float_vectors=None, k_factor=RESCORE_K_FACTOR):
+    """批量检索：所有查询向量共用一次 FAISS 调用，返回每条查询的 [(Document, L2 距离)]。调用方需持有索引的读锁。
+
+    传入 float_vectors（与索引位置对齐的原始向量）时先取 k * k_factor 个候选，再按精确距离精排。
+    """
+    vectors = np.asarray(vectors, dtype=np.float32).reshape(len(vectors), -1)
+    fetch = k * k_factor if float_vectors is not None and k_factor > 0 else k
+    if category == ALL_CATEGORIES:
+        params = category_filter.default_params
+    elif not category_filter.count(category):
+        return [[] for _ in vectors]
+    else:
+        params = category_filter.params(category)
+    try:
+        with span("faiss", len(vectors)):
+            scores, indices = vector_db.index.search(vectors, fetch, params=params)
+    except RuntimeError:
+        if category == ALL_CATEGORIES:
+            raise
+        return [_deepening_search(vector_db, vector[None, :], category, k) for vector in vectors]
+    results = []
+    with span("rescore" if fetch > k else "collect", len(vectors)):
+        for vector, row_scores, row_indices in zip(vectors, scores, indices):
+            if fetch > k:
+                row_scores, row_indices = rescore(float_vectors, vector, row_indices, k)
+            results.append(_to_docs(vector_db, row_scores, row_indices))
+    return results
+
+
+def search_by_vector(vector_db, category_filter, vector, category=ALL_CATEGORIES, k=5, float_vectors=None, k_factor=RESCORE_K_FACTOR):
+    """返回 [(Document, L2 距离)]，按相关度排序。调用方需持有索引的读锁。"""
+    return search_by_vectors(vector_db, category_filter, [vector], category, k, float_vectors, k_factor)[0]
+
+
+def hit_to_json(doc, score):
+    # 服务接口与批量查询输出共用的结果格式
+    return {
+        "source": doc.metadata['source'],
+        "doc_id": doc.metadata['doc_id'],
+        "category": doc.metadata.get('category'),
+        "content": doc.page_content,
+        # chunk 在全文中的字符区间，客户端可据此高亮；旧快照中没有时为 None
+        "start": doc.metadata.get('start'),
+        "end": doc.metadata.get('end'),
+        # chunk id：分片协调端据此在 RRF 融合时把两路结果中的同一 chunk 合并
+        "id": doc.id,
+        "score": score,
+    }
+
+
+def lexical_search(vector_db, lexical, query, category=ALL_CATEGORIES, k=5, corpus=None):
+    """返回 [(Document, BM25 分数)]。调用方需持有索引的读锁。corpus 见 LexicalIndex.search。"""
+    with span("lexical"):
+        hits = lexical.search(query, k, None if category == ALL_CATEGORIES else category, corpus)
+    return [(vector_db.docstore.search(_id), score) for _id, score in hits]
+
+
+def fuse(result_lists, k=5, rrf_k=RRF_K):
+    """倒数排名融合：只看名次不看分数，L2 距离与 BM25 分数无需归一化到同一尺度。"""
+    # 两路结果按 chunk id 去重（ChunkStore 每次检索都返回新的 Chunk 对象；旧快照的 Document 可能没有 id，按对象去重）
+    scores, docs = {}, {}
+    for hits in result_lists:
+        for rank, (doc, _) in enumerate(hits):
+            key = doc.id or id(doc)
+            scores[key] = scores.get(key, 0.0) + 1.0 / (rrf_k + rank + 1)
+            docs[key] = doc
+    top = sorted(scores, key=scores.get, reverse=True)[:k]
+    return [(docs[key], scores[key]) for key in top]
+
+
+def drop_stale(hits):
+    """去掉原文在上次同步后已被修改或删除的 chunk（chunk_store.Chunk.stale），不展示另一版本原文的切片。
+
+    会读取这些命中的原文；Document（旧快照）没有 stale，总是保留。
+    """
+    return [(doc, score) for doc, score in hits if not getattr(doc, "stale", False)]
+
+
+def collapse(hits, k):
+    """同一来源文档只保留排名最前的 chunk，返回前 k 篇不同文档的命中。"""
+    seen, kept = set(), []
+    for doc, score in hits:
+        source = doc.metadata['source']
+        if source in seen:
+            continue
+        seen.add(source)
+        kept.append((doc, score))
+        if len(kept) == k:
+            break
+    return kept
+
+
+def hybrid_search_many(vector_db, category_filter, lexical, queries, vectors=None, category=ALL_CATEGORIES, k=5, mode="hybrid",
+                       float_vectors=None, depth=HYBRID_DEPTH, collapse_by_source=COLLAPSE_BY_SOURCE):
+    """同一分类、k、模式下的一批查询；向量检索部分合并为一次 FAISS 调用。mode="lexical" 时不需要 vectors。"""
+    if vector_db is None:
+        # 还没有任何 chunk 的索引（空分片、follow 模式尚无快照）
+        return [[] for _ in queries]
+    fetch = k * COLLAPSE_FETCH_FACTOR if collapse_by_source else k
+    if mode == "lexical":
+        results = [lexical_search(vector_db, lexical, query, category, fetch) for query in queries]
+    elif mode == "dense" or lexical is None:
+        results = search_by_vectors(vector_db, category_filter, vectors, category, fetch, float_vectors)
+    else:
+        dense = search_by_vectors(vector_db, category_filter, vectors, category, max(fetch, depth), float_vectors)
+        lexical_hits = [lexical_search(vector_db, lexical, query, category, max(fetch, depth)) for query in queries]
+        with span("fuse", len(queries)):
+            results = [fuse([hits, more], fetch) for hits, more in zip(dense, lexical_hits)]
+    if collapse_by_source:
+        with span("collapse", len(queries)):
+            results = [collapse(hits, k) for hits in results]
+    with span("text", len(queries)):
+        return [drop_stale(hits) for hits in results]
+
+
+def hybrid_search(vector_db, category_filter, lexical, query, vector=None, category=ALL_CATEGORIES, k=5, mode="hybrid",
+                  float_vectors=None, depth=HYBRID_DEPTH, collapse_by_source=COLLAPSE_BY_SOURCE):
+    """按 mode 检索，返回 [(Document, 分数)]。mode="lexical" 时不需要 vector。调用方需持有索引的读锁。"""
+    return hybrid_search_many(vector_db, category_filter, lexical, [query], [vector], category, k, mode, float_vectors, depth,
+                              collapse_by_source)[0]
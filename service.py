@@ -0,0 +1,318 @@
+import argparse
+import asyncio
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote
+
+from config import DOCS_DIR, INDEX_DIR, SYNC_INTERVAL, SEARCH_MODE, SEARCH_MODES, SEARCH_MAX_K, ALL_CATEGORIES, INDEX_MODE
+from config import COLLAPSE_FETCH_FACTOR, HYBRID_DEPTH
+from config import SERVICE_HOST, SERVICE_PORT, SERVICE_SOCKET, BATCH_WINDOW_MS, BATCH_MAX_SIZE, SERVING_QUEUE_SIZE, SERVING_TIMEOUT
+from metrics import PROFILER, REGISTRY
+from search import hit_to_json
+from serving import Overloaded
+from sharding import shard_call, shard_index_dir, shard_spec
+
+# --- 独立检索服务 ---
+# 在本地 TCP 端口或 Unix socket 上提供 HTTP/JSON 接口，app.py 可作为瘦客户端连接（见 config.SERVICE_URL）。
+# 并发到达的查询先进入队列，在 BATCH_WINDOW_MS 毫秒的窗口内攒成一批（最多 BATCH_MAX_SIZE 条），
+# 整批查询一次前向计算嵌入、按分类合并为一次 FAISS 调用，多用户并发时吞吐远高于逐条处理。
+# 等待攒批的队列有界（SERVING_QUEUE_SIZE）：队满时 /search 立即返回 503，排队超过 SERVING_TIMEOUT 秒的请求
+# 也返回 503（{"reason": "queue_full" | "timeout"}），过载时尾延迟保持稳定而不是无限增长。
+#
+#   GET  /health              -> {"ok": true}
+#   GET  /stats               -> 文档数、各分类文档数、缓存命中率、批处理统计
+#   GET  /doc/<doc_id>        -> {"doc_id": ..., "text": ...}
+#   POST /search              -> 请求 {"query", "category"?, "k"?, "mode"?}，返回 {"hits": [...], "ms", "stages"}；
+#                                k 须为正整数（超过 SEARCH_MAX_K 时按上限处理），否则返回 400
+#   POST /search/parts        -> 请求 {"requests": [[query, category, depth, mode], ...], "vectors": [...] | null, "corpora": [...] | null}，
+#                                返回 {"parts": [{"dense": [...], "lexical": [...]}, ...]}；分片协调端（sharding.RemoteShard）调用，
+#                                查询向量与全局 BM25 统计由调用方给出
+#   POST /shard/state         -> 请求 {"since": 版本 | null}，返回分片节点的 {"ready", "version", "lexical"}，分片协调端在后台轮询
+#   GET  /metrics             -> Prometheus 文本格式的计数器、直方图与 gauge（见 metrics.py）
+#   GET  /metrics.json        -> 同上，JSON 格式，直方图给出 p50/p95/p99
+#   POST /profile/start       -> 请求 {"mode": "cpu" | "memory"}，开始运行时剖析
+#   POST /profile/stop        -> 停止剖析，返回文本报告
+
+_ENDPOINTS = {"/health", "/stats", "/search", "/search/parts", "/shard/state", "/metrics", "/metrics.json", "/profile/start", "/profile/stop"}
+_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 500: "Internal Server Error",
+            503: "Service Unavailable"}
+
+
+# /search/parts 的 depth 由分片协调端按 k 算出（见 sharding.ShardedIndex），上限随之放宽
+_MAX_DEPTH = max(SEARCH_MAX_K * COLLAPSE_FETCH_FACTOR, HYBRID_DEPTH)
+
+
+def _bounded_k(value, limit):
+    # JSON 中的 k 须为正整数（不接受 true、5.5、"5"），超过 limit 时按 limit 处理，不让超大的 k 进入 FAISS
+    if isinstance(value, bool) or not isinstance(value, int) or value < 1:
+        raise ValueError(f"k must be a positive integer, got {value!r}")
+    return min(value, limit)
+
+
+def _search_item(request):
+    query, category, mode = request["query"], request.get("category", ALL_CATEGORIES), request.get("mode", SEARCH_MODE)
+    if not isinstance(query, str) or not isinstance(category, str):
+        raise ValueError("query and category must be strings")
+    if mode not in SEARCH_MODES:
+        raise ValueError(f"unknown mode {mode!r}")
+    return query, category, _bounded_k(request.get("k", 5), SEARCH_MAX_K), mode
+
+
+class MicroBatcher:
+    """把并发提交的请求按时间窗口攒批，交给 fn(list) 在线程池中一次处理。同一时刻只有一批在处理。
+
+    队列最多容纳 queue_size 个请求，队满时 submit 抛出 Overloaded；排队超过 timeout 秒的请求不再处理。
+    """
+
+    def __init__(self, fn, window_ms=BATCH_WINDOW_MS, max_size=BATCH_MAX_SIZE, queue_size=SERVING_QUEUE_SIZE, timeout=SERVING_TIMEOUT):
+        self.fn = fn
+        self.window = window_ms / 1000
+        self.max_size = max_size
+        self.timeout = timeout
+        self.batches = 0
+        self.items = 0
+        self._queue = asyncio.Queue(maxsize=queue_size)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="batch")
+
+    async def submit(self, item):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        try:
+            self._queue.put_nowait((item, future, loop.time()))
+        except asyncio.QueueFull:
+            REGISTRY.inc("serving_rejected_total", reason="queue_full")
+            raise Overloaded("queue_full") from None
+        return await future
+
+    def _admit(self, batch, now):
+        # 排队时间计入 serving_wait_seconds；超时的请求直接以 Overloaded 结束
+        admitted = []
+        for item, future, enqueued in batch:
+            REGISTRY.observe("serving_wait_seconds", now - enqueued)
+            if now - enqueued > self.timeout:
+                REGISTRY.inc("serving_rejected_total", reason="timeout")
+                if not future.done():
+                    future.set_exception(Overloaded("timeout"))
+            else:
+                admitted.append((item, future))
+        return admitted
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.window
+            while len(batch) < self.max_size:
+                # 上一批处理期间到达的请求已在队列中，直接取走，不再等待
+                if not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
+                    continue
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            batch = self._admit(batch, loop.time())
+            if not batch:
+                continue
+            self.batches += 1
+            self.items += len(batch)
+            try:
+                results = await loop.run_in_executor(self._executor, self._call, [item for item, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+    def _call(self, items):
+        # 整批在同一线程内处理，各阶段耗时（embed/faiss/lexical/...）随结果返回，由批内每条请求共享
+        with REGISTRY.trace() as stages:
+            results = self.fn(items)
+        return [(result, stages) for result in results]
+
+    def stats(self):
+        return {"batches": self.batches, "queries": self.items, "mean_batch": self.items / self.batches if self.batches else 0.0,
+                "queued": self._queue.qsize()}
+
+
+class RetrievalService:
+    def __init__(self, live, window_ms=BATCH_WINDOW_MS, max_size=BATCH_MAX_SIZE, queue_size=SERVING_QUEUE_SIZE, timeout=SERVING_TIMEOUT):
+        self.live = live
+        self.batcher = MicroBatcher(self._search_json, window_ms, max_size, queue_size, timeout)
+        # /stats、/doc 等轻量请求不进批处理队列，但也不能阻塞事件循环
+        self._io = ThreadPoolExecutor(max_workers=4, thread_name_prefix="io")
+        REGISTRY.gauge("service_batches", lambda: self.batcher.batches)
+        REGISTRY.gauge("service_mean_batch", lambda: self.batcher.stats()["mean_batch"])
+        REGISTRY.gauge("serving_queue_depth", lambda: self.batcher.stats()["queued"], help="Requests waiting to be batched")
+
+    def _search_json(self, items):
+        # 在批处理线程中序列化命中：chunk 文本（Chunk.page_content）按需从原文读取，事件循环线程不碰磁盘
+        return [[hit_to_json(doc, score) for doc, score in hits] for hits in self.live.search_many(items)]
+
+    async def route(self, method, path, body):
+        loop = asyncio.get_running_loop()
+        if path == "/health":
+            return 200, {"ok": True, "ready": self.live.ready, **({"warmup": self.live.status()} if hasattr(self.live, "status") else {})}
+        if path == "/stats":
+            stats = await loop.run_in_executor(self._io, self.live.stats)
+            return 200, dict(stats, batching=self.batcher.stats())
+        if path.startswith("/doc/"):
+            try:
+                doc_id = int(unquote(path[len("/doc/"):]))
+            except ValueError:
+                return 400, {"error": "doc_id must be an integer"}
+            text = await loop.run_in_executor(self._io, self.live.read_text, doc_id)
+            return (200, {"doc_id": doc_id, "text": text}) if text is not None else (404, {"error": "not found"})
+        if path == "/search":
+            if method != "POST":
+                return 405, {"error": "use POST"}
+            try:
+                item = _search_item(json.loads(body or b"{}"))
+            except (ValueError, KeyError, TypeError) as e:
+                return 400, {"error": f"bad request: {e}"}
+            start = time.perf_counter()
+            try:
+                hits, stages = await self.batcher.submit(item)
+            except Overloaded as e:
+                return 503, {"error": str(e), "reason": e.reason}
+            return 200, {
+                "hits": hits,
+                "ms": (time.perf_counter() - start) * 1000,
+                "stages": {stage: seconds * 1000 for stage, seconds in stages.items()},
+            }
+        if path == "/search/parts":
+            if method != "POST":
+                return 405, {"error": "use POST"}
+            try:
+                request = json.loads(body or b"{}")
+                items = [(query, category, _bounded_k(depth, _MAX_DEPTH), mode) for query, category, depth, mode in request["requests"]]
+                vectors = request.get("vectors")
+                corpora = request.get("corpora")
+            except (ValueError, KeyError, TypeError) as e:
+                return 400, {"error": f"bad request: {e}"}
+            # 已经是一批，且带有查询向量，不再进入攒批队列
+            try:
+                parts = await loop.run_in_executor(self._io, shard_call, self.live, "search_parts", (items, vectors, corpora))
+            except Overloaded as e:
+                return 503, {"error": str(e), "reason": e.reason}
+            return 200, {"parts": parts}
+        if path == "/shard/state":
+            if method != "POST":
+                return 405, {"error": "use POST"}
+            since = json.loads(body or b"{}").get("since")
+            return 200, await loop.run_in_executor(self._io, self.live.shard_state, since)
+        if path == "/metrics":
+            return 200, await loop.run_in_executor(self._io, REGISTRY.to_prometheus)
+        if path == "/metrics.json":
+            return 200, await loop.run_in_executor(self._io, REGISTRY.snapshot)
+        if path in ("/profile/start", "/profile/stop"):
+            if method != "POST":
+                return 405, {"error": "use POST"}
+            if path == "/profile/stop":
+                return 200, await loop.run_in_executor(self._io, PROFILER.stop)
+            try:
+                PROFILER.start(json.loads(body or b"{}").get("mode", "cpu"))
+            except (ValueError, RuntimeError) as e:
+                return 400, {"error": str(e)}
+            return 200, {"profiling": PROFILER.mode}
+        return 404, {"error": "not found"}
+
+    @staticmethod
+    def _endpoint(path):
+        # 直方图标签只用固定的路由名，/doc/<id> 不按 id 展开，未知路径归为 other
+        if path.startswith("/doc/"):
+            return "/doc"
+        return path if path in _ENDPOINTS else "other"
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                path = target.split("?", 1)[0]
+                start = time.perf_counter()
+                try:
+                    status, payload = await self.route(method, path, body)
+                except Exception as e:
+                    status, payload = 500, {"error": str(e)}
+                REGISTRY.observe("service_request_seconds", time.perf_counter() - start, endpoint=self._endpoint(path))
+                REGISTRY.inc("service_requests_total", endpoint=self._endpoint(path), status=status)
+                # 文本报告（/metrics、剖析结果）原样返回，其余为 JSON
+                if isinstance(payload, str):
+                    data, content_type = payload.encode("utf-8"), "text/plain; version=0.0.4; charset=utf-8"
+                else:
+                    data, content_type = json.dumps(payload, ensure_ascii=False).encode("utf-8"), "application/json; charset=utf-8"
+                writer.write(
+                    f"HTTP/1.1 {status} {_REASONS[status]}\r\n"
+                    f"Content-Type: {content_type}\r\nContent-Length: {len(data)}\r\n\r\n".encode("latin-1") + data
+                )
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host=SERVICE_HOST, port=SERVICE_PORT, socket_path=SERVICE_SOCKET):
+        self._batch_task = asyncio.get_running_loop().create_task(self.batcher.run())
+        if socket_path:
+            server = await asyncio.start_unix_server(self.handle, path=socket_path)
+            print(f"[service] listening on unix:{socket_path}")
+        else:
+            server = await asyncio.start_server(self.handle, host, port)
+            print(f"[service] listening on http://{host}:{port}")
+        async with server:
+            await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="以 HTTP/JSON 服务的形式提供检索，并发查询按时间窗口合并批处理")
+    parser.add_argument("--docs", default=DOCS_DIR)
+    parser.add_argument("--index", default=INDEX_DIR)
+    parser.add_argument("--host", default=SERVICE_HOST)
+    parser.add_argument("--port", type=int, default=SERVICE_PORT)
+    parser.add_argument("--socket", default=SERVICE_SOCKET, help="改为监听 Unix socket 路径")
+    parser.add_argument("--window-ms", type=float, default=BATCH_WINDOW_MS)
+    parser.add_argument("--max-batch", type=int, default=BATCH_MAX_SIZE)
+    parser.add_argument("--queue-size", type=int, default=SERVING_QUEUE_SIZE, help="等待攒批的请求上限，队满时返回 503")
+    parser.add_argument("--timeout", type=float, default=SERVING_TIMEOUT, help="请求最长排队秒数，超过时返回 503")
+    parser.add_argument("--index-mode", choices=["sync", "follow"], default=INDEX_MODE,
+                        help="follow：不同步 docs/，只换入 python ingest.py 写出的新快照")
+    parser.add_argument("--shard", help="只服务分片索引（config.INDEX_SHARDS）中的一个分片，供其他节点的 SHARD_URLS 连接")
+    args = parser.parse_args()
+
+    from warmup import WarmupIndex
+
+    index_dir, spec = args.index, None
+    if args.shard:
+        try:
+            spec = shard_spec(args.shard)
+        except ValueError as e:
+            parser.error(str(e))
+        index_dir = shard_index_dir(args.index, spec.name)
+    # 先开始监听，模型与索引在后台载入；/health 的 ready 在两者都就绪后才为 true，可直接用作就绪探针
+    live = WarmupIndex(args.docs, index_dir, SYNC_INTERVAL, mode=args.index_mode, shard=spec)
+    service = RetrievalService(live, args.window_ms, args.max_batch, args.queue_size, args.timeout)
+    asyncio.run(service.serve(args.host, args.port, args.socket))
+
+
+if __name__ == "__main__":
+    main()
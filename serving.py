@@ -0,0 +1,102 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from config import SERVING_WORKERS, SERVING_QUEUE_SIZE, SERVING_TIMEOUT, SERVING_SEARCH_THREADS, SERVING_EMBED_THREADS
+from metrics import REGISTRY
+
+# --- 在线检索的并发控制 ---
+# Streamlit 的每个会话在自己的线程中执行脚本，st.cache_resource 让所有会话共享同一份索引与模型。
+# 多个用户同时检索时，每个请求各自启动一组 OpenMP（FAISS）与 PyTorch 推理线程，线程数远超核数，
+# 互相抢占、频繁切换，尾延迟随并发急剧上升。ServingPool 把检索交给固定数量的工作线程：
+#   并发   -> 同时执行的检索不超过 SERVING_WORKERS 个，每个线程的 FAISS 线程数为 SERVING_SEARCH_THREADS
+#   排队   -> 其余请求在有界队列中等待；队满时立即拒绝（reason="queue_full"），
+#             排队超过 SERVING_TIMEOUT 秒仍未开始的请求放弃（reason="timeout"），两者都抛出 Overloaded
+#   指标   -> serving_queue_depth、serving_active（gauge），serving_wait_seconds（排队时间），
+#             serving_rejected_total{reason}
+# 与索引更新的并发安全仍由 LiveIndex 的读写锁保证：检索持读锁，sync / 换入新快照持写锁。
+
+
+class Overloaded(RuntimeError):
+    """请求被拒绝：队列已满或排队超时。reason 为 "queue_full" 或 "timeout"。"""
+
+    def __init__(self, reason):
+        super().__init__(f"overloaded: {reason}")
+        self.reason = reason
+
+
+def serving_threads(configured, workers=SERVING_WORKERS):
+    """每个检索线程可用的计算线程数：未配置（0）时按核数平分给各工作线程。"""
+    return configured or max(1, (os.cpu_count() or 1) // max(workers, 1))
+
+
+def embed_threads(workers=SERVING_WORKERS):
+    return serving_threads(SERVING_EMBED_THREADS, workers)
+
+
+def _init_search_thread(threads):
+    # OpenMP 的线程数是每个线程各自的设置，须在工作线程内设置
+    import faiss
+
+    faiss.omp_set_num_threads(threads)
+
+
+class ServingPool:
+    """有界队列 + 固定并发的执行器。run() 在调用线程中等待结果，排队与执行的耗时都计入指标。"""
+
+    def __init__(self, workers=SERVING_WORKERS, queue_size=SERVING_QUEUE_SIZE, timeout=SERVING_TIMEOUT,
+                 search_threads=SERVING_SEARCH_THREADS, name="serving"):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.search_threads = serving_threads(search_threads, workers)
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name,
+                                            initializer=_init_search_thread, initargs=(self.search_threads,))
+        self._lock = threading.Lock()
+        self.queued = 0
+        self.active = 0
+        REGISTRY.gauge("serving_queue_depth", lambda: self.queued, help="Requests waiting for a serving worker")
+        REGISTRY.gauge("serving_active", lambda: self.active, help="Requests being executed")
+
+    def run(self, fn, *args, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        with self._lock:
+            # 队列之外另有 workers 个执行名额（工作线程刚启动、尚未取走任务时也计入）
+            if self.queued + self.active >= self.workers + self.queue_size:
+                REGISTRY.inc("serving_rejected_total", reason="queue_full")
+                raise Overloaded("queue_full")
+            self.queued += 1
+        enqueued = time.perf_counter()
+        started = threading.Event()
+
+        def task():
+            with self._lock:
+                self.queued -= 1
+                self.active += 1
+            started.set()
+            REGISTRY.observe("serving_wait_seconds", time.perf_counter() - enqueued)
+            try:
+                # stage 耗时在工作线程中收集，交回调用线程（app 据此显示本次查询的耗时构成）
+                with REGISTRY.trace() as stages:
+                    return fn(*args), stages
+            finally:
+                with self._lock:
+                    self.active -= 1
+
+        future = self._executor.submit(task)
+        if not started.wait(timeout) and future.cancel():
+            # 取消成功说明任务还在队列中，从未开始执行
+            with self._lock:
+                self.queued -= 1
+            REGISTRY.inc("serving_rejected_total", reason="timeout")
+            REGISTRY.observe("serving_wait_seconds", time.perf_counter() - enqueued)
+            raise Overloaded("timeout")
+        result, stages = future.result()
+        REGISTRY.merge_trace(stages)
+        return result
+
+    def stats(self):
+        with self._lock:
+            return {"workers": self.workers, "queue_size": self.queue_size, "queued": self.queued, "active": self.active,
+                    "search_threads": self.search_threads}
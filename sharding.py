@@ -0,0 +1,467 @@
+import itertools
+import multiprocessing
+import os
+import re
+import threading
+import time
+import zlib
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from langchain_core.documents import Document
+
+from categorizer import DEFAULT_CATEGORY, DISPLAY_CATEGORIES
+from config import ALL_CATEGORIES, CLASSIFIER_MODE, INDEX_MODE, INDEX_POLL_INTERVAL, INDEX_SHARDS, SHARD_URLS, SYNC_INTERVAL
+from config import COLLAPSE_BY_SOURCE, COLLAPSE_FETCH_FACTOR, HYBRID_DEPTH, RESULT_CACHE_SIZE, RESULT_CACHE_TTL
+from embedder import embeddings_ready
+from embedding_cache import embed_queries, normalize_text
+from lexical import tokenize
+from metrics import PROFILER, REGISTRY, span
+from query_cache import LRUCache
+from search import collapse, fuse, hit_to_json
+
+# --- 分片索引：分散检索、合并结果 ---
+# INDEX_SHARDS = "category" 时每个分类（DISPLAY_CATEGORIES 加默认分类）一个分片；为整数 N 时按来源路径的哈希分成 N 片。
+# 每个分片是 index/shards/<名称>/ 下一个独立的快照目录（自己的 CURRENT、manifest、向量与倒排索引），
+# 可以单独构建与发布：python ingest.py --shard <名称>。
+#
+# 查询时 ShardedIndex（app / service 进程内）只运行一次查询嵌入，把查询与向量发给各分片的工作进程
+# （或 SHARD_URLS 中的远程 service.py --shard）。各分片并行检索，向量与 BM25 两路各返回未融合、未折叠的前 depth 条，
+# 协调端把各分片的同一路结果合并为全局的前 depth 条，再与单一索引一样做 RRF 融合、按来源折叠：
+#   dense   -> L2 距离在分片之间可比
+#   lexical -> BM25 的文档频率、chunk 数与平均长度使用全局统计（各分片 LexicalIndex.corpus_stats 之和），分数可比
+#   hybrid  -> 两路各自全局合并后只融合一次，结果与单一索引一致
+# 带分类过滤的查询在按分类分片时只发给该分类的分片。
+# doc_id 在分片内编号，对外使用 本地 doc_id * 分片数 + 分片序号。
+# 分片的就绪状态、索引版本与 BM25 语料统计由工作进程在变化时主动推送（远程分片由协调端在后台轮询 /shard/state），
+# ShardedIndex.ready 与全局统计只读缓存的状态，不发起请求；分片更新后的约一秒内仍按旧统计打分。
+
+
+def _slug(name):
+    return re.sub(r"[^0-9a-zA-Z]+", "-", name).strip("-").lower()
+
+
+class ShardSpec:
+    """一个分片负责哪些文档。owns_path 在读取文件前按路径判断（无法判断时为 None），owns 在分类之后判断。"""
+
+    def __init__(self, name, category=None, bucket=None, buckets=None):
+        self.name = name
+        self.category = category
+        self.bucket = bucket
+        self.buckets = buckets
+
+    @property
+    def key(self):
+        # 写入 manifest：分片定义变化（分类规则、分片数）时旧快照不再兼容
+        return f"category:{self.category}" if self.category is not None else f"hash:{self.bucket}/{self.buckets}"
+
+    def owns_path(self, path):
+        if self.category is not None:
+            return None
+        return zlib.crc32(path.encode("utf-8")) % self.buckets == self.bucket
+
+    def owns(self, doc):
+        if self.category is not None:
+            return doc.metadata['category'] == self.category
+        return self.owns_path(doc.metadata['source'])
+
+    def select(self, files):
+        """manifest 的 files 中去掉按路径就能确定不属于本分片的文件，这些文件不会被读取。"""
+        return {path: entry for path, entry in files.items() if self.owns_path(path) is not False}
+
+
+def shard_specs(mode=INDEX_SHARDS):
+    if not mode:
+        return []
+    if mode == "category":
+        # 向量分类会在嵌入之后改变文档的分类，而分片归属在切分之前就要确定
+        if CLASSIFIER_MODE == "centroid":
+            raise ValueError('INDEX_SHARDS = "category" requires CLASSIFIER_MODE = "keyword"')
+        return [ShardSpec(_slug(category), category=category) for category in DISPLAY_CATEGORIES + [DEFAULT_CATEGORY]]
+    buckets = int(mode)
+    return [ShardSpec(f"{i:02d}", bucket=i, buckets=buckets) for i in range(buckets)]
+
+
+def shard_spec(name, mode=INDEX_SHARDS):
+    for spec in shard_specs(mode):
+        if spec.name == name:
+            return spec
+    raise ValueError(f"unknown shard {name!r}; available: {[spec.name for spec in shard_specs(mode)]}")
+
+
+def shard_index_dir(index_dir, name):
+    return os.path.join(index_dir, "shards", name)
+
+
+# --- 分片端：工作进程与 service.py --shard 共用 ---
+
+_NOTIFY_INTERVAL = 1.0  # 工作进程检查就绪状态与索引版本的间隔（秒），有变化才推送
+
+
+def shard_state(live, since=None):
+    """分片是否就绪、当前索引版本与 BM25 语料统计（LexicalIndex.corpus_stats）。版本等于 since 时统计没有变化，为 None。"""
+    if live is None:
+        return {"ready": False, "version": None, "lexical": None}
+    with live.lock.read():
+        lexical = live.lexical.corpus_stats() if live.version != since else None
+        return {"ready": live.ready, "version": live.version, "lexical": lexical}
+
+
+def shard_call(live, method, args):
+    """在分片的索引上执行一次调用。live 尚未载入时返回空结果。结果只含可序列化的数据。"""
+    if method == "search_parts":
+        requests, vectors, corpora = args
+        if live is None:
+            return [{} for _ in requests]
+        return [{part: [hit_to_json(doc, score) for doc, score in hits] for part, hits in parts.items()}
+                for parts in live.search_parts(requests, vectors, corpora)]
+    if method == "state":
+        return shard_state(live, *args)
+    if method == "stats":
+        if live is None:
+            return {"docs": 0, "categories": {}, "ready": False, "version": 0, "snapshot": None}
+        return live.stats()
+    if method == "read_text":
+        return live.read_text(args[0]) if live is not None else None
+    raise ValueError(f"unknown method {method!r}")
+
+
+def _worker_main(conn, docs_dir, index_dir, name, index_mode, threads):
+    import faiss
+
+    # 各分片进程平分 CPU，避免 OpenMP 线程互相抢占
+    faiss.omp_set_num_threads(threads)
+    state = {"live": None}
+    send_lock = threading.Lock()
+
+    def send(message):
+        # 应答与状态推送来自不同线程
+        with send_lock:
+            conn.send(message)
+
+    def notify():
+        # 请求编号为 None 的消息是状态推送；语料统计只在索引版本变化时随状态发送
+        last = (None, None)
+        while True:
+            current = shard_state(state["live"], since=last[1])
+            if (current["ready"], current["version"]) != last:
+                try:
+                    send((None, True, current))
+                except (OSError, ValueError):
+                    return
+                last = (current["ready"], current["version"])
+            time.sleep(_NOTIFY_INTERVAL)
+
+    def load():
+        try:
+            from ingest import follow_live_index, open_live_index
+
+            shard_dir = shard_index_dir(index_dir, name)
+            if index_mode == "follow":
+                # 查询向量由协调进程给出，工作进程不加载嵌入模型
+                live = follow_live_index(docs_dir, shard_dir, None)
+                state["live"] = live
+                live.start_follower(INDEX_POLL_INTERVAL)
+            else:
+                from embedder import make_embeddings
+
+                # 模型只在分片有文档需要嵌入时才加载（查询向量由协调进程给出），推理线程数与 FAISS 一样按分片平分
+                embeddings = make_embeddings(lazy=True, threads=threads)
+                live = open_live_index(docs_dir, shard_dir, embeddings, sync=False, shard=shard_spec(name))
+                state["live"] = live
+                live.sync()
+                live.start_watcher(SYNC_INTERVAL)
+        except Exception as e:
+            print(f"[shard {name}] load failed: {e}")
+
+    threading.Thread(target=load, name=f"shard-{name}-load", daemon=True).start()
+    threading.Thread(target=notify, name=f"shard-{name}-notify", daemon=True).start()
+    while True:
+        try:
+            req_id, method, args = conn.recv()
+        except EOFError:
+            return
+        try:
+            send((req_id, True, shard_call(state["live"], method, args)))
+        except Exception as e:
+            send((req_id, False, f"{type(e).__name__}: {e}"))
+
+
+class _ShardState:
+    """分片最近一次推送（或轮询得到）的状态 {"ready", "version"} 与 BM25 语料统计 corpus。"""
+
+    def __init__(self):
+        self.state = {"ready": False, "version": None}
+        self.corpus = None
+
+    def _set_state(self, state):
+        state = dict(state)
+        # 统计只在索引版本变化时给出，其余时候沿用上一份
+        corpus = state.pop("lexical", None)
+        if corpus is not None:
+            self.corpus = corpus
+        self.state = state
+
+
+class ProcessShard(_ShardState):
+    """本机的分片工作进程。call() 立即返回 Future，多个请求可以同时在途，由接收线程按请求编号交付结果。"""
+
+    def __init__(self, name, docs_dir, index_dir, index_mode=INDEX_MODE, threads=1):
+        super().__init__()
+        self.name = name
+        context = multiprocessing.get_context("spawn")
+        self._conn, child = context.Pipe()
+        self.process = context.Process(target=_worker_main, args=(child, docs_dir, index_dir, name, index_mode, threads),
+                                       name=f"shard-{name}", daemon=True)
+        self.process.start()
+        child.close()
+        self._ids = itertools.count()
+        self._pending = {}
+        self._lock = threading.Lock()
+        threading.Thread(target=self._receive, name=f"shard-{name}-recv", daemon=True).start()
+
+    def call(self, method, *args):
+        future = Future()
+        with self._lock:
+            req_id = next(self._ids)
+            self._pending[req_id] = future
+            self._conn.send((req_id, method, args))
+        return future
+
+    def _receive(self):
+        while True:
+            try:
+                req_id, ok, value = self._conn.recv()
+            except (EOFError, OSError):
+                break
+            if req_id is None:
+                self._set_state(value)
+                continue
+            with self._lock:
+                future = self._pending.pop(req_id)
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(RuntimeError(f"shard {self.name}: {value}"))
+        self._set_state({"ready": False, "version": None, "error": "exited"})
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        for future in pending.values():
+            future.set_exception(RuntimeError(f"shard {self.name} exited"))
+
+
+class RemoteShard(_ShardState):
+    """运行在其他节点上的分片（python service.py --shard <名称>），接口与 ProcessShard 相同。"""
+
+    def __init__(self, name, url, workers=4, poll_interval=INDEX_POLL_INTERVAL):
+        from client import ServiceClient
+
+        super().__init__()
+        self.name = name
+        self.client = ServiceClient(url)
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"shard-{name}")
+        threading.Thread(target=self._poll, args=(poll_interval,), name=f"shard-{name}-poll", daemon=True).start()
+
+    def _poll(self, interval):
+        # 远程节点无法主动推送，由后台线程轮询其状态
+        while True:
+            try:
+                self._set_state(self.client.shard_state(self.state["version"]))
+            except (OSError, ValueError) as e:
+                self._set_state({"ready": False, "version": None, "error": str(e)})
+            time.sleep(interval)
+
+    def call(self, method, *args):
+        fn = {"search_parts": self.client.search_parts, "stats": self.client.stats, "read_text": self.client.read_text}[method]
+        return self._pool.submit(fn, *args)
+
+
+# --- 协调端 ---
+
+class ShardedIndex:
+    """各分片的门面，接口与 LiveIndex 中 app / service 用到的部分一致。"""
+
+    def __init__(self, docs_dir, index_dir, embeddings, index_mode=INDEX_MODE, mode=INDEX_SHARDS, urls=SHARD_URLS):
+        self.embeddings = embeddings
+        self.specs = shard_specs(mode)
+        threads = max(1, (os.cpu_count() or 1) // len(self.specs))
+        self.shards = [
+            RemoteShard(spec.name, urls[spec.name]) if spec.name in urls
+            else ProcessShard(spec.name, docs_dir, index_dir, index_mode, threads)
+            for spec in self.specs
+        ]
+        self._by_category = {spec.category: i for i, spec in enumerate(self.specs) if spec.category is not None}
+        self._corpus_lock = threading.Lock()
+        self._corpus_from = [None] * len(self.shards)
+        self._corpus = None
+        # 与 LiveIndex 相同的结果缓存，键中的版本为各分片索引版本组成的元组；任一分片换了版本时整体清空
+        self.result_cache = LRUCache(RESULT_CACHE_SIZE, RESULT_CACHE_TTL)
+        self._cache_versions = None
+        self._cache_lock = threading.Lock()
+
+    @property
+    def ready(self):
+        # 各分片推送（或轮询得到）的状态，不发起请求
+        return all(shard.state["ready"] for shard in self.shards)
+
+    def _route(self, category):
+        # 按分类分片时，分类过滤的查询只发给该分类的分片
+        if category != ALL_CATEGORIES and category in self._by_category:
+            return [self._by_category[category]]
+        return range(len(self.shards))
+
+    def _to_hit(self, position, hit):
+        metadata = {"source": hit["source"], "doc_id": hit["doc_id"] * len(self.shards) + position, "category": hit["category"],
+                    "start": hit.get("start"), "end": hit.get("end")}
+        # 带上 chunk id：RRF 融合按 id 合并两路结果中的同一 chunk
+        return Document(page_content=hit["content"], metadata=metadata, id=hit.get("id")), hit["score"]
+
+    def _global_corpus(self):
+        # 各分片 BM25 统计之和；任一分片推送了新统计时重新合并
+        corpora = [shard.corpus for shard in self.shards]
+        with self._corpus_lock:
+            if any(a is not b for a, b in zip(corpora, self._corpus_from)):
+                df = Counter()
+                for corpus in corpora:
+                    if corpus is not None:
+                        df.update(corpus["df"])
+                self._corpus = {"n": sum(c["n"] for c in corpora if c is not None),
+                                "total_length": sum(c["total_length"] for c in corpora if c is not None), "df": df}
+                self._corpus_from = corpora
+            return self._corpus
+
+    @staticmethod
+    def _query_corpus(corpus, query):
+        # 只发送查询词的文档频率
+        if not corpus or not corpus["n"]:
+            return None
+        df = corpus["df"]
+        return {"n": corpus["n"], "total_length": corpus["total_length"],
+                "df": {term: df[term] for term in set(tokenize(query)) if term in df}}
+
+    @staticmethod
+    def _merge(parts, k, mode, fetch, depth):
+        # 与 search.hybrid_search_many 相同：每路取全局前 depth 条，融合（或截取）为 fetch 条，再按来源折叠为 k 篇
+        dense = sorted(parts["dense"], key=lambda hit: hit[1])[:depth]  # L2 距离越小越相关
+        lexical = sorted(parts["lexical"], key=lambda hit: hit[1], reverse=True)[:depth]
+        if mode == "hybrid":
+            hits = fuse([dense, lexical], fetch)
+        else:
+            hits = (lexical if mode == "lexical" else dense)[:fetch]
+        return collapse(hits, k) if COLLAPSE_BY_SOURCE else hits
+
+    def search(self, query, category=ALL_CATEGORIES, k=5, mode="hybrid"):
+        return self.search_many([(query, category, k, mode)])[0]
+
+    def _versions(self):
+        # 各分片推送的索引版本；变化时清空结果缓存
+        versions = tuple(shard.state["version"] for shard in self.shards)
+        with self._cache_lock:
+            if versions != self._cache_versions:
+                self.result_cache.clear()
+                self._cache_versions = versions
+        return versions
+
+    def search_many(self, requests, query_vectors=None):
+        """批量检索 [(query, category, k, mode)]：查询只嵌入一次，按路由分发给各分片，合并为每条请求的 [(Document, 分数)]。
+
+        未命中结果缓存的查询才发给分片；模型加载中降级为关键词检索的结果与有分片出错时的结果不写入缓存。
+        """
+        with PROFILER.capture():
+            keys = [(normalize_text(query), category, k, mode) for query, category, k, mode in requests]
+            versions = self._versions()
+            results = [self.result_cache.get(key + (versions,)) for key in keys]
+            pending = [i for i, hits in enumerate(results) if hits is None]
+            for i, (_, _, _, mode) in enumerate(requests):
+                REGISTRY.inc("query_requests_total", mode=mode, cache="miss" if results[i] is None else "hit")
+            if not pending:
+                return results
+            degraded = query_vectors is None and not embeddings_ready(self.embeddings)
+            hits, failed = self._search_shards([requests[i] for i in pending],
+                                               None if query_vectors is None else [query_vectors[i] for i in pending])
+            for i, found in zip(pending, hits):
+                results[i] = found
+                if not (degraded and requests[i][3] != "lexical") and not failed:
+                    self.result_cache.put(keys[i] + (versions,), found)
+            return results
+
+    def _search_shards(self, requests, query_vectors):
+        # 返回 (每条请求的结果, 是否有分片出错)
+        # 与 LiveIndex 相同：模型仍在加载时向量/混合检索以关键词检索代替
+        if query_vectors is None and not embeddings_ready(self.embeddings):
+            REGISTRY.inc("query_degraded_total", sum(mode != "lexical" for _, _, _, mode in requests))
+            requests = [(query, category, k, "lexical") for query, category, k, _ in requests]
+        dense = [i for i, request in enumerate(requests) if request[3] != "lexical"]
+        if query_vectors is not None:
+            vectors = {i: query_vectors[i] for i in dense}
+        else:
+            with span("embed", len(dense)):
+                vectors = dict(zip(dense, embed_queries(self.embeddings, [requests[i][0] for i in dense])))
+
+        fetch = [k * COLLAPSE_FETCH_FACTOR if COLLAPSE_BY_SOURCE else k for _, _, k, _ in requests]
+        depth = [max(n, HYBRID_DEPTH) if mode == "hybrid" else n for n, (_, _, _, mode) in zip(fetch, requests)]
+        parts = [(query, category, d, mode) for d, (query, category, _, mode) in zip(depth, requests)]
+        corpus = self._global_corpus() if any(mode != "dense" for _, _, _, mode in requests) else None
+        corpora = [self._query_corpus(corpus, query) if mode != "dense" else None for query, _, _, mode in requests]
+
+        routed = {}
+        for i, (_, category, _, _) in enumerate(requests):
+            for position in self._route(category):
+                routed.setdefault(position, []).append(i)
+        with span("shards", len(requests)):
+            futures = {position: self.shards[position].call("search_parts", [parts[i] for i in idxs],
+                                                            [vectors.get(i) for i in idxs], [corpora[i] for i in idxs])
+                       for position, idxs in routed.items()}
+            merged = [{"dense": [], "lexical": []} for _ in requests]
+            failed = False
+            for position, future in futures.items():
+                # 单个分片出错（进程退出、远程节点不可达）时跳过它，其余分片的结果照常返回
+                try:
+                    shard_hits = future.result()
+                except (RuntimeError, OSError) as e:
+                    REGISTRY.inc("shard_errors_total", shard=self.shards[position].name)
+                    print(f"[shard {self.shards[position].name}] search failed: {e}")
+                    failed = True
+                    continue
+                for i, shard_parts in zip(routed[position], shard_hits):
+                    for part, hits in shard_parts.items():
+                        merged[i][part].extend(self._to_hit(position, hit) for hit in hits)
+        with span("merge", len(requests)):
+            return [self._merge(merged[i], k, mode, fetch[i], depth[i]) for i, (_, _, k, mode) in enumerate(requests)], failed
+
+    def stats(self):
+        futures = [shard.call("stats") for shard in self.shards]
+        shards, categories = {}, {}
+        for spec, future in zip(self.specs, futures):
+            try:
+                stats = future.result()
+            except (RuntimeError, OSError) as e:
+                stats = {"docs": 0, "categories": {}, "ready": False, "version": 0, "snapshot": None, "error": str(e)}
+            shards[spec.name] = {key: stats.get(key) for key in ("docs", "ready", "version", "snapshot", "error")}
+            for category, count in stats["categories"].items():
+                categories[category] = categories.get(category, 0) + count
+        query_cache = getattr(self.embeddings, "query_cache", None)
+        return {
+            "docs": sum(s["docs"] for s in shards.values()),
+            "categories": categories,
+            "ready": all(s["ready"] for s in shards.values()),
+            "model_ready": embeddings_ready(self.embeddings),
+            "version": sum(s["version"] for s in shards.values()),
+            "snapshot": None,
+            "shards": shards,
+            "cache": {"query_embedding": query_cache.stats() if query_cache is not None else None, "results": self.result_cache.stats()},
+        }
+
+    def read_text(self, doc_id):
+        n = len(self.shards)
+        return self.shards[doc_id % n].call("read_text", doc_id // n).result()
+
+    def metrics(self):
+        return REGISTRY.snapshot()
+
+    def start_profile(self, mode):
+        PROFILER.start(mode)
+        return {"profiling": PROFILER.mode}
+
+    def stop_profile(self):
+        return PROFILER.stop()
@@ -0,0 +1,150 @@
+import argparse
+import json
+import os
+import random
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+from categorizer import DEFAULT_CATEGORY, RULES, categorize
+from corpus_shards import SHARD_SUFFIX, ShardWriter, index_path, iter_corpus
+
+# --- 合成语料生成 ---
+# 以 docs/ 中现有文章为模板：先用关键词规则给模板文章分类，按分类收集句子与标题，
+# 再为每篇合成文档抽取同类句子重新组合，并混入该分类的关键词，使生成文档的分类可控。
+# 可指定分类比例（--mix）与重复率（--dup-rate，其中一部分为逐字重复，其余为打乱句序的近似重复）。
+#
+# 输出按 --per-dir 分片（默认每片 10000 篇）：默认每片写成一个打包分片 00000.docs.jsonl（见 corpus_shards.py），
+# 文档的 source 为逻辑路径 00000/doc_xxxxxxxx.txt；--format files 时每篇写成一个 .txt 文件。并写出 labels.jsonl：
+#   {"source": 路径, "category": 生成时指定的分类, "dup_of": 被复制文档的路径或 null}
+
+_SENTENCE = re.compile(r"[^。！？!?\n]+[。！？!?]?")
+
+
+def load_templates(template_dir):
+    """返回 {分类: {"titles": [...], "sentences": [...]}}。"""
+    pools = {}
+    for path, text in iter_corpus(template_dir):
+        lines = [line.strip() for line in text.splitlines() if line.strip()]
+        if not lines:
+            continue
+        pool = pools.setdefault(categorize(path, text), {"titles": [], "sentences": []})
+        pool["titles"].append(lines[0])
+        for line in lines[1:]:
+            pool["sentences"].extend(s.strip() for s in _SENTENCE.findall(line) if len(s.strip()) > 4)
+    return pools
+
+
+def parse_mix(spec, categories):
+    # "AI & Technology=0.5,FinTech & Economy=0.3"；未列出的分类权重为 0，不指定时均匀分布
+    if not spec:
+        return {c: 1.0 for c in categories}
+    mix = {}
+    for part in spec.split(","):
+        name, _, weight = part.rpartition("=")
+        if name.strip() not in categories:
+            raise SystemExit(f"unknown category {name.strip()!r}; available: {sorted(categories)}")
+        mix[name.strip()] = float(weight)
+    return mix
+
+
+def _keywords():
+    words = {rule["category"]: rule["keywords"] for rule in RULES["rules"]}
+    words[DEFAULT_CATEGORY] = []
+    return words
+
+
+def make_document(rng, category, pool, keywords, min_sentences, max_sentences):
+    sentences = rng.sample(pool["sentences"], min(len(pool["sentences"]), rng.randint(min_sentences, max_sentences)))
+    if keywords.get(category):
+        # 在随机位置插入 1-3 个本分类关键词，保证关键词分类与生成标签一致
+        for word in rng.sample(keywords[category], min(len(keywords[category]), rng.randint(1, 3))):
+            sentences.insert(rng.randrange(len(sentences) + 1), f"（{word.capitalize()}）")
+    paragraphs = ["".join(sentences[i:i + 4]) for i in range(0, len(sentences), 4)]
+    title = f"{rng.choice(pool['titles'])} · 第{rng.randrange(1, 10**6)}期"
+    return title + "\n\n" + "\n\n".join(paragraphs)
+
+
+def _generate_shard(args):
+    shard, start, count, out_dir, pools, mix, dup_rate, near_dup_rate, seed, sentences, packed = args
+    rng = random.Random(seed * 1_000_003 + shard)
+    keywords = _keywords()
+    categories = list(mix)
+    weights = [mix[c] for c in categories]
+    shard_dir = os.path.join(out_dir, f"{shard:05d}")
+    if packed:
+        # 分片只追加，重新生成时先删除旧分片
+        shard_path = shard_dir + SHARD_SUFFIX
+        for path in (shard_path, index_path(shard_path)):
+            if os.path.exists(path):
+                os.remove(path)
+        writer = ShardWriter(shard_path)
+    else:
+        os.makedirs(shard_dir, exist_ok=True)
+    written = []  # 本分片已生成的 (path, category, text)，重复文档从中取样
+    labels = []
+    for i in range(start, start + count):
+        path = os.path.join(shard_dir, f"doc_{i:08d}.txt")
+        dup_of = None
+        if written and rng.random() < dup_rate:
+            dup_of, category, text = rng.choice(written)
+            if rng.random() < near_dup_rate:
+                lines = text.split("\n\n")
+                body = lines[1:]
+                rng.shuffle(body)
+                text = "\n\n".join([lines[0]] + body)
+        else:
+            category = rng.choices(categories, weights)[0]
+            text = make_document(rng, category, pools[category], keywords, *sentences)
+            if len(written) < 1000:
+                written.append((path, category, text))
+            else:
+                written[rng.randrange(1000)] = (path, category, text)
+        if packed:
+            writer.append(path, text, category)
+        else:
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(text)
+        labels.append({"source": path, "category": category, "dup_of": dup_of})
+    if packed:
+        writer.close()
+    return labels
+
+
+def generate(out_dir, count, template_dir="docs/", mix=None, dup_rate=0.0, near_dup_rate=0.5, per_dir=10000, seed=0,
+             min_sentences=6, max_sentences=18, workers=None, packed=True):
+    pools = {c: p for c, p in load_templates(template_dir).items() if p["sentences"]}
+    weights = parse_mix(mix, pools)
+    os.makedirs(out_dir, exist_ok=True)
+    tasks = [
+        (shard, start, min(per_dir, count - start), out_dir, pools, weights, dup_rate, near_dup_rate, seed, (min_sentences, max_sentences),
+         packed)
+        for shard, start in enumerate(range(0, count, per_dir))
+    ]
+    # 分片之间互不依赖，按分片并行；labels 按分片顺序逐个写出，不在内存中累积
+    with open(os.path.join(out_dir, "labels.jsonl"), "w", encoding="utf-8") as f, \
+            ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        for labels in pool.map(_generate_shard, tasks):
+            for label in labels:
+                f.write(json.dumps(label, ensure_ascii=False) + "\n")
+    print(f"[synth] {count} docs -> {out_dir} ({len(tasks)} shards)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="以 docs/ 中的文章为模板生成大规模合成语料")
+    parser.add_argument("out_dir")
+    parser.add_argument("-n", "--count", type=int, default=10000)
+    parser.add_argument("--templates", default="docs/")
+    parser.add_argument("--mix", help='分类比例，如 "AI & Technology=0.5,FinTech & Economy=0.3,Humanities & History=0.2"')
+    parser.add_argument("--dup-rate", type=float, default=0.05, help="重复文档比例")
+    parser.add_argument("--near-dup-rate", type=float, default=0.5, help="重复文档中打乱句序的近似重复比例")
+    parser.add_argument("--per-dir", type=int, default=10000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--format", choices=["packed", "files"], default="packed", help="packed：每片一个打包分片；files：每篇一个 .txt")
+    args = parser.parse_args()
+    generate(args.out_dir, args.count, args.templates, args.mix, args.dup_rate, args.near_dup_rate, args.per_dir, args.seed,
+             workers=args.workers, packed=args.format == "packed")
+
+
+if __name__ == "__main__":
+    main()
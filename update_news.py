@@ -1,4 +1,5 @@
 import os
+import sys
 
 # 1. 确保输出目录与之前一致
 output_dir = "docs"
@@ -74,15 +75,29 @@ new_articles = {
     这些宏伟的建筑往往耗时几个世纪才能完工，见证了无数代工匠的生老病死。它们是城市文明（Civilization）的中心，也是历史（History）的见证者。今天，它们依然作为活着的博物馆（Museum），向我们诉说着那个时代人们对彼岸世界的极度渴望。"""
 }
 
-# 3. 写入新文件
+# 3. 写入新文件；--packed 时追加到打包分片 docs/updates.docs.jsonl（重复运行会覆盖同名文章的旧记录）
 count = 0
 print("正在补充新文章...")
-for filename, content in new_articles.items():
-    file_path = os.path.join(output_dir, filename)
-    with open(file_path, "w", encoding='utf-8') as f:
-        f.write(content)
-    count += 1
-    print(f"✅ [新增] 成功生成: {filename}")
+if "--packed" in sys.argv:
+    from corpus_shards import ShardWriter
+
+    with ShardWriter(os.path.join(output_dir, "updates.docs.jsonl")) as writer:
+        for filename, content in new_articles.items():
+            writer.append(os.path.join(output_dir, filename), content)
+            count += 1
+            print(f"✅ [新增] 已写入分片: {filename}")
+else:
+    for filename, content in new_articles.items():
+        file_path = os.path.join(output_dir, filename)
+        with open(file_path, "w", encoding='utf-8') as f:
+            f.write(content)
+        count += 1
+        print(f"✅ [新增] 成功生成: {filename}")
 
 print(f"\n🎉 更新完成！已向 '{output_dir}' 文件夹中添加了 {count} 篇新文章。")
-print("现在的 docs 文件夹中应该共有 38 个文件。")
\ No newline at end of file
+print("现在的 docs 文件夹中应该共有 38 个文件。")
+
+# 4. 可选：直接把新文章写入索引快照（python update_news.py --index），与 ingest.py 命令行共用同一条导入管线
+if "--index" in sys.argv:
+    from ingest import run_ingest
+    run_ingest(output_dir)
@@ -0,0 +1,166 @@
+import threading
+import time
+
+from config import DOCS_DIR, INDEX_DIR, SYNC_INTERVAL, EMBED_WORKERS, INDEX_MODE, INDEX_POLL_INTERVAL, INDEX_SHARDS
+from metrics import PROFILER, REGISTRY
+
+# --- 后台预热 ---
+# app 与检索服务启动时不再阻塞在模型加载与索引载入上：WarmupIndex 构造后立即返回，
+# 两个后台线程并行完成（重模块 langchain / FAISS / torch 都在线程内才导入）：
+#   index 线程：载入磁盘快照 -> 投入使用 -> 增量同步 docs/ -> 启动目录监视
+#   model 线程：导入并加载嵌入模型，做一次前向计算
+# 快照载入前检索返回空结果；快照已载入而模型未就绪时，向量/混合检索以关键词检索代替（见 LiveIndex.search_many），
+# 结果缓存中已有的查询照常命中。没有可用快照、需要全量构建时，index 线程会等待模型加载完成。
+# mode="follow" 时 index 线程只载入现有快照（没有时为空索引），之后轮询 CURRENT 换入新版本，不同步 docs/。
+# 设置了 shards（config.INDEX_SHARDS）时 index 线程启动各分片的工作进程（sharding.ShardedIndex），本进程只运行查询嵌入；
+# shard 为单个分片（service.py --shard），index_dir 为该分片的目录，只索引属于它的文档。
+# 传入 pool（serving.ServingPool）时检索交给其工作线程执行，并发数、排队与线程数受控；embed_threads 限制模型的推理线程数。
+
+
+class WarmupIndex:
+    """后台预热的 LiveIndex 代理，接口与 LiveIndex 中 app / service 用到的部分一致。"""
+
+    def __init__(self, docs_dir=DOCS_DIR, index_dir=INDEX_DIR, sync_interval=SYNC_INTERVAL, workers=EMBED_WORKERS, mode=INDEX_MODE,
+                 shards=INDEX_SHARDS, shard=None, pool=None, embed_threads=None):
+        self.docs_dir = docs_dir
+        self.index_dir = index_dir
+        self.sync_interval = sync_interval
+        self.workers = workers
+        self.mode = mode
+        self.shards = shards if shard is None else None
+        self.shard = shard
+        self.pool = pool
+        self.embed_threads = embed_threads
+        self.live = None
+        self.embeddings = None
+        self.stage = "starting"
+        self.error = None
+        self.timings = {}
+        self._start = time.time()
+        self._embeddings_created = threading.Event()
+        threading.Thread(target=self._load_model, name="warmup-model", daemon=True).start()
+        threading.Thread(target=self._load_index, name="warmup-index", daemon=True).start()
+
+    def _load_model(self):
+        try:
+            from embedder import make_embeddings, warm_up
+
+            self.embeddings = make_embeddings(workers=self.workers, lazy=True, threads=self.embed_threads)
+            self._embeddings_created.set()
+            warm_up(self.embeddings)
+            self.timings["model"] = round(time.time() - self._start, 2)
+        except Exception as e:
+            self.error = f"model: {e}"
+            print(f"[warmup] model failed: {e}")
+        finally:
+            self._embeddings_created.set()
+
+    def _load_index(self):
+        try:
+            from ingest import follow_live_index, open_live_index
+
+            self._embeddings_created.wait()
+            if self.embeddings is None:
+                return
+            self.stage = "loading index"
+            if self.shards:
+                from sharding import ShardedIndex
+
+                # 各分片在自己的进程中载入并同步（或跟随）索引，ShardedIndex 的 ready 在所有分片就绪后才为真
+                self.live = ShardedIndex(self.docs_dir, self.index_dir, self.embeddings, self.mode, self.shards)
+                self.timings["index"] = round(time.time() - self._start, 2)
+                self.stage = "synced"
+                return
+            if self.mode == "follow":
+                self.live = follow_live_index(self.docs_dir, self.index_dir, self.embeddings)
+                self.live.start_follower(INDEX_POLL_INTERVAL)
+                self.timings["index"] = round(time.time() - self._start, 2)
+                self.stage = "synced"
+                print(f"[warmup] {self.timings}")
+                return
+            live = open_live_index(self.docs_dir, self.index_dir, self.embeddings, sync=False, shard=self.shard)
+            self.live = live
+            self.timings["index"] = round(time.time() - self._start, 2)
+            self.stage = "syncing"
+            report = live.sync()
+            if report["added"] or report["updated"] or report["removed"]:
+                print(f"[ingest] {report}")
+            live.start_watcher(self.sync_interval)
+            self.timings["sync"] = round(time.time() - self._start, 2)
+            self.stage = "synced"
+            print(f"[warmup] {self.timings}")
+        except Exception as e:
+            self.error = f"index: {e}"
+            self.stage = "failed"
+            print(f"[warmup] index failed: {e}")
+
+    @property
+    def ready(self):
+        return self.live is not None and self.live.ready and self.status()["model_ready"]
+
+    def status(self):
+        model_ready = False
+        if self.embeddings is not None:
+            from embedder import embeddings_ready
+
+            model_ready = embeddings_ready(self.embeddings)
+        stage = self.stage
+        if stage == "synced":
+            stage = "ready" if model_ready else "loading model"
+        return {
+            "stage": stage,
+            "index_ready": self.live is not None,
+            "model_ready": model_ready,
+            "seconds": round(time.time() - self._start, 1),
+            "timings": dict(self.timings),
+            "error": self.error,
+        }
+
+    def search(self, query, category, k=5, mode="hybrid"):
+        return self.search_many([(query, category, k, mode)])[0]
+
+    def search_many(self, requests, query_vectors=None):
+        if self.live is None:
+            return [[] for _ in requests]
+        if self.pool is not None:
+            # 队满或排队超时时抛出 serving.Overloaded
+            return self.pool.run(self.live.search_many, requests, query_vectors)
+        return self.live.search_many(requests, query_vectors)
+
+    def search_parts(self, requests, query_vectors, corpora=None):
+        # service.py --shard 的 /search/parts，与 search_many 一样受 pool 的并发与排队控制
+        if self.live is None:
+            return [{} for _ in requests]
+        if self.pool is not None:
+            return self.pool.run(self.live.search_parts, requests, query_vectors, corpora)
+        return self.live.search_parts(requests, query_vectors, corpora)
+
+    def stats(self):
+        if self.live is not None:
+            stats = self.live.stats()
+        else:
+            stats = {"docs": 0, "categories": {}, "ready": False, "model_ready": False, "version": 0, "snapshot": None,
+                     "cache": {"query_embedding": None, "results": None}}
+        stats = dict(stats, warmup=self.status())
+        if self.pool is not None:
+            stats["serving"] = self.pool.stats()
+        return stats
+
+    def read_text(self, doc_id):
+        return self.live.read_text(doc_id) if self.live is not None else None
+
+    def shard_state(self, since=None):
+        # service.py --shard 的 /shard/state
+        from sharding import shard_state
+
+        return shard_state(self.live, since)
+
+    def metrics(self):
+        return REGISTRY.snapshot()
+
+    def start_profile(self, mode):
+        PROFILER.start(mode)
+        return {"profiling": PROFILER.mode}
+
+    def stop_profile(self):
+        return PROFILER.stop()